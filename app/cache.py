@@ -0,0 +1,76 @@
+import os
+import time
+
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """In-process LRU cache with per-entry expiry and explicit invalidation
+
+    `set` takes the `version()` observed before the value was read, so a
+    value read before a concurrent `invalidate` of the same key is not
+    cached afterwards.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._invalidated: OrderedDict[Hashable, int] = OrderedDict()
+        self._clock = 0
+        self._cleared = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def version(self) -> int:
+        return self._clock
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, version: int | None = None):
+        if version is not None and (version < self._cleared or self._invalidated.get(key, -1) > version):
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *keys: Hashable):
+        for key in keys:
+            self._clock += 1
+            self._entries.pop(key, None)
+            self._invalidated[key] = self._clock
+            self._invalidated.move_to_end(key)
+        while len(self._invalidated) > self.maxsize:
+            # versions before a forgotten invalidation are refused for every key
+            _, clock = self._invalidated.popitem(last=False)
+            self._cleared = max(self._cleared, clock)
+
+    def clear(self):
+        self._clock += 1
+        self._entries.clear()
+        self._invalidated.clear()
+        self._cleared = self._clock
+
+
+profiles = TTLCache(
+    maxsize=int(os.getenv('BROAPI_PROFILE_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('BROAPI_PROFILE_CACHE_TTL', '30')),
+)
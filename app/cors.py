@@ -0,0 +1,97 @@
+from typing import Iterable
+
+REJECTED_BODY = b'{"error":"invalid origin"}'
+
+
+def _wildcard(origin: str) -> tuple[str, str]:
+    """'https://*.example.com' -> ('https://', '.example.com')"""
+    scheme, _, host = origin.partition('://*')
+    return scheme + '://', host
+
+
+class OriginMiddleware:
+    """Origin filter and CORS headers in one pure ASGI layer
+
+    Requests from origins outside `allow_origins` are rejected with 403
+    unless the path is in `allow_paths`; `*` allows any origin and
+    `scheme://*.domain` any subdomain of domain. Preflight requests are
+    answered here and never reach the router.
+    """
+
+    def __init__(self, app, allow_origins: Iterable[str], allow_paths: Iterable[str] = (),
+                 allow_methods: Iterable[str] = ('GET', 'POST'), max_age: int = 600):
+        self.app = app
+
+        origins = {origin.strip().rstrip('/') for origin in allow_origins if origin.strip()}
+        self.allow_all = '*' in origins
+        self.origins = frozenset(origin for origin in origins if '*' not in origin)
+        self.wildcards = tuple(_wildcard(origin) for origin in origins if '://*.' in origin)
+        self.paths = frozenset(allow_paths)
+        self.methods = frozenset(method.upper() for method in allow_methods)
+
+        self._preflight_headers = [
+            (b'access-control-allow-methods', ', '.join(sorted(self.methods)).encode()),
+            (b'access-control-max-age', str(max_age).encode()),
+            (b'content-type', b'text/plain; charset=utf-8'),
+        ]
+        self._rejected_headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(REJECTED_BODY)).encode()),
+        ]
+
+    def is_allowed(self, origin: str) -> bool:
+        if self.allow_all or origin in self.origins:
+            return True
+        for scheme, suffix in self.wildcards:
+            if origin.startswith(scheme) and origin.endswith(suffix):
+                label = origin[len(scheme):-len(suffix)]
+                if label and '/' not in label and ':' not in label:
+                    return True
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        origin = request_method = request_headers = None
+        for name, value in scope['headers']:
+            if name == b'origin':
+                origin = value.decode('latin-1')
+            elif name == b'access-control-request-method':
+                request_method = value.decode('latin-1')
+            elif name == b'access-control-request-headers':
+                request_headers = value
+
+        allowed = origin is not None and self.is_allowed(origin)
+        if not allowed and not self.allow_all and scope['path'] not in self.paths:
+            return await _respond(send, 403, self._rejected_headers, REJECTED_BODY)
+        if origin is None or not allowed:
+            return await self.app(scope, receive, send)
+
+        cors_headers = self._allow_origin_headers(origin)
+        if scope['method'] == 'OPTIONS' and request_method is not None:
+            if request_method.upper() not in self.methods:
+                return await _respond(send, 400, cors_headers + self._preflight_headers, b'Disallowed CORS method')
+            headers = cors_headers + self._preflight_headers
+            if request_headers is not None:
+                headers.append((b'access-control-allow-headers', request_headers))
+            return await _respond(send, 200, headers, b'OK')
+
+        async def send_with_cors(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', ()), *cors_headers]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+    def _allow_origin_headers(self, origin: str) -> list[tuple[bytes, bytes]]:
+        if self.allow_all:
+            return [(b'access-control-allow-origin', b'*')]
+        return [(b'access-control-allow-origin', origin.encode('latin-1')), (b'vary', b'Origin')]
+
+
+async def _respond(send, status: int, headers: list[tuple[bytes, bytes]], body: bytes):
+    if not any(name == b'content-length' for name, _ in headers):
+        headers = [*headers, (b'content-length', str(len(body)).encode())]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,268 @@
+import asyncio
+import contextvars
+import hashlib
+import logging
+import os
+import time
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+from fastapi import Header, Request, Response
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from sqlalchemy import delete, event, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from sqlmodel import select
+
+from . import metrics
+from .cache import TTLCache
+from .database import session_factory
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+TTL = float(os.getenv('BROAPI_IDEMPOTENCY_TTL', '600'))
+# how long a repeat waits for the response of a first request running on another worker
+WAIT_TIMEOUT = float(os.getenv('BROAPI_IDEMPOTENCY_WAIT_SECONDS', '10'))
+WAIT_POLL = 0.05
+
+replays = metrics.Counter(
+    'broapi_idempotency_replays_total', 'Requests answered with a stored response', ('route',),
+)
+
+
+async def key(idempotency_key: str | None = Header(None, max_length=255)) -> str | None:
+    """Optional Idempotency-Key header; repeats within the window get the first response back"""
+    return idempotency_key
+
+
+@dataclass
+class _StoredResponse:
+    fingerprint: str
+    status_code: int
+    body: bytes
+    media_type: str | None
+
+
+class KeyClaimed(Exception):
+    """Raised into the handler when another request holds its key"""
+
+
+@dataclass
+class _Claim:
+    key: tuple[str, str, str]
+    fingerprint: str
+    inserted: bool = False # in the open transaction of the handler
+    claimed: bool = False # committed with it
+
+
+# the key of the request being handled, claimed by its first transaction
+_claim: contextvars.ContextVar[_Claim | None] = contextvars.ContextVar('idempotency_claim', default=None)
+
+
+@event.listens_for(Session, 'after_begin')
+def _claim_key(session: Session, transaction, connection):
+    """Inserts the key in the transaction of the handler, so it commits or rolls back with its writes
+
+    A concurrent repeat on another worker blocks on the row until the
+    first request finishes; an expired row is taken over.
+    """
+    claim = _claim.get()
+    if claim is None or claim.inserted or claim.claimed:
+        return
+
+    method, path, idempotency_key = claim.key
+    ts_now = datetime.now(timezone.utc)
+    statement = insert(db.IdempotencyKey).values(
+        method=method, path=path, key=idempotency_key, fingerprint=claim.fingerprint, ts_created=ts_now,
+    )
+    claimed = connection.execute(
+        statement.on_conflict_do_update(
+            index_elements=[db.IdempotencyKey.method, db.IdempotencyKey.path, db.IdempotencyKey.key],
+            set_={'fingerprint': claim.fingerprint, 'status_code': None, 'body': None, 'media_type': None, 'ts_created': ts_now},
+            where=db.IdempotencyKey.ts_created < ts_now - timedelta(seconds=TTL),
+        ).returning(db.IdempotencyKey.key)
+    ).first()
+    if claimed is None:
+        raise KeyClaimed()
+    claim.inserted = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _commit_claim(session: Session):
+    claim = _claim.get()
+    if claim is not None and claim.inserted:
+        claim.claimed = True
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_claim(session: Session):
+    # the next transaction of the handler claims the key again
+    claim = _claim.get()
+    if claim is not None and not claim.claimed:
+        claim.inserted = False
+
+
+class IdempotencyStore:
+    """Successful responses by (method, path, key) for the replay window
+
+    Keys and responses are kept in Postgres, so a repeat that lands on
+    another worker is answered from there; each worker also keeps them in
+    memory. A repeat that arrives while the first request is still
+    running waits for it instead of executing concurrently. Failed
+    requests are not stored, their claim goes away with their rollback
+    and they may be retried with the same key.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._responses = TTLCache(maxsize, ttl)
+        self._inflight: dict[tuple[str, str, str], tuple[str, asyncio.Future]] = {}
+
+    async def run(self, key: tuple[str, str, str], fingerprint: str, route: str,
+                  call: Callable[[], Awaitable[Response]]) -> Response:
+        # same worker: answered or awaited without a query
+        while True:
+            stored: _StoredResponse | None = self._responses.get(key)
+            if stored is not None:
+                return self._replay(stored, fingerprint, route)
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            if inflight[0] != fingerprint:
+                return _key_reused()
+            await asyncio.shield(inflight[1])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = (fingerprint, future)
+        claim = _Claim(key, fingerprint)
+        token = _claim.set(claim)
+        try:
+            try:
+                response = await call()
+            except KeyClaimed:
+                response = None
+            finally:
+                _claim.reset(token)
+            if response is None:
+                return await self._wait(key, fingerprint, route)
+
+            if 200 <= response.status_code < 300:
+                stored = _StoredResponse(fingerprint, response.status_code, response.body, response.media_type)
+                self._responses.set(key, stored)
+                if claim.claimed:
+                    await self._save(key, stored)
+            elif claim.claimed:
+                await self._release(key)
+            return response
+        except Exception:
+            if claim.claimed:
+                await self._release(key)
+            raise
+        finally:
+            del self._inflight[key]
+            future.set_result(None)
+
+    async def _wait(self, key: tuple[str, str, str], fingerprint: str, route: str) -> Response:
+        """Polls for the response of the request holding key on another worker"""
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            row = await self._load(key)
+            if row is None:
+                # the first request failed and gave the key up
+                break
+            if row.fingerprint != fingerprint:
+                return _key_reused()
+            if row.status_code is not None:
+                stored = _StoredResponse(row.fingerprint, row.status_code, row.body, row.media_type)
+                self._responses.set(key, stored)
+                return self._replay(stored, fingerprint, route)
+            await asyncio.sleep(WAIT_POLL)
+        return JSONResponse({'detail': f"a request with this {HEADER} is still in progress; retry"}, status_code=409)
+
+    async def _load(self, key: tuple[str, str, str]) -> db.IdempotencyKey | None:
+        method, path, idempotency_key = key
+        async with session_factory() as session:
+            row = await session.exec(
+                select(db.IdempotencyKey).where(
+                    db.IdempotencyKey.method == method,
+                    db.IdempotencyKey.path == path,
+                    db.IdempotencyKey.key == idempotency_key,
+                )
+            )
+            return row.one_or_none()
+
+    async def _save(self, key: tuple[str, str, str], stored: _StoredResponse):
+        method, path, idempotency_key = key
+        async with session_factory() as session:
+            await session.exec(
+                update(db.IdempotencyKey)
+                    .where(db.IdempotencyKey.method == method, db.IdempotencyKey.path == path, db.IdempotencyKey.key == idempotency_key)
+                    .values(status_code=stored.status_code, body=stored.body, media_type=stored.media_type)
+                    .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+
+    async def _release(self, key: tuple[str, str, str]):
+        # a claim committed before the handler failed would block retries until it expires
+        method, path, idempotency_key = key
+        try:
+            async with session_factory() as session:
+                await session.exec(
+                    delete(db.IdempotencyKey)
+                        .where(
+                            db.IdempotencyKey.method == method,
+                            db.IdempotencyKey.path == path,
+                            db.IdempotencyKey.key == idempotency_key,
+                            db.IdempotencyKey.status_code == None,
+                        )
+                        .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+        except Exception:
+            logger.exception("releasing idempotency key %r failed", key)
+
+    def _replay(self, stored: _StoredResponse, fingerprint: str, route: str) -> Response:
+        if stored.fingerprint != fingerprint:
+            return _key_reused()
+
+        replays.inc(route=route)
+        response = Response(stored.body, status_code=stored.status_code, media_type=stored.media_type)
+        response.headers[REPLAYED_HEADER] = 'true'
+        return response
+
+
+def _key_reused() -> Response:
+    return JSONResponse({'detail': f"{HEADER} was already used with a different request"}, status_code=422)
+
+
+store = IdempotencyStore(
+    maxsize=int(os.getenv('BROAPI_IDEMPOTENCY_CACHE_SIZE', '50000')),
+    ttl=TTL,
+)
+
+
+class IdempotentRoute(APIRoute):
+    """Route class that honours Idempotency-Key on routes depending on `key`"""
+
+    def get_route_handler(self) -> Callable[[Request], Awaitable[Response]]:
+        handler = super().get_route_handler()
+        if not any(dependency.dependency is key for dependency in self.dependencies):
+            return handler
+
+        async def idempotent_handler(request: Request) -> Response:
+            header = request.headers.get(HEADER)
+            if header is None:
+                return await handler(request)
+
+            # the body is cached on the request, the handler reads it again for free
+            fingerprint = hashlib.sha256(await request.body()).hexdigest()
+            request_key = (request.method, request.url.path, header)
+            return await store.run(request_key, fingerprint, self.path, lambda: handler(request))
+
+        return idempotent_handler
@@ -0,0 +1,182 @@
+"""Cross-worker invalidation of the in-process caches over LISTEN/NOTIFY
+
+Endpoints publish what they changed on their session; the events go out
+with one NOTIFY in the same transaction, so other workers hear about them
+only if it commits, and are applied locally right after the commit. Each
+worker listens on a dedicated connection and applies the events of the
+others to its profile cache, opponent pool, leaderboards and the
+read-your-writes window of the replica routing.
+"""
+import asyncio
+import logging
+import os
+import uuid
+
+from datetime import datetime
+from typing import Any, Callable
+
+import asyncpg
+import pydantic_core
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.orm import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from . import cache, matchmaking, metrics
+from .database import engine, env_flag
+from .leaderboard import leaderboards
+from .replicas import replicas
+from .models import domain
+
+logger = logging.getLogger(__name__)
+
+
+ENABLED = env_flag('BROAPI_INVALIDATION', True)
+# LISTEN needs a session-mode connection; set it when BROAPI_DB_DSN points at pgbouncer in transaction mode
+DSN = os.getenv('BROAPI_INVALIDATION_DSN') or engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+CHANNEL = 'broapi_invalidation'
+# an idle connection that died unnoticed would silently stop invalidating
+PING_INTERVAL = 5.0
+# NOTIFY payloads are limited to 8000 bytes
+MAX_PAYLOAD = 7900
+
+# events published by this process are already applied when they come back
+ORIGIN = uuid.uuid4().hex
+
+events_received = metrics.Counter('broapi_invalidation_received_total', 'Invalidation events applied from other workers')
+
+
+def _timestamp(value: datetime | str | None) -> datetime | None:
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+HANDLERS: dict[str, Callable[..., Any]] = {
+    'profiles': lambda *user_ids: cache.profiles.invalidate(*user_ids),
+    'pool.upsert': lambda user_id, level, ts: matchmaking.pool.upsert(user_id, level, _timestamp(ts)),
+    'pool.reserve': lambda user_id, ts: matchmaking.pool.reserve(user_id, _timestamp(ts)),
+    'pool.release': lambda user_id: matchmaking.pool.release(user_id),
+    'rank': lambda kind, user_id, value, username=None: leaderboards.update(domain.LeaderboardKind(kind), user_id, value, username),
+    'written': lambda *user_ids: replicas.stick(*user_ids),
+}
+
+_INFO_KEY = 'invalidation_events'
+
+
+def publish(session: AsyncSession, name: str, *args):
+    """Applies the event here once session commits and broadcasts it to the other workers"""
+    session.info.setdefault(_INFO_KEY, []).append((name, args))
+
+
+def _apply(events: list[tuple[str, tuple]]):
+    for name, args in events:
+        try:
+            HANDLERS[name](*args)
+        except Exception:
+            logger.exception("invalidation event %s%r failed", name, args)
+
+
+def _payloads(events: list[tuple[str, tuple]]) -> list[str]:
+    payloads, batch = [], []
+    for name, args in events:
+        batch.append([name, *args])
+        payload = pydantic_core.to_json({'origin': ORIGIN, 'events': batch}).decode()
+        if len(payload) > MAX_PAYLOAD and len(batch) > 1:
+            payloads.append(pydantic_core.to_json({'origin': ORIGIN, 'events': batch[:-1]}).decode())
+            batch = batch[-1:]
+    if batch:
+        payloads.append(pydantic_core.to_json({'origin': ORIGIN, 'events': batch}).decode())
+    return payloads
+
+
+NOTIFY = text('SELECT pg_notify(:channel, :payload)')
+
+
+@event.listens_for(Session, 'before_commit')
+def _notify(session: Session):
+    events = session.info.get(_INFO_KEY)
+    if not events or not ENABLED:
+        return
+    for payload in _payloads(events):
+        session.execute(NOTIFY, {'channel': CHANNEL, 'payload': payload})
+
+
+async def notify(connection: AsyncConnection, events: list[tuple[str, tuple]]):
+    """Broadcasts events in the open transaction of connection, for writes made without a session
+
+    Nothing is applied in this process; the caller commits.
+    """
+    if not events or not ENABLED:
+        return
+    for payload in _payloads(events):
+        await connection.execute(NOTIFY, {'channel': CHANNEL, 'payload': payload})
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_committed(session: Session):
+    events = session.info.pop(_INFO_KEY, None)
+    if events:
+        _apply(events)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session: Session):
+    session.info.pop(_INFO_KEY, None)
+
+
+class Listener:
+    """LISTENs on a dedicated connection, reconnecting when it drops
+
+    Notifications sent while disconnected are lost, so the profile cache
+    is cleared on every reconnect; the opponent pool and the leaderboards
+    catch up on their own periodic refresh.
+    """
+
+    def __init__(self):
+        self._worker: asyncio.Task | None = None
+        self._connection: asyncpg.Connection | None = None
+
+    async def start(self):
+        if not ENABLED:
+            return
+        await self._connect()
+        self._worker = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def _connect(self):
+        self._connection = await asyncpg.connect(DSN)
+        await self._connection.add_listener(CHANNEL, self._received)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(PING_INTERVAL)
+            try:
+                await self._connection.fetchval('SELECT 1', timeout=PING_INTERVAL)
+                continue
+            except Exception:
+                logger.warning("invalidation listener lost its connection; reconnecting")
+                self._connection.terminate()
+
+            try:
+                await self._connect()
+                cache.profiles.clear()
+            except Exception:
+                logger.exception("invalidation listener failed to reconnect")
+
+    def _received(self, connection, pid, channel, payload: str):
+        message = pydantic_core.from_json(payload)
+        if message['origin'] == ORIGIN:
+            return
+        events_received.inc(len(message['events']))
+        _apply([(event[0], tuple(event[1:])) for event in message['events']])
+
+
+listener = Listener()
@@ -0,0 +1,115 @@
+"""Rolling maintenance of the monthly pvp.matches partitions
+
+Creates the partitions for the coming months and archives the ones older
+than the retention window: open matches left in them are dropped, the
+rest is compacted into pvp.matches_archive and the partition is detached
+into the pvp_archive schema (or dropped with --drop). Run it at least
+monthly, inserts fail once no partition covers the current month:
+
+    python -m app.jobs.archive_matches [--keep-months 3] [--ahead 3] [--drop]
+"""
+import argparse
+import asyncio
+
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+from ..database import engine, session_factory
+
+ARCHIVE_SCHEMA = 'pvp_archive'
+
+
+def _month_start(ts: datetime, months: int = 0) -> datetime:
+    """First instant of the UTC month `months` away from ts"""
+    index = ts.year * 12 + ts.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def _partition_name(month: datetime) -> str:
+    return f'matches_{month:%Y_%m}'
+
+
+async def create_partitions(ahead: int):
+    ts_now = datetime.now(timezone.utc)
+    async with session_factory() as session:
+        for months in range(ahead + 1):
+            month = _month_start(ts_now, months)
+            # bounds are literals, identifiers come from _partition_name only
+            await session.exec(text(
+                f"CREATE TABLE IF NOT EXISTS pvp.{_partition_name(month)} PARTITION OF pvp.matches "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_month_start(month, 1).isoformat()}')"
+            ))
+        await session.commit()
+
+
+async def _expired_partitions(keep_months: int) -> list[str]:
+    """Attached partitions entirely older than the retention window"""
+    cutoff = _month_start(datetime.now(timezone.utc), -keep_months)
+    async with session_factory() as session:
+        rows = await session.exec(text('''
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = 'pvp.matches'::regclass
+            ORDER BY child.relname
+        '''))
+        expired = []
+        for name, bound in rows.all():
+            month = name.removeprefix('matches_')
+            try:
+                start = datetime.strptime(month, '%Y_%m').replace(tzinfo=timezone.utc)
+            except ValueError:
+                print(f"skipping partition {name} ({bound})")
+                continue
+            if _month_start(start, 1) <= cutoff:
+                expired.append(name)
+        return expired
+
+
+async def archive_partition(name: str, drop: bool):
+    async with session_factory() as session:
+        # detaching waits for an exclusive lock on pvp.matches; give up rather than queue requests behind it
+        await session.exec(text("SET LOCAL lock_timeout = '5s'"))
+
+        # unfinished matches this old are abandoned; search_match opens a new one when needed
+        abandoned = await session.exec(text(f'DELETE FROM pvp.{name} WHERE ts_finished IS NULL'))
+        await session.exec(text(f'''
+            INSERT INTO pvp.matches_archive (player_id, matches, ts_last_finished)
+            SELECT player_id, count(*), max(ts_finished) FROM pvp.{name} GROUP BY player_id
+            ON CONFLICT (player_id) DO UPDATE SET
+                matches = matches_archive.matches + excluded.matches,
+                ts_last_finished = greatest(matches_archive.ts_last_finished, excluded.ts_last_finished)
+        '''))
+        await session.exec(text(f'ALTER TABLE pvp.matches DETACH PARTITION pvp.{name}'))
+        if drop:
+            await session.exec(text(f'DROP TABLE pvp.{name}'))
+        else:
+            await session.exec(text(f'CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}'))
+            await session.exec(text(f'ALTER TABLE pvp.{name} SET SCHEMA {ARCHIVE_SCHEMA}'))
+        await session.commit()
+
+    print(f"archived {name}; dropped {abandoned.rowcount} abandoned matches")
+
+
+async def maintain(keep_months: int = 3, ahead: int = 3, drop: bool = False):
+    await create_partitions(ahead)
+    for name in await _expired_partitions(keep_months):
+        await archive_partition(name, drop)
+
+
+async def main(keep_months: int, ahead: int, drop: bool):
+    try:
+        await maintain(keep_months, ahead, drop)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--keep-months', type=int, default=3, help='whole months kept attached before the current one')
+    parser.add_argument('--ahead', type=int, default=3, help='months to create partitions for in advance')
+    parser.add_argument('--drop', action='store_true', help='drop archived partitions instead of keeping them in pvp_archive')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.keep_months, args.ahead, args.drop))
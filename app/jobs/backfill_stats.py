@@ -0,0 +1,67 @@
+"""One-off backfill of pvp.characters stats counters from pvp.matches
+
+Run once after migrations/0002 is applied and start_match maintains the
+counters:
+
+    python -m app.jobs.backfill_stats [batch_size]
+"""
+import asyncio
+import sys
+
+from sqlalchemy import Integer, case, func, literal, union_all, update
+from sqlmodel import select
+
+from ..database import engine, session_factory
+from ..models import db
+
+
+def _stats_for(user_ids: list[int]):
+    finished = db.PVPMatch.ts_finished != None
+    attacks = select(
+        db.PVPMatch.player_id.label('user_id'),
+        case((db.PVPMatch.result == db.MatchResult.win, 1), else_=0).label('won'),
+        case((db.PVPMatch.result == db.MatchResult.win, db.PVPMatch.loot['coins'].as_integer()), else_=0).label('loot'),
+    ).where(db.PVPMatch.player_id.in_(user_ids), finished)
+    defences = select(
+        db.PVPMatch.opponent_id.label('user_id'),
+        case((db.PVPMatch.result == db.MatchResult.lose, 1), else_=0).label('won'),
+        literal(0, Integer).label('loot'),
+    ).where(db.PVPMatch.opponent_id.in_(user_ids), finished)
+
+    matches = union_all(attacks, defences).subquery()
+    return select(
+        matches.c.user_id,
+        func.count().label('total'),
+        func.sum(matches.c.won).label('won'),
+        func.sum(matches.c.loot).label('loot'),
+    ).group_by(matches.c.user_id).subquery()
+
+
+async def backfill(batch_size: int = 1000):
+    last_user_id, updated = None, 0
+    while True:
+        async with session_factory() as session:
+            statement = select(db.PVPCharacter.user_id).order_by(db.PVPCharacter.user_id).limit(batch_size)
+            if last_user_id is not None:
+                statement = statement.where(db.PVPCharacter.user_id > last_user_id)
+            user_ids = (await session.exec(statement)).all()
+            if not user_ids:
+                break
+
+            stats = _stats_for(user_ids)
+            result = await session.exec(
+                update(db.PVPCharacter)
+                    .where(db.PVPCharacter.user_id == stats.c.user_id)
+                    .values(stats_total=stats.c.total, stats_won=stats.c.won, stats_loot=stats.c.loot)
+                    .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+
+        last_user_id, updated = user_ids[-1], updated + result.rowcount
+        print(f"backfilled {updated} characters; last user_id {last_user_id}")
+
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(backfill(*map(int, sys.argv[1:2])))
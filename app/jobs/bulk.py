@@ -0,0 +1,221 @@
+"""Bulk user imports and cohort grants for migrations and campaigns
+
+Imports stream the file into a temp table with COPY and create each batch
+of users (and characters) with one INSERT ... SELECT; grants change a batch
+of telegram ids with one UPDATE and tell the workers what changed over the
+invalidation channel, in the same transaction. Progress is printed after
+every batch:
+
+    python -m app.jobs.bulk [--batch 10000] import users.csv [--characters]
+    python -m app.jobs.bulk premium ids.txt --days 30
+    python -m app.jobs.bulk energy ids.txt --boost 10
+    python -m app.jobs.bulk coins ids.txt --amount 500
+
+Users come as CSV with a user_id,username header or as NDJSON objects with
+the same keys (by extension, .ndjson or .jsonl); users that already exist
+are skipped. Id files hold one telegram id per line.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import time
+
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+from sqlalchemy import text
+
+from .. import invalidation
+from ..database import engine
+from ..models import domain
+
+BATCH_SIZE = 10000
+
+# same starting values as post_user and _load_character
+CREATE_USERS = '''
+    INSERT INTO users (sid, username, ref_code, tg_id, refs, score, last_score, energy, tickets, boxes,
+                       ton_balanse, mining_claim, last_tap, last_login, reward_streak, region, advertising_limit)
+    SELECT gen_random_uuid(), bulk.username, bulk.user_id, bulk.tg_id, '{"id": []}', 25, 0, 1000, 25, 0,
+           0, true, now(), now(), 1, 'eng', 10
+    FROM (SELECT DISTINCT ON (user_id) * FROM bulk_users ORDER BY user_id) AS bulk
+    WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.tg_id = bulk.tg_id)
+      AND (bulk.tg_id IS NOT NULL OR NOT EXISTS (SELECT 1 FROM users WHERE users.ref_code = bulk.user_id))
+'''
+CREATE_REFERAL_SCORES = '''
+    INSERT INTO referals_score (username, score)
+    SELECT DISTINCT user_id, 0 FROM bulk_users
+    ON CONFLICT (username) DO NOTHING
+'''
+CREATE_CHARACTERS = '''
+    INSERT INTO pvp.characters (user_id, username, ts_updated, abilities, level, experience, power,
+                                ts_last_match, energy_last_match, energy_max, energy_boost, ts_defences_today,
+                                stats_total, stats_won, stats_loot)
+    SELECT DISTINCT ON (tg_id) tg_id, coalesce(nullif(username, ''), 'unnamed_bro'), now(), CAST(:abilities AS jsonb), 0, 0, :power,
+           now(), 2, 2, 0, 0,
+           0, 0, 0
+    FROM bulk_users
+    WHERE tg_id IS NOT NULL
+    ON CONFLICT (user_id) DO NOTHING
+'''
+
+# extends an active premium, starts from now otherwise
+GRANT_PREMIUM = '''
+    UPDATE pvp.characters
+    SET ts_premium_until = greatest(coalesce(ts_premium_until, now()), now()) + make_interval(days => :days),
+        ts_updated = now()
+    WHERE user_id = ANY(:ids)
+    RETURNING user_id
+'''
+GRANT_ENERGY = '''
+    UPDATE pvp.characters SET energy_boost = energy_boost + :boost, ts_updated = now()
+    WHERE user_id = ANY(:ids)
+    RETURNING user_id
+'''
+# logged to the coin ledger like the balance changes of app.ledger; of users
+# sharing a telegram id only the lowest sid is credited, as there
+GRANT_COINS = '''
+    WITH granted AS (
+        UPDATE users SET score = coalesce(score, 0) + :amount
+        WHERE sid IN (SELECT DISTINCT ON (tg_id) sid FROM users WHERE tg_id = ANY(:ids) ORDER BY tg_id, sid)
+        RETURNING sid, tg_id, username, score
+    ), logged AS (
+        INSERT INTO coin_ledger (user_sid, delta, balance, reason)
+        SELECT sid, :amount, score, 'grant' FROM granted
+    )
+    SELECT tg_id, username, score FROM granted
+'''
+# ids per 'profiles' event, keeps each event well under the NOTIFY payload limit
+PROFILES_PER_EVENT = 500
+
+
+def _profile_events(rows) -> list[tuple[str, tuple]]:
+    user_ids = [user_id for user_id, in rows]
+    return [('profiles', tuple(batch)) for batch in _batches(user_ids, PROFILES_PER_EVENT)]
+
+
+def _rank_events(rows) -> list[tuple[str, tuple]]:
+    return [('rank', (domain.LeaderboardKind.coins, tg_id, score, username)) for tg_id, username, score in rows]
+
+
+def _read_users(path: Path) -> Iterator[domain.CreateUser]:
+    with path.open(newline='') as f:
+        if path.suffix in ('.ndjson', '.jsonl'):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for row in rows:
+            yield domain.CreateUser(user_id=str(row['user_id']).strip(), username=row.get('username') or '')
+
+
+def _read_ids(path: Path) -> list[int]:
+    with path.open() as f:
+        return [int(line) for line in f if line.strip()]
+
+
+def _non_negative(value: str) -> int:
+    amount = int(value)
+    if amount < 0:
+        raise argparse.ArgumentTypeError(f"{value} is below 0")
+    return amount
+
+
+def _batches(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _progress(action: str, done: int, changed: int, started: float, total: int | None = None):
+    elapsed = time.monotonic() - started
+    of_total = f"/{total}" if total is not None else ''
+    print(f"{action}: {done}{of_total} processed, {changed} changed, {done / elapsed if elapsed else 0:.0f}/s")
+
+
+async def import_users(path: Path, characters: bool = False, batch_size: int = BATCH_SIZE):
+    abilities = domain.AbilityScores.default()
+    started, done, created = time.monotonic(), 0, 0
+    async with engine.connect() as conn:
+        await conn.exec_driver_sql(
+            'CREATE TEMP TABLE bulk_users (user_id varchar NOT NULL, username varchar, tg_id bigint)'
+        )
+        await conn.commit()
+        copy = (await conn.get_raw_connection()).driver_connection.copy_records_to_table
+
+        for batch in _batches(_read_users(path), batch_size):
+            records = [
+                (user.user_id, user.username, domain.telegram_id(user.user_id))
+                for user in batch
+            ]
+            await copy('bulk_users', records=records, columns=['user_id', 'username', 'tg_id'])
+            result = await conn.execute(text(CREATE_USERS))
+            await conn.execute(text(CREATE_REFERAL_SCORES))
+            if characters:
+                await conn.execute(text(CREATE_CHARACTERS), dict(
+                    abilities=abilities.model_dump_json(), power=abilities.power()
+                ))
+            await conn.execute(text('TRUNCATE bulk_users'))
+            await conn.commit()
+
+            done, created = done + len(batch), created + result.rowcount
+            _progress('import', done, created, started)
+
+
+async def grant(statement: str, events: Callable[[list], list[tuple[str, tuple]]], ids: list[int],
+                batch_size: int = BATCH_SIZE, **params):
+    """Runs statement for each batch of ids; the workers hear about the rows it returns with the commit"""
+    started, done, changed = time.monotonic(), 0, 0
+    async with engine.connect() as conn:
+        for batch in _batches(ids, batch_size):
+            result = await conn.execute(text(statement), dict(params, ids=batch))
+            rows = result.all()
+            await invalidation.notify(conn, events(rows))
+            await conn.commit()
+
+            done, changed = done + len(batch), changed + len(rows)
+            _progress('grant', done, changed, started, len(ids))
+    if changed < len(ids):
+        print(f"{len(ids) - changed} ids matched nothing")
+
+
+async def main(args: argparse.Namespace):
+    try:
+        if args.command == 'import':
+            await import_users(Path(args.file), args.characters, args.batch)
+        elif args.command == 'premium':
+            await grant(GRANT_PREMIUM, _profile_events, _read_ids(Path(args.file)), args.batch, days=args.days)
+        elif args.command == 'energy':
+            await grant(GRANT_ENERGY, _profile_events, _read_ids(Path(args.file)), args.batch, boost=args.boost)
+        elif args.command == 'coins':
+            await grant(GRANT_COINS, _rank_events, _read_ids(Path(args.file)), args.batch, amount=args.amount)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='rows per statement and transaction')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('import', help='create users from a CSV or NDJSON file')
+    command.add_argument('file')
+    command.add_argument('--characters', action='store_true', help='also create their pvp characters')
+
+    command = commands.add_parser('premium', help='extend premium of the listed characters')
+    command.add_argument('file')
+    command.add_argument('--days', type=int, required=True)
+
+    command = commands.add_parser('energy', help='add energy boosts to the listed characters')
+    command.add_argument('file')
+    command.add_argument('--boost', type=int, required=True)
+
+    command = commands.add_parser('coins', help='add coins to the listed users')
+    command.add_argument('file')
+    command.add_argument('--amount', type=_non_negative, required=True)
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import os
+
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel import select
+
+from .database import session_factory
+from .models import db, domain
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL = float(os.getenv('BROAPI_LEADERBOARD_RECONCILE_SECONDS', '60'))
+# rows committed by other workers may carry timestamps slightly behind the watermark
+RECONCILE_OVERLAP = timedelta(seconds=30)
+# entries per sorted sublist; lists are split at twice this size
+LOAD = 512
+
+# the row of each telegram id is the lowest sid, the one the API and app.ledger use;
+# a NULL score there takes the user off the board
+USERS = '''
+    SELECT DISTINCT ON (tg_id) tg_id, username, score FROM users
+    WHERE tg_id IS NOT NULL
+    ORDER BY tg_id, sid
+'''
+USERS_CHANGED = '''
+    SELECT DISTINCT ON (tg_id) tg_id, username, score FROM users
+    WHERE tg_id IN (SELECT tg_id FROM users WHERE ts_score_updated > :since)
+    ORDER BY tg_id, sid
+'''
+
+
+class RankIndex:
+    """Order statistics over user values, highest value first
+
+    Entries (-value, user_id) are kept in sorted sublists of at most
+    2 * LOAD with a Fenwick tree over the sublist lengths, so update, rank
+    and the start of a page cost O(log n) plus a shift within one sublist.
+    Equal values are ranked by user_id.
+    """
+
+    def __init__(self, values: dict[int, float] | None = None):
+        self._values: dict[int, float] = {}
+        self._lists: list[list[tuple[float, int]]] = []
+        self._maxes: list[tuple[float, int]] = []
+        self._tree: list[int] = []
+        if values:
+            self._load(values)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def value(self, user_id: int) -> float | None:
+        return self._values.get(user_id)
+
+    def update(self, user_id: int, value: float):
+        previous = self._values.get(user_id)
+        if previous == value:
+            return
+        if previous is not None:
+            self._remove((-previous, user_id))
+        self._values[user_id] = value
+        self._insert((-value, user_id))
+
+    def discard(self, user_id: int):
+        previous = self._values.pop(user_id, None)
+        if previous is not None:
+            self._remove((-previous, user_id))
+
+    def reconcile(self, values: dict[int, float]):
+        """Brings the ranking in line with values, touching only the entries that differ"""
+        if not self._values:
+            return self._load(values)
+        for user_id in self._values.keys() - values.keys():
+            self.discard(user_id)
+        for user_id, value in values.items():
+            self.update(user_id, value)
+
+    def rank(self, user_id: int) -> int | None:
+        """1-based position of user_id, None if not ranked"""
+        value = self._values.get(user_id)
+        if value is None:
+            return None
+        entry = (-value, user_id)
+        index = bisect_left(self._maxes, entry)
+        return self._prefix(index) + bisect_left(self._lists[index], entry) + 1
+
+    def page(self, offset: int, limit: int) -> list[tuple[int, float]]:
+        """(user_id, value) pairs ranked offset + 1 to offset + limit"""
+        if offset >= len(self._values):
+            return []
+        index, position = self._locate(offset)
+        page = []
+        while index < len(self._lists) and len(page) < limit:
+            page.extend((user_id, -value) for value, user_id in self._lists[index][position:position + limit - len(page)])
+            index, position = index + 1, 0
+        return page
+
+    def _load(self, values: dict[int, float]):
+        self._values = dict(values)
+        entries = sorted((-value, user_id) for user_id, value in self._values.items())
+        self._lists = [entries[start:start + LOAD] for start in range(0, len(entries), LOAD)]
+        self._maxes = [entries[-1] for entries in self._lists]
+        self._build_tree()
+
+    def _insert(self, entry: tuple[float, int]):
+        if not self._lists:
+            self._lists.append([entry])
+            self._maxes.append(entry)
+            self._build_tree()
+            return
+
+        index = bisect_left(self._maxes, entry)
+        if index == len(self._maxes):
+            index -= 1
+            self._lists[index].append(entry)
+            self._maxes[index] = entry
+        else:
+            insort(self._lists[index], entry)
+        self._add(index, 1)
+
+        entries = self._lists[index]
+        if len(entries) > 2 * LOAD:
+            self._lists[index:index + 1] = [entries[:LOAD], entries[LOAD:]]
+            self._maxes[index:index + 1] = [entries[LOAD - 1], entries[-1]]
+            self._build_tree()
+
+    def _remove(self, entry: tuple[float, int]):
+        index = bisect_left(self._maxes, entry)
+        entries = self._lists[index]
+        del entries[bisect_left(entries, entry)]
+        if entries:
+            self._maxes[index] = entries[-1]
+            self._add(index, -1)
+        else:
+            del self._lists[index], self._maxes[index]
+            self._build_tree()
+
+    def _build_tree(self):
+        tree = [len(entries) for entries in self._lists]
+        for index in range(len(tree)):
+            parent = index | (index + 1)
+            if parent < len(tree):
+                tree[parent] += tree[index]
+        self._tree = tree
+
+    def _add(self, index: int, delta: int):
+        while index < len(self._tree):
+            self._tree[index] += delta
+            index |= index + 1
+
+    def _prefix(self, index: int) -> int:
+        """Entries in the sublists before index"""
+        total = 0
+        while index > 0:
+            total += self._tree[index - 1]
+            index &= index - 1
+        return total
+
+    def _locate(self, position: int) -> tuple[int, int]:
+        """(sublist, offset within it) of the entry at 0-based position"""
+        index = 0
+        step = 1 << len(self._tree).bit_length()
+        while step:
+            probe = index + step
+            if probe <= len(self._tree) and self._tree[probe - 1] <= position:
+                position -= self._tree[probe - 1]
+                index = probe
+            step >>= 1
+        return index, position
+
+
+class Leaderboards:
+    """Coins and power rankings of every worker, kept in memory
+
+    Endpoints that change a balance or power update the rankings after
+    commit; changes made by other workers, admin tools or the database
+    show up when a background task reconciles the rankings with the rows
+    changed since the last reconciliation, every RECONCILE_INTERVAL
+    seconds. The tables are read in full only on the first load, so users
+    deleted from them stay ranked until the worker restarts. Requests
+    only read the rankings.
+    """
+
+    def __init__(self):
+        self.boards = {kind: RankIndex() for kind in domain.LeaderboardKind}
+        self.usernames: dict[int, str] = {}
+        self._worker: asyncio.Task | None = None
+        # database time of the last read; None until the first full load
+        self._watermark: datetime | None = None
+        # updates made while a reconciliation reads the tables, replayed after it
+        self._reload_updates: list[tuple[domain.LeaderboardKind, int, float]] | None = None
+
+    def __getitem__(self, kind: domain.LeaderboardKind) -> RankIndex:
+        return self.boards[kind]
+
+    def update(self, kind: domain.LeaderboardKind, user_id: int, value: float | None, username: str | None = None):
+        if value is None:
+            return
+        if username is not None:
+            self.usernames[user_id] = username
+        self.boards[kind].update(user_id, value)
+        if self._reload_updates is not None:
+            self._reload_updates.append((kind, user_id, value))
+
+    async def start(self):
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+
+    async def refresh(self, session: AsyncSession):
+        """Reconciles the rankings with the rows changed since the last refresh, all of them the first time"""
+        self._reload_updates = []
+        try:
+            ts_read = await session.scalar(text('SELECT now()'))
+            if self._watermark is None:
+                users = await session.exec(text(USERS))
+                characters = await session.exec(select(db.PVPCharacter.user_id, db.PVPCharacter.power))
+            else:
+                since = self._watermark - RECONCILE_OVERLAP
+                users = await session.exec(text(USERS_CHANGED), params={'since': since})
+                characters = await session.exec(
+                    select(db.PVPCharacter.user_id, db.PVPCharacter.power).where(db.PVPCharacter.ts_updated > since)
+                )
+            users = users.all()
+            characters = characters.all()
+
+            coins = self.boards[domain.LeaderboardKind.coins]
+            if self._watermark is None:
+                coins.reconcile({user_id: score for user_id, _, score in users if score is not None})
+                self.boards[domain.LeaderboardKind.power].reconcile(dict(characters))
+                self.usernames = {user_id: username for user_id, username, score in users if score is not None}
+            else:
+                for user_id, username, score in users:
+                    if score is None:
+                        coins.discard(user_id)
+                    else:
+                        coins.update(user_id, score)
+                        self.usernames[user_id] = username
+                for user_id, power in characters:
+                    self.boards[domain.LeaderboardKind.power].update(user_id, power)
+            # the rows may predate changes committed here while they were read
+            for kind, user_id, value in self._reload_updates:
+                self.boards[kind].update(user_id, value)
+            self._watermark = ts_read
+        finally:
+            self._reload_updates = None
+
+    async def _run(self):
+        # loaded by the warmup already, unless it is disabled
+        delay = RECONCILE_INTERVAL if self._watermark is not None else 0
+        while True:
+            await asyncio.sleep(delay)
+            delay = RECONCILE_INTERVAL
+            try:
+                async with session_factory() as session:
+                    await self.refresh(session)
+            except Exception:
+                logger.exception("leaderboard reconciliation failed")
+
+
+leaderboards = Leaderboards()
@@ -0,0 +1,123 @@
+"""Coin balances changed by single statements, logged to coin_ledger
+
+`apply` locks the users, changes their balances and appends one ledger
+entry per changed balance in one prepared statement, so concurrent matches and
+upgrades of the same user queue on the row lock instead of overwriting
+each other's balance read earlier in Python.
+"""
+import os
+
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from . import metrics
+from .database import session_factory
+from .models import db
+
+RETENTION = timedelta(days=int(os.getenv('BROAPI_LEDGER_RETENTION_DAYS', '90')))
+BATCH = int(os.getenv('BROAPI_LEDGER_COMPACT_BATCH', '10000'))
+
+entries_written = metrics.Counter('broapi_ledger_entries_total', 'Coin ledger entries written', ('reason',))
+
+
+class Change(NamedTuple):
+    balance: int # after the change, or as it is when the change was refused
+    delta: int # as applied; 0 when refused
+
+
+# tg_id is not unique on legacy rows: each key changes only its lowest sid, the row
+# the reads pick; users are locked in sid order, so concurrent changes cannot deadlock
+APPLY = '''
+    WITH resolved AS (
+        SELECT DISTINCT ON (deltas.key) users.sid, deltas.key, deltas.delta
+        FROM users
+        JOIN unnest(CAST(:keys AS {type}[]), CAST(:deltas AS integer[])) AS deltas (key, delta) ON users.{key} = deltas.key
+        ORDER BY deltas.key, users.sid
+    ), locked AS (
+        SELECT users.sid, resolved.key, coalesce(users.score, 0) AS score, resolved.delta
+        FROM users
+        JOIN resolved ON resolved.sid = users.sid
+        ORDER BY users.sid
+        FOR UPDATE OF users
+    ), changed AS (
+        UPDATE users SET score = {score}
+        FROM locked
+        WHERE users.sid = locked.sid {condition}
+        RETURNING users.sid, users.score, users.score - locked.score AS delta
+    ), logged AS (
+        INSERT INTO coin_ledger (user_sid, delta, balance, reason, match_id)
+        SELECT sid, delta, score, :reason, CAST(:match_id AS uuid) FROM changed
+        WHERE delta <> 0
+    )
+    SELECT locked.key, coalesce(changed.score, locked.score), coalesce(changed.delta, 0)
+    FROM locked LEFT JOIN changed ON changed.sid = locked.sid
+'''
+KEY_TYPES = {'tg_id': 'bigint', 'sid': 'uuid'}
+STATEMENTS = {
+    (key, floor): text(APPLY.format(
+        key=key,
+        type=key_type,
+        score='greatest(0, locked.score + locked.delta)' if floor else 'locked.score + locked.delta',
+        condition='' if floor else 'AND locked.score + locked.delta >= 0',
+    ))
+    for key, key_type in KEY_TYPES.items() for floor in (False, True)
+}
+
+
+async def apply(session: AsyncSession, deltas: dict, reason: db.CoinReason, match_id: UUID | None = None,
+                floor: bool = False, key: str = 'tg_id') -> dict:
+    """Adds deltas to the balances of users by key, their telegram ids or sids
+
+    Without floor a delta that would take a balance below 0 is refused as
+    a whole for that user; with floor the balance stops at 0 and the
+    entry records what was actually taken. Users that do not exist are
+    missing from the result.
+    """
+    result = await session.exec(STATEMENTS[key, floor], params={
+        'keys': list(deltas), 'deltas': list(deltas.values()), 'reason': reason.value, 'match_id': match_id,
+    })
+    changes = {user_key: Change(balance, applied) for user_key, balance, applied in result.all()}
+    entries_written.inc(sum(1 for change in changes.values() if change.delta != 0), reason=reason.value)
+    return changes
+
+
+# folds a batch of the oldest entries into the compacted entry of each user
+COMPACT = '''
+    WITH folded AS (
+        DELETE FROM coin_ledger
+        WHERE id IN (
+            SELECT id FROM coin_ledger
+            WHERE ts_created < :cutoff AND reason <> 'compacted'
+            ORDER BY id
+            LIMIT :batch
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, user_sid, delta, balance, ts_created
+    ), merged AS (
+        INSERT INTO coin_ledger (user_sid, delta, balance, reason, ts_created)
+        SELECT DISTINCT ON (user_sid) user_sid, sum(delta) OVER (PARTITION BY user_sid), balance, 'compacted', ts_created
+        FROM folded
+        ORDER BY user_sid, id DESC
+        ON CONFLICT (user_sid) WHERE reason = 'compacted' DO UPDATE
+            SET delta = coin_ledger.delta + excluded.delta, balance = excluded.balance, ts_created = excluded.ts_created
+    )
+    SELECT count(*) FROM folded
+'''
+
+
+async def compact() -> int:
+    """Folds entries older than RETENTION into one entry per user, BATCH at a time"""
+    cutoff = datetime.now(timezone.utc) - RETENTION
+    total = 0
+    while True:
+        async with session_factory() as session:
+            result = await session.exec(text(COMPACT), params={'cutoff': cutoff, 'batch': BATCH})
+            folded = result.scalar_one()
+            await session.commit()
+        total += folded
+        if folded < BATCH:
+            return total
@@ -1,45 +1,62 @@
 import os
 
-from fastapi import FastAPI, APIRouter, Request
-from starlette.responses import JSONResponse
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, APIRouter
+from starlette.responses import Response
 from starlette.middleware import Middleware
-from starlette.middleware.cors import CORSMiddleware
 
-from .routers import users, pvp
+from . import invalidation, maintenance, metrics, notifications, replicas, warmup
+from .database import engine
+from .leaderboard import leaderboards
+from .dependencies import close_bot
+from .cors import OriginMiddleware
+from .responses import ModelResponse
+from .routers import leaderboard, users, pvp
 
 origins = os.getenv('BROAPI_ALLOW_ORIGINS').split(',')
 
-middleware = [
-    Middleware(
-        CORSMiddleware,
-        allow_origins=origins,
-        allow_credentials=False,
-        allow_methods=['GET', 'POST'],
-        allow_headers=["*"],
-    )
-]
-
-app = FastAPI(middleware=middleware)
-
+# reachable without an allowed Origin
 whitelist = [
     "/favicon.ico",
     "/openapi.json",
     "/docs",
-    "/redoc"
+    "/redoc",
+    "/metrics",
 ]
 
-@app.middleware('http')
-async def fitler_orgins(request: Request, call_next):
-    if "*" in origins:
-        return await call_next(request)
+middleware = [
+    Middleware(OriginMiddleware, allow_origins=origins, allow_paths=whitelist, allow_methods=['GET', 'POST']),
+    Middleware(metrics.MetricsMiddleware),
+]
 
-    origin = request.headers.get('Origin')
-    if origin not in origins and request.url.path not in whitelist:
-        return JSONResponse({'error': 'invalid origin'}, status_code=403)
-    return await call_next(request)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # uvicorn reports the worker ready and starts accepting once this has run
+    await warmup.run()
+    await invalidation.listener.start()
+    await leaderboards.start()
+    await replicas.replicas.start()
+    await notifications.dispatcher.start()
+    await maintenance.scheduler.start()
+    yield
+    await maintenance.scheduler.stop()
+    await notifications.dispatcher.stop()
+    await leaderboards.stop()
+    await invalidation.listener.stop()
+    await replicas.replicas.stop()
+    await close_bot()
+    await engine.dispose()
+
+app = FastAPI(middleware=middleware, lifespan=lifespan, default_response_class=ModelResponse)
+
+@app.get('/metrics', include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 api = APIRouter()
 api.include_router(pvp.router)
 api.include_router(users.router)
+api.include_router(leaderboard.router)
 
 app.include_router(api, prefix='/api/v1')
\ No newline at end of file
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import os
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+from sqlalchemy import delete, func, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select
+
+from . import idempotency, ledger, metrics
+from .database import env_flag, session_factory
+from .jobs import archive_matches
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+
+ENABLED = env_flag('BROAPI_MAINTENANCE', True)
+TICK = float(os.getenv('BROAPI_MAINTENANCE_TICK', '30'))
+BATCH = int(os.getenv('BROAPI_MAINTENANCE_BATCH', '1000'))
+# start_match rejects matches idle for 30 minutes, search_match opens a new one after these are gone
+STALE_MATCH_AFTER = timedelta(hours=1)
+PARTITIONS_AHEAD = 3
+
+job_rows = metrics.Counter('broapi_maintenance_rows_total', 'Rows changed by maintenance jobs', ('job',))
+job_failures = metrics.Counter('broapi_maintenance_failures_total', 'Maintenance job runs that raised', ('job',))
+
+
+@dataclass
+class Job:
+    name: str
+    run: Callable[[], Awaitable[int]]
+    interval: timedelta | None # None: once per UTC day
+
+    def is_due(self, ts_last_run: datetime | None, ts_now: datetime) -> bool:
+        if ts_last_run is None:
+            return True
+        if self.interval is None:
+            return ts_last_run.date() < ts_now.date()
+        return ts_last_run + self.interval <= ts_now
+
+
+async def _in_batches(statement) -> int:
+    """Runs statement until it changes fewer than BATCH rows, one transaction per batch"""
+    total = 0
+    while True:
+        async with session_factory() as session:
+            result = await session.exec(statement.execution_options(synchronize_session=False))
+            await session.commit()
+        total += result.rowcount
+        if result.rowcount < BATCH:
+            return total
+
+
+async def expire_reservations() -> int:
+    # rows locked by requests are skipped, the next run gets them
+    expired = (
+        select(db.PVPCharacter.user_id)
+            .where(db.PVPCharacter.ts_invulnerable_until < func.now())
+            .limit(BATCH)
+            .with_for_update(skip_locked=True)
+    )
+    return await _in_batches(
+        update(db.PVPCharacter).where(db.PVPCharacter.user_id.in_(expired)).values(ts_invulnerable_until=None)
+    )
+
+
+async def drop_stale_matches() -> int:
+    stale = (
+        select(db.PVPMatch.uuid, db.PVPMatch.ts_created)
+            .where(db.PVPMatch.ts_finished == None, db.PVPMatch.ts_updated < func.now() - STALE_MATCH_AFTER)
+            .limit(BATCH)
+            .with_for_update(skip_locked=True)
+    )
+    return await _in_batches(
+        delete(db.PVPMatch).where(tuple_(db.PVPMatch.uuid, db.PVPMatch.ts_created).in_(stale))
+    )
+
+
+async def reset_defences() -> int:
+    defended = (
+        select(db.PVPCharacter.user_id)
+            .where(db.PVPCharacter.ts_defences_today > 0)
+            .limit(BATCH)
+            .with_for_update(skip_locked=True)
+    )
+    return await _in_batches(
+        update(db.PVPCharacter).where(db.PVPCharacter.user_id.in_(defended)).values(ts_defences_today=0)
+    )
+
+
+async def expire_idempotency_keys() -> int:
+    expired = (
+        select(db.IdempotencyKey.method, db.IdempotencyKey.path, db.IdempotencyKey.key)
+            .where(db.IdempotencyKey.ts_created < func.now() - timedelta(seconds=idempotency.TTL))
+            .limit(BATCH)
+            .with_for_update(skip_locked=True)
+    )
+    return await _in_batches(
+        delete(db.IdempotencyKey).where(
+            tuple_(db.IdempotencyKey.method, db.IdempotencyKey.path, db.IdempotencyKey.key).in_(expired)
+        )
+    )
+
+
+async def create_partitions() -> int:
+    await archive_matches.create_partitions(PARTITIONS_AHEAD)
+    return 0
+
+
+JOBS = [
+    Job('expire_reservations', expire_reservations, timedelta(minutes=1)),
+    Job('drop_stale_matches', drop_stale_matches, timedelta(minutes=10)),
+    Job('expire_idempotency_keys', expire_idempotency_keys, timedelta(minutes=10)),
+    Job('reset_defences', reset_defences, None),
+    Job('create_partitions', create_partitions, None),
+    Job('compact_ledger', ledger.compact, None),
+]
+
+
+class Scheduler:
+    """Runs the maintenance jobs from every worker, each job on one at a time
+
+    Every tick each due job is tried under a row lock on its pvp.maintenance
+    row; workers that find the row locked skip the job, and the run time
+    stored in the row keeps the cadence across workers and restarts.
+    """
+
+    def __init__(self, jobs: list[Job]):
+        self.jobs = jobs
+        self._worker: asyncio.Task | None = None
+
+    async def start(self):
+        if not ENABLED:
+            return
+        async with session_factory() as session:
+            await session.exec(
+                insert(db.PVPMaintenance)
+                    .values([{'job': job.name} for job in self.jobs])
+                    .on_conflict_do_nothing()
+            )
+            await session.commit()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+
+    async def run_job(self, job: Job) -> bool:
+        """Runs job if it is due and no other worker is running it"""
+        async with session_factory() as session:
+            row = await session.exec(
+                select(db.PVPMaintenance)
+                    .where(db.PVPMaintenance.job == job.name)
+                    .with_for_update(skip_locked=True)
+            )
+            entry = row.one_or_none()
+            ts_now = datetime.now(timezone.utc)
+            if entry is None or not job.is_due(entry.ts_last_run, ts_now):
+                return False
+
+            rows = await job.run()
+            job_rows.inc(rows, job=job.name)
+            entry.ts_last_run = ts_now
+            session.add(entry)
+            await session.commit()
+
+        logger.info("maintenance job %s changed %d rows", job.name, rows)
+        return True
+
+    async def _run(self):
+        while True:
+            for job in self.jobs:
+                try:
+                    await self.run_job(job)
+                except Exception:
+                    job_failures.inc(job=job.name)
+                    logger.exception("maintenance job %s failed", job.name)
+            await asyncio.sleep(TICK)
+
+
+scheduler = Scheduler(JOBS)
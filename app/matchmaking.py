@@ -0,0 +1,166 @@
+import asyncio
+import heapq
+import os
+import random
+import time
+
+from datetime import datetime, timedelta, timezone
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel import select
+
+from .models import db
+
+
+REFRESH_INTERVAL = float(os.getenv('BROAPI_POOL_REFRESH_SECONDS', '5'))
+# rows committed by other workers may carry ts_updated slightly behind our watermark
+REFRESH_OVERLAP = timedelta(seconds=30)
+
+
+class _Bucket:
+    """Characters of a single level with O(1) add, discard and random pick"""
+
+    def __init__(self):
+        self.ids: list[int] = []
+        self.positions: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, user_id: int):
+        if user_id in self.positions:
+            return
+        self.positions[user_id] = len(self.ids)
+        self.ids.append(user_id)
+
+    def discard(self, user_id: int):
+        position = self.positions.pop(user_id, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if last != user_id:
+            self.ids[position] = last
+            self.positions[last] = position
+
+
+class OpponentPool:
+    """In-memory matchmaking index over pvp.characters
+
+    Available characters are kept in per-level buckets, reserved ones wait
+    in a heap ordered by ts_invulnerable_until and return to their bucket
+    once it passes. The index is refreshed incrementally by ts_updated.
+    """
+
+    def __init__(self):
+        self._levels: dict[int, int] = {}
+        self._buckets: dict[int, _Bucket] = {}
+        self._invulnerable_until: dict[int, datetime] = {}
+        self._expiry: list[tuple[datetime, int]] = []
+
+        self._watermark: datetime | None = None
+        self._ts_refreshed = 0.0
+        # set while a refresh is reading
+        self._refreshing: asyncio.Future | None = None
+
+    def __len__(self) -> int:
+        return len(self._levels)
+
+    def upsert(self, user_id: int, level: int, ts_invulnerable_until: datetime | None = None):
+        previous_level = self._levels.get(user_id)
+        if previous_level is not None and previous_level != level:
+            self._discard(previous_level, user_id)
+        self._levels[user_id] = level
+
+        if ts_invulnerable_until is not None and ts_invulnerable_until > datetime.now(timezone.utc):
+            self.reserve(user_id, ts_invulnerable_until)
+        else:
+            self.release(user_id)
+
+    def reserve(self, user_id: int, ts_invulnerable_until: datetime):
+        level = self._levels.get(user_id)
+        if level is None:
+            return
+        self._discard(level, user_id)
+        if self._invulnerable_until.get(user_id) == ts_invulnerable_until:
+            return
+        self._invulnerable_until[user_id] = ts_invulnerable_until
+        heapq.heappush(self._expiry, (ts_invulnerable_until, user_id))
+
+    def release(self, user_id: int):
+        level = self._levels.get(user_id)
+        if level is None:
+            return
+        self._invulnerable_until.pop(user_id, None)
+        self._buckets.setdefault(level, _Bucket()).add(user_id)
+
+    def sample(self, player_id: int, min_level: int, max_level: int, k: int = 1) -> list[int]:
+        """Up to `k` distinct random available characters within the level range"""
+        self._expire(datetime.now(timezone.utc))
+
+        buckets = [self._buckets[level] for level in range(min_level, max_level + 1) if self._buckets.get(level)]
+        total = sum(len(bucket) for bucket in buckets)
+
+        picked: set[int] = set()
+        # bounded number of draws; duplicates and the player itself are just skipped
+        for _ in range(min(total, k * 2 + 2)):
+            index = random.randrange(total)
+            for bucket in buckets:
+                if index < len(bucket):
+                    user_id = bucket.ids[index]
+                    break
+                index -= len(bucket)
+            if user_id != player_id:
+                picked.add(user_id)
+            if len(picked) >= k:
+                break
+        return list(picked)
+
+    async def refresh(self, session: AsyncSession, force: bool = False):
+        # concurrent callers wait for the refresh in flight instead of starting another one;
+        # at startup every miss would otherwise read all characters again
+        refreshing = self._refreshing
+        if refreshing is not None:
+            await asyncio.shield(refreshing)
+            return
+        if not force and time.monotonic() - self._ts_refreshed < REFRESH_INTERVAL:
+            return
+        self._ts_refreshed = time.monotonic()
+
+        refreshing = self._refreshing = asyncio.get_running_loop().create_future()
+        try:
+            await self._load(session)
+        finally:
+            refreshing.set_result(None)
+            if self._refreshing is refreshing:
+                self._refreshing = None
+
+    async def _load(self, session: AsyncSession):
+        statement = select(
+            db.PVPCharacter.user_id,
+            db.PVPCharacter.level,
+            db.PVPCharacter.ts_invulnerable_until,
+            db.PVPCharacter.ts_updated,
+        )
+        if self._watermark is not None:
+            statement = statement.where(db.PVPCharacter.ts_updated > self._watermark - REFRESH_OVERLAP)
+
+        rows = await session.exec(statement)
+        for user_id, level, ts_invulnerable_until, ts_updated in rows:
+            self.upsert(user_id, level, ts_invulnerable_until)
+            if self._watermark is None or ts_updated > self._watermark:
+                self._watermark = ts_updated
+
+    def _discard(self, level: int, user_id: int):
+        bucket = self._buckets.get(level)
+        if bucket is not None:
+            bucket.discard(user_id)
+
+    def _expire(self, ts_now: datetime):
+        while self._expiry and self._expiry[0][0] <= ts_now:
+            ts_invulnerable_until, user_id = heapq.heappop(self._expiry)
+            # stale heap entries are left behind when a reservation is extended or released
+            if self._invulnerable_until.get(user_id) == ts_invulnerable_until:
+                self.release(user_id)
+
+
+pool = OpponentPool()
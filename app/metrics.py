@@ -0,0 +1,243 @@
+"""Prometheus metrics in the text exposition format
+
+A small in-process registry, scraped from GET /metrics. Values are per
+worker process; Prometheus sums them across targets.
+"""
+import contextvars
+import math
+import time
+
+from typing import Callable, Iterable
+
+from sqlalchemy import event, exc
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+API_PREFIX = '/api/v1'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 32)
+
+_registry: list['_Metric'] = []
+# statements executed by the request running in the current context
+_queries: contextvars.ContextVar[list[int] | None] = contextvars.ContextVar('queries', default=None)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = (*sorted(buckets), math.inf)
+        # per label set: counts per bucket (not cumulative), sum
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = ([0] * len(self.buckets), [0.0])
+        counts, total = entry
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        total[0] += value
+
+    def samples(self) -> Iterable[str]:
+        names = (*self.labelnames, 'le')
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_format_labels(names, (*key, _format_value(bound)))} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(total[0])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Callback(_Metric):
+    """Value read at scrape time, e.g. a queue size or a counter kept elsewhere
+
+    Unlabelled callbacks take their read here; labelled ones get one read
+    per label set from `track`.
+    """
+
+    def __init__(self, name: str, documentation: str, kind: str, read: Callable[[], float] | None = None,
+                 labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self._reads: dict[tuple[str, ...], Callable[[], float]] = {}
+        if read is not None:
+            self._reads[()] = read
+
+    def track(self, read: Callable[[], float], **labels: str):
+        self._reads[self._key(labels)] = read
+
+    def samples(self) -> Iterable[str]:
+        for key, read in self._reads.items():
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(read())}'
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+http_requests = Counter(
+    'broapi_http_requests_total', 'API requests by route and status', ('method', 'route', 'status'),
+)
+http_duration = Histogram(
+    'broapi_http_request_duration_seconds', 'API request latency by route', ('method', 'route'),
+)
+http_queries = Histogram(
+    'broapi_http_request_queries', 'SQL statements executed per API request', ('method', 'route'), QUERY_BUCKETS,
+)
+
+# labelled by database: primary, or replica_<n> for the read replicas
+db_pool_checkouts = Counter('broapi_db_pool_checkouts_total', 'Connections checked out of the pool', ('database',))
+db_pool_timeouts = Counter('broapi_db_pool_timeouts_total', 'Checkouts that gave up after pool_timeout', ('database',))
+db_pool_wait = Histogram(
+    'broapi_db_pool_wait_seconds', 'Time to get a connection from the pool, including opening a new one',
+    ('database',), POOL_WAIT_BUCKETS,
+)
+db_pool_size = Callback('broapi_db_pool_size', 'Configured pool size', 'gauge', labelnames=('database',))
+db_pool_checked_out = Callback('broapi_db_pool_checked_out', 'Connections currently checked out', 'gauge', labelnames=('database',))
+db_pool_overflow = Callback('broapi_db_pool_overflow', 'Connections open beyond pool_size', 'gauge', labelnames=('database',))
+
+matchmaking_searches = Counter(
+    'broapi_matchmaking_searches_total', 'Opponent searches by outcome', ('outcome',),
+)
+matchmaking_misses = Counter(
+    'broapi_matchmaking_misses_total',
+    'Search attempts that claimed nobody; empty: no candidates in the pool, contended: all candidates taken',
+    ('reason',),
+)
+
+
+class TimedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long checkouts wait"""
+
+    database = 'primary'
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            db_pool_timeouts.inc(database=self.database)
+            raise
+        finally:
+            db_pool_wait.observe(time.perf_counter() - started, database=self.database)
+
+
+def timed_pool(database: str) -> type[TimedPool]:
+    # dispose() recreates the pool from its class, so the label lives on a subclass
+    return type(f'TimedPool_{database}', (TimedPool,), {'database': database})
+
+
+def instrument_engine(engine: AsyncEngine, database: str):
+    # dispose() replaces the pool, so look it up on every scrape
+    sync_engine = engine.sync_engine
+    db_pool_size.track(lambda: sync_engine.pool.size(), database=database)
+    db_pool_checked_out.track(lambda: sync_engine.pool.checkedout(), database=database)
+    # overflow() is negative until the pool has opened pool_size connections
+    db_pool_overflow.track(lambda: max(sync_engine.pool.overflow(), 0), database=database)
+
+    @event.listens_for(sync_engine, 'checkout')
+    def count_checkout(dbapi_connection, connection_record, connection_proxy):
+        db_pool_checkouts.inc(database=database)
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        queries = _queries.get()
+        if queries is not None:
+            queries[0] += 1
+
+
+class MetricsMiddleware:
+    """Times API requests and counts their SQL statements, labelled by route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(API_PREFIX):
+            return await self.app(scope, receive, send)
+
+        status = 500
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        queries = [0]
+        token = _queries.set(queries)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _queries.reset(token)
+
+            # set by the router once matched; unmatched paths share one series
+            route = scope.get('route')
+            template = getattr(route, 'path', '<unmatched>')
+            http_requests.inc(method=scope['method'], route=template, status=str(status))
+            http_duration.observe(elapsed, method=scope['method'], route=template)
+            http_queries.observe(queries[0], method=scope['method'], route=template)
@@ -4,7 +4,7 @@ from datetime import datetime, timezone, timedelta
 import enum
 
 from sqlmodel import SQLModel, Field, MetaData, Enum
-from sqlalchemy import JSON, Column, DateTime, BigInteger, func
+from sqlalchemy import JSON, Column, DateTime, BigInteger, Index, LargeBinary, String, UniqueConstraint, func, text
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.dialects.postgresql import JSONB
 
@@ -20,6 +20,7 @@ class User(SQLModel, table=True):
     )
     username: str
     ref_code: str | None
+    tg_id: int | None = Field(default=None, sa_column=Column(BigInteger(), index=True, nullable=True))
     refs: dict = Field(default_factory=dict, sa_column=Column(JSON))
     score: int | None
     last_score: int | None
@@ -41,6 +42,63 @@ class ReferalScore(SQLModel, table=True):
     username: str = Field(primary_key=True)
     score: int
 
+class Referral(SQLModel, table=True):
+    __tablename__ = "referrals"
+    __table_args__ = (UniqueConstraint('referrer_sid', 'ref_code'), Index('referrals_referrer_idx', 'referrer_sid', 'id'))
+
+    # insertion order; legacy users.refs entries keep their array order
+    id: int | None = Field(default=None, sa_column=Column(BigInteger(), primary_key=True, autoincrement=True))
+    referrer_sid: UUID = Field(foreign_key="users.sid", nullable=False)
+    ref_code: str # the referred user's ref_code
+    premium: bool | None # unknown for legacy entries
+    ts_created: datetime | None = Field(sa_column=Column(DateTime(timezone=True), nullable=True))
+
+class ReferralCount(SQLModel, table=True):
+    __tablename__ = "referral_counts"
+
+    referrer_sid: UUID = Field(foreign_key="users.sid", primary_key=True)
+    total: int = Field(default=0)
+    premium: int = Field(default=0)
+
+class IdempotencyKey(SQLModel, table=True):
+    __tablename__ = "idempotency_keys"
+
+    # claimed in the transaction of the request (app.idempotency); the response is stored once it succeeded
+    method: str = Field(primary_key=True)
+    path: str = Field(primary_key=True)
+    key: str = Field(primary_key=True)
+    fingerprint: str
+    status_code: int | None = None
+    body: bytes | None = Field(default=None, sa_column=Column(LargeBinary(), nullable=True))
+    media_type: str | None = None
+    ts_created: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False, index=True))
+
+class CoinReason(str, enum.Enum):
+    levelup = "levelup"
+    skip = "skip"
+    match = "match"
+    referral = "referral"
+    grant = "grant" # app.jobs.bulk coins
+    # the sum of the entries folded by app.ledger.compact
+    compacted = "compacted"
+
+class CoinLedger(SQLModel, table=True):
+    __tablename__ = "coin_ledger"
+    __table_args__ = (
+        Index('coin_ledger_user_idx', 'user_sid', 'id'),
+        Index('coin_ledger_ts_created_idx', 'ts_created'),
+        Index('coin_ledger_compacted_idx', 'user_sid', unique=True, postgresql_where=text("reason = 'compacted'")),
+    )
+
+    # append-only, written by app.ledger in the statement that changes users.score
+    id: int | None = Field(default=None, sa_column=Column(BigInteger(), primary_key=True, autoincrement=True))
+    user_sid: UUID = Field(foreign_key="users.sid", nullable=False)
+    delta: int # as applied, after the floor at 0
+    balance: int # users.score after the change
+    reason: str = Field(sa_column=Column(String(), nullable=False))
+    match_id: UUID | None = None
+    ts_created: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False, server_default=func.now()))
+
 class PVPCharacter(SQLModel, table=True):
     __tablename__ = "characters"
 
@@ -65,6 +123,11 @@ class PVPCharacter(SQLModel, table=True):
 
     ts_invulnerable_until: datetime | None = Field(sa_column=Column(DateTime(timezone=True), nullable=True))
     ts_defences_today: int 
+
+    # pvp stats, maintained by start_match
+    stats_total: int = Field(default=0)
+    stats_won: int = Field(default=0)
+    stats_loot: int = Field(default=0, sa_column=Column(BigInteger(), nullable=False, server_default='0'))
     
 class MatchResult(str, enum.Enum):
     win = 'win'
@@ -76,7 +139,8 @@ class PVPMatch(SQLModel, table=True):
     metadata = MetaData(schema="pvp")
 
     uuid: UUID = Field(default_factory=uuid4, primary_key=True, index=True, nullable=False)
-    ts_created: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
+    # partition key of the monthly partitions, see migrations/0005
+    ts_created: datetime = Field(sa_column=Column(DateTime(timezone=True), primary_key=True, nullable=False))
     ts_updated: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
 
     player_id: int = Field(sa_column=Column(BigInteger()))
@@ -87,3 +151,34 @@ class PVPMatch(SQLModel, table=True):
     loot: dict = Field(sa_type=JSONB, nullable=True)
 
     stats: dict = Field(sa_type=JSONB, nullable=True)
+
+class PVPMatchArchive(SQLModel, table=True):
+    __tablename__ = 'matches_archive'
+
+    metadata = MetaData(schema="pvp")
+
+    # matches played as the attacker in partitions detached by app.jobs.archive_matches
+    player_id: int = Field(sa_column=Column(BigInteger(), primary_key=True))
+    matches: int
+    ts_last_finished: datetime | None = Field(sa_column=Column(DateTime(timezone=True), nullable=True))
+
+class PVPNotification(SQLModel, table=True):
+    __tablename__ = 'notifications'
+
+    metadata = MetaData(schema="pvp")
+
+    id: int | None = Field(default=None, sa_column=Column(BigInteger(), primary_key=True, autoincrement=True))
+    chat_id: int = Field(sa_column=Column(BigInteger(), nullable=False))
+    payload: dict = Field(sa_type=JSONB, nullable=False)
+
+    ts_created: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
+    ts_claimed: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
+
+class PVPMaintenance(SQLModel, table=True):
+    __tablename__ = 'maintenance'
+
+    metadata = MetaData(schema="pvp")
+
+    # one row per app.maintenance job, locked while the job runs
+    job: str = Field(primary_key=True)
+    ts_last_run: datetime | None = Field(sa_column=Column(DateTime(timezone=True), nullable=True))
@@ -4,6 +4,7 @@ from enum import Enum
 
 import math
 
+from bisect import bisect_right
 from typing import Optional
 from pydantic import BaseModel, Field
 
@@ -29,6 +30,24 @@ class CreateUser(BaseModel):
     ref_code: Optional[str] = None
     premium: Optional[bool] = None
 
+def telegram_id(user_id: str) -> int | None:
+    """The telegram id a user_id stands for, by the rule of the users_set_tg_id trigger"""
+    if user_id.isascii() and user_id.isdigit() and len(user_id) <= 18:
+        return int(user_id)
+    return None
+
+
+class Referral(BaseModel):
+    user_id: str
+    premium: Optional[bool] = Field(None)
+
+class Referrals(BaseModel):
+    total: int
+    premium: int
+    referrals: list[Referral]
+    # pass as `before` for the next page; None on the last one
+    before: Optional[int] = Field(None)
+
 
 class GetEnergy(BaseModel):
     energy: int
@@ -52,12 +71,50 @@ _coeffecients = {
 
 exp_table = [2, 12, 37, 77, 137, 222, 332, 482, 707, 1057, 1612]
 
+# (power gap treshold, alpha) for the match win probability, see routers.pvp._calculate_match_result
+alpha_table = [
+        (1.50, None),  # auto-win
+        (0.51, 1.746),
+        (0.49, 1.800),
+        (0.44, 1.970),
+        (0.39, 2.170),
+        (0.34, 2.400),
+        (0.29, 2.500),
+        (0.24, 2.800),
+        (0.19, 3.000),
+        (0.14, 3.500),
+        (0.09, 4.000),
+        (0.06, 4.000),
+        (0.03, 4.000),
+        (0.01, 5.000),
+    ]
+
+# a single levelup may raise an ability by at most this much; keeps the cost tables bounded
+MAX_LEVELUP_DELTA = 1000
+# abilities start here and are never lowered
+MIN_ABILITY_LEVEL = 1
+
+# every per-level cost is a float of at least 1 (or 0 for level 0), so it is a
+# whole multiple of 2 ** -52 and the tables can sum them exactly as integers
+_COST_SCALE = 52
+
+# _cost_tables[ability][level] is the total cost of levels [0, level) scaled by
+# 2 ** _COST_SCALE, so upgrading from a to b costs table[b] - table[a] rounded
+# up; exact, so a cost does not depend on the level it starts from
+_cost_tables: dict[str, list[int]] = {ability_name: [0] for ability_name in _coeffecients}
+
+def _cost_table(ability_name: str, level: int) -> list[int]:
+    table, coeff = _cost_tables[ability_name], _coeffecients[ability_name]
+    while len(table) <= level:
+        table.append(table[-1] + int(math.ldexp(math.pow(len(table) - 1, coeff), _COST_SCALE)))
+    return table
+
 class AbilityScoresDelta(BaseModel):
-    strength: int | None = None
-    defence: int | None = None
-    speed: int | None = None
-    weight: int | None = None
-    combinations: int | None = None
+    strength: int | None = Field(None, ge=0, le=MAX_LEVELUP_DELTA)
+    defence: int | None = Field(None, ge=0, le=MAX_LEVELUP_DELTA)
+    speed: int | None = Field(None, ge=0, le=MAX_LEVELUP_DELTA)
+    weight: int | None = Field(None, ge=0, le=MAX_LEVELUP_DELTA)
+    combinations: int | None = Field(None, ge=0, le=MAX_LEVELUP_DELTA)
 
 class AbilityScores(BaseModel):
     strength: int
@@ -92,6 +149,9 @@ class AbilityScores(BaseModel):
         return cost
     
     def upgrade(self, delta: AbilityScoresDelta):
+        for ability_name, ability_delta in delta:
+            if ability_delta is not None:
+                self._check_levels(ability_name, getattr(self, ability_name) + ability_delta)
         if delta.strength:
             self.strength += delta.strength
         if delta.defence:
@@ -103,16 +163,46 @@ class AbilityScores(BaseModel):
         if delta.combinations:
             self.combinations += delta.combinations
 
+    def max_upgrade(self, coins: int) -> AbilityScoresDelta:
+        """Largest delta per ability affordable with `coins`, each ability on its own"""
+        delta = {}
+        for ability_name in _coeffecients:
+            level_current = getattr(self, ability_name)
+            self._check_levels(ability_name, level_current)
+            level_limit = level_current + MAX_LEVELUP_DELTA
+            table = _cost_table(ability_name, level_current)
+            budget = table[level_current] + (max(coins, 0) << _COST_SCALE)
+            # grow the table just past the budget, the costs only increase
+            while table[-1] <= budget and len(table) <= level_limit:
+                table = _cost_table(ability_name, len(table))
+            level_target = max(min(bisect_right(table, budget) - 1, level_limit), level_current)
+            delta[ability_name] = level_target - level_current
+        return AbilityScoresDelta(**delta)
+
     def _ability_cost(self, ability_name: str, level_target: int) -> int:
-        level_current, cost = getattr(self, ability_name), 0
-        for level in range(level_current, level_target):
-            cost += math.pow(level, _coeffecients[ability_name])
-        return math.ceil(cost)
+        level_current = getattr(self, ability_name)
+        self._check_levels(ability_name, level_target)
+        if level_target == level_current:
+            return 0
+        table = _cost_table(ability_name, level_target)
+        return -((table[level_current] - table[level_target]) >> _COST_SCALE)
+
+    def _check_levels(self, ability_name: str, level_target: int):
+        # a level below the table start would index it from its end and price the upgrade negative
+        level_current = getattr(self, ability_name)
+        if level_current < MIN_ABILITY_LEVEL or level_target < level_current:
+            raise ValueError(f"{ability_name} cannot go from level {level_current} to {level_target}")
     
 class LevelupResponse(BaseModel):
     abilities: AbilityScores
     power: int
 
+class MaxLevelupResponse(BaseModel):
+    coins: int
+    delta: AbilityScoresDelta
+    abilities: AbilityScores
+    costs: AbilityScores
+
 class CharacterEnergy(BaseModel):
     remaining: int
     maximum: int
@@ -136,6 +226,17 @@ class CharacterProfile(BaseModel):
     premium: Optional[CharacterProfilePremium] = Field(None)
     stats: Optional[PVPStats] = Field(None)
 
+MAX_CHARACTERS_BATCH = 500
+
+class CharactersBatchRequest(BaseModel):
+    user_ids: list[int] = Field(min_length=1, max_length=MAX_CHARACTERS_BATCH)
+    # include pvp stats of every character, not only for premium ones
+    stats: bool = False
+
+class CharactersBatchResponse(BaseModel):
+    characters: dict[int, CharacterProfile]
+    not_found: list[int]
+
 class MatchCompetitioner(BaseModel):
     user_id: int
     username: str
@@ -161,3 +262,18 @@ class PVPMatchResult(BaseModel):
     result: MatchResult
     loot: Optional[MatchLoot] = Field(None)
 
+
+class LeaderboardKind(str, Enum):
+    coins = "coins"
+    power = "power"
+
+class LeaderboardEntry(BaseModel):
+    rank: int
+    user_id: int
+    username: Optional[str] = Field(None)
+    value: int
+
+class Leaderboard(BaseModel):
+    board: LeaderboardKind
+    total: int
+    entries: list[LeaderboardEntry]
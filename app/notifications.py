@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import os
+
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel import select
+
+from . import metrics
+from .database import env_flag, session_factory
+from .dependencies import bro_button, get_bot
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+
+QUEUE_SIZE = int(os.getenv('BROAPI_NOTIFICATIONS_QUEUE_SIZE', '10000'))
+# defences reported to the same chat within the window are sent as one digest;
+# it also keeps every chat well under telegram's one message per second
+COALESCE_WINDOW = float(os.getenv('BROAPI_NOTIFICATIONS_WINDOW', '60'))
+GLOBAL_RATE = float(os.getenv('BROAPI_NOTIFICATIONS_RATE', '25')) # messages per second, telegram allows ~30
+RETRIES = int(os.getenv('BROAPI_NOTIFICATIONS_RETRIES', '5'))
+BACKOFF_BASE, BACKOFF_MAX = 1.0, 60.0
+
+OUTBOX_ENABLED = env_flag('BROAPI_NOTIFICATIONS_OUTBOX', False)
+# outbox rows claimed by a worker that died are picked up again after this long
+OUTBOX_CLAIM_TIMEOUT = timedelta(minutes=10)
+OUTBOX_RECOVERY_INTERVAL = 60.0
+OUTBOX_RECOVERY_BATCH = 500
+
+
+@dataclass
+class DefenceReport:
+    chat_id: int
+    attacker: str
+    attacker_power: int
+    winner: str
+    defended: bool
+    score_delta: int
+    score: int
+    energy: int
+    outbox_id: int | None = None
+
+
+def render(reports: list[DefenceReport]) -> str:
+    if len(reports) == 1:
+        return _render_single(reports[0])
+
+    last = reports[-1]
+    defended = sum(1 for report in reports if report.defended)
+    attackers = list(dict.fromkeys(f'@{report.attacker}' for report in reports))
+    if len(attackers) > 3:
+        attackers = attackers[:3] + [f'{len(attackers) - 3} more']
+
+    return f'''⚔️ You were attacked {len(reports)} times by {', '.join(attackers)}! ⚔️
+🛡 Defended: {defended}, lost: {len(reports) - defended}
+📃 Result: {sum(report.score_delta for report in reports):+d} $BRO 🪙
+
+Your $BRO balance: {last.score} $BRO 🪙
+Energy remaining: {last.energy} ⚡️
+
+Level up your stats to win more battles!
+
+'''
+
+
+def _render_single(report: DefenceReport) -> str:
+    if not report.defended:
+        return f'''⚔️ @{report.attacker} with {report.attacker_power} battle power attacked you! ⚔️
+🏆 Winner: @{report.winner}
+📃 Result: You lost {report.score_delta} $BRO 🪙
+
+Your $BRO balance: {report.score} $BRO 🪙
+Energy remaining: {report.energy} ⚡️
+
+Level up your stats to win more battles!
+
+'''
+    return f'''⚔️ @{report.attacker} with {report.attacker_power} battle power attacked you! ⚔️
+🏆 Winner: @{report.winner}
+📃 Result: You won {report.score_delta} $BRO 🪙, +1 EXP
+
+Your $BRO balance: {report.score} $BRO 🪙
+Energy remaining: {report.energy} ⚡️
+
+Level up your stats to win more battles!
+
+'''
+
+
+class _RateLimiter:
+    """Spaces acquisitions at least 1/rate seconds apart, in arrival order"""
+
+    def __init__(self, rate: float):
+        self._interval = 1.0 / rate
+        self._next = 0.0
+
+    async def acquire(self):
+        now = asyncio.get_running_loop().time()
+        delay = self._next - now
+        self._next = max(now, self._next) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        now = asyncio.get_running_loop().time()
+        self._next = max(self._next, now + seconds)
+
+
+class NotificationDispatcher:
+    """Delivers defence reports to telegram off the request path
+
+    Reports go through a bounded queue. The first report for a chat is sent
+    right away, later ones within COALESCE_WINDOW are merged into a digest.
+    All sends share one global rate limiter and are retried with backoff.
+    With BROAPI_NOTIFICATIONS_OUTBOX reports are also stored in
+    pvp.notifications within the match transaction and deleted once
+    delivered, so they survive restarts.
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue[DefenceReport] = asyncio.Queue(QUEUE_SIZE)
+        self._limiter = _RateLimiter(GLOBAL_RATE)
+        self._pending: dict[int, list[DefenceReport]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._worker: asyncio.Task | None = None
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def stage(self, session: AsyncSession, report: DefenceReport) -> db.PVPNotification | None:
+        if not OUTBOX_ENABLED:
+            return None
+
+        payload = asdict(report)
+        del payload['chat_id'], payload['outbox_id']
+        entry = db.PVPNotification(
+            chat_id=report.chat_id,
+            payload=payload,
+            ts_created=datetime.now(timezone.utc),
+            ts_claimed=datetime.now(timezone.utc),
+        )
+        session.add(entry)
+        return entry
+
+    def submit(self, report: DefenceReport, entry: db.PVPNotification | None = None) -> bool:
+        if entry is not None:
+            report.outbox_id = entry.id
+        try:
+            self._queue.put_nowait(report)
+            return True
+        except asyncio.QueueFull:
+            # with the outbox enabled the report is retried by recovery
+            self.dropped += 1
+            logger.warning("notification queue is full; dropping report for %s", report.chat_id)
+            return False
+
+    async def start(self):
+        self._worker = asyncio.create_task(self._run())
+        if OUTBOX_ENABLED:
+            self._spawn(self._recover())
+
+    async def stop(self, timeout: float = 5.0):
+        leftovers = {chat_id: reports for chat_id, reports in self._pending.items() if reports}
+        tasks = [task for task in (self._worker, *self._tasks) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker = None
+
+        # whatever is still queued or waiting out a coalescing window gets one last chance
+        while not self._queue.empty():
+            report = self._queue.get_nowait()
+            leftovers.setdefault(report.chat_id, []).append(report)
+        if leftovers:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(self._deliver(chat_id, reports) for chat_id, reports in leftovers.items())),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                logger.warning("notifications for %d chats were not delivered before shutdown", len(leftovers))
+
+    async def _run(self):
+        while True:
+            report = await self._queue.get()
+            pending = self._pending.get(report.chat_id)
+            if pending is not None:
+                pending.append(report)
+                continue
+
+            self._pending[report.chat_id] = []
+            self._spawn(self._chat_sender(report.chat_id, [report]))
+
+    async def _chat_sender(self, chat_id: int, reports: list[DefenceReport]):
+        try:
+            while reports:
+                await self._deliver(chat_id, reports)
+                await asyncio.sleep(COALESCE_WINDOW)
+                reports, self._pending[chat_id] = self._pending[chat_id], []
+        finally:
+            self._pending.pop(chat_id, None)
+
+    async def _deliver(self, chat_id: int, reports: list[DefenceReport]):
+        bot = get_bot()
+        if bot is None:
+            print("skip notification; bot disabled")
+            await self._acknowledge(reports)
+            return
+        from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+        text = render(reports)
+        for attempt in range(RETRIES):
+            await self._limiter.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, reply_markup=bro_button())
+                self.sent += 1
+                break
+            except TelegramRetryAfter as e:
+                self._limiter.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # blocked the bot or never started it; retrying will not help
+                logger.info("notification to %s rejected: %s", chat_id, e)
+                self.failed += 1
+                break
+            except Exception:
+                logger.exception("notification to %s failed; attempt %d", chat_id, attempt + 1)
+                await asyncio.sleep(min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        else:
+            self.failed += 1
+            return # outbox rows stay for recovery
+
+        await self._acknowledge(reports)
+
+    async def _acknowledge(self, reports: list[DefenceReport]):
+        ids = [report.outbox_id for report in reports if report.outbox_id is not None]
+        if not ids:
+            return
+        async with session_factory() as session:
+            await session.exec(delete(db.PVPNotification).where(db.PVPNotification.id.in_(ids)))
+            await session.commit()
+
+    async def _recover(self):
+        report_fields = {field.name for field in fields(DefenceReport)}
+        while True:
+            try:
+                ts_now = datetime.now(timezone.utc)
+                async with session_factory() as session:
+                    stale = (
+                        select(db.PVPNotification.id)
+                            .where(db.PVPNotification.ts_claimed < ts_now - OUTBOX_CLAIM_TIMEOUT)
+                            .order_by(db.PVPNotification.id)
+                            .limit(OUTBOX_RECOVERY_BATCH)
+                            .with_for_update(skip_locked=True)
+                    )
+                    claimed = await session.exec(
+                        update(db.PVPNotification)
+                            .where(db.PVPNotification.id.in_(stale))
+                            .values(ts_claimed=ts_now)
+                            .returning(db.PVPNotification.id, db.PVPNotification.chat_id, db.PVPNotification.payload)
+                            .execution_options(synchronize_session=False)
+                    )
+                    rows = claimed.all()
+                    await session.commit()
+
+                for outbox_id, chat_id, payload in rows:
+                    payload = {key: value for key, value in payload.items() if key in report_fields}
+                    self.submit(DefenceReport(chat_id=chat_id, outbox_id=outbox_id, **payload))
+            except Exception:
+                logger.exception("notification outbox recovery failed")
+
+            await asyncio.sleep(OUTBOX_RECOVERY_INTERVAL)
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+dispatcher = NotificationDispatcher()
+
+metrics.Callback('broapi_notifications_queue_depth', 'Defence reports waiting in the queue', 'gauge', lambda: dispatcher.depth)
+metrics.Callback('broapi_notifications_sent_total', 'Notification messages delivered', 'counter', lambda: dispatcher.sent)
+metrics.Callback('broapi_notifications_failed_total', 'Notification messages given up on', 'counter', lambda: dispatcher.failed)
+metrics.Callback('broapi_notifications_dropped_total', 'Defence reports dropped on a full queue', 'counter', lambda: dispatcher.dropped)
@@ -0,0 +1,138 @@
+"""Routing of read-only endpoints to streaming replicas
+
+Reads go to a replica whose replay lag was last measured within MAX_LAG
+and to the primary when none is, or when the user they are about was
+written in the last STICKY_SECONDS. Writes publish a 'written' event on
+the invalidation bus, so the window holds on every worker; keeping it
+well above MAX_LAG means a replica that serves a user has replayed the
+last commit about them, and the profile cache only ever sees fresh rows.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+
+from fastapi import Request
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from . import metrics
+from .cache import TTLCache
+from .database import replica_engines, replica_session_factories, session_factory
+
+logger = logging.getLogger(__name__)
+
+MAX_LAG = float(os.getenv('BROAPI_DB_REPLICA_MAX_LAG', '1'))
+STICKY_SECONDS = float(os.getenv('BROAPI_DB_REPLICA_STICKY_SECONDS', '5'))
+CHECK_INTERVAL = float(os.getenv('BROAPI_DB_REPLICA_CHECK_SECONDS', '1'))
+
+# 0 while the replica has replayed all it received; an idle primary leaves
+# the last replay timestamp behind without any lag. A promoted replica is
+# no longer in recovery and never lags.
+LAG = text('''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+''')
+
+reads = metrics.Counter('broapi_db_reads_total', 'Read-only requests by the database they were routed to', ('target',))
+lag_checks_failed = metrics.Counter('broapi_db_replica_lag_check_failures_total', 'Replica lag checks that raised or timed out', ('replica',))
+lag_seconds = metrics.Callback('broapi_db_replica_lag_seconds', 'Replay lag by replica, -1 when unknown', 'gauge', labelnames=('replica',))
+
+
+class Replica:
+    def __init__(self, index: int, engine: AsyncEngine, factory):
+        self.name = str(index)
+        self.engine = engine
+        self.factory = factory
+        self.lag: float | None = None
+        self.ts_checked = 0.0
+
+    def usable(self) -> bool:
+        # a monitor that stopped checking must not keep a replica in use
+        fresh = time.monotonic() - self.ts_checked < 3 * CHECK_INTERVAL
+        return fresh and self.lag is not None and self.lag <= MAX_LAG
+
+    async def _measure(self):
+        async with self.engine.connect() as conn:
+            return await conn.scalar(LAG)
+
+    async def check(self):
+        try:
+            lag = await asyncio.wait_for(self._measure(), CHECK_INTERVAL)
+            self.lag = float(lag) if lag is not None else None
+        except Exception as e:
+            # logged on every check while the replica is down, keep it to one line
+            lag_checks_failed.inc(replica=self.name)
+            logger.warning("replica %s lag check failed: %r", self.name, e)
+            self.lag = None
+        self.ts_checked = time.monotonic()
+
+
+class ReplicaSet:
+    """Replicas in use, their measured lag and the recently written users"""
+
+    def __init__(self, replicas: list[Replica]):
+        self.replicas = replicas
+        self.written = TTLCache(maxsize=int(os.getenv('BROAPI_DB_REPLICA_STICKY_SIZE', '100000')), ttl=STICKY_SECONDS)
+        self._next = itertools.count()
+        self._worker: asyncio.Task | None = None
+
+        for replica in replicas:
+            lag_seconds.track(lambda replica=replica: replica.lag if replica.lag is not None else -1, replica=replica.name)
+
+    def stick(self, *keys):
+        """Sends reads about keys to the primary for STICKY_SECONDS"""
+        for key in keys:
+            self.written.set(str(key), True)
+
+    def factory(self, key=None):
+        """Session factory for a read about key, the primary's when no replica may serve it"""
+        if key is not None and self.written.get(str(key)):
+            reads.inc(target='sticky')
+            return session_factory
+        usable = [replica for replica in self.replicas if replica.usable()]
+        if not usable:
+            if self.replicas:
+                reads.inc(target='lagging')
+            return session_factory
+        replica = usable[next(self._next) % len(usable)]
+        reads.inc(target=f'replica_{replica.name}')
+        return replica.factory
+
+    async def start(self):
+        if not self.replicas:
+            return
+        await self.check()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    async def check(self):
+        await asyncio.gather(*(replica.check() for replica in self.replicas))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(CHECK_INTERVAL)
+            await self.check()
+
+
+replicas = ReplicaSet([
+    Replica(index, engine, factory)
+    for index, (engine, factory) in enumerate(zip(replica_engines, replica_session_factories))
+])
+
+
+async def get_read_session(request: Request) -> AsyncSession: # type: ignore
+    """Session for read-only endpoints, keyed by their user_id path parameter"""
+    async with replicas.factory(request.path_params.get('user_id'))() as session:
+        yield session
@@ -0,0 +1,23 @@
+from typing import Any
+
+import pydantic_core
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+class ModelResponse(JSONResponse):
+    """JSON response encoded by pydantic-core's compiled serializer
+
+    Handlers return `ModelResponse(model)` for the response model they have
+    just built, so FastAPI neither dumps nor re-validates it and the model
+    is serialized in a single pass; `bytes` are sent as they are. As the
+    app's default response class it also encodes every other JSON body.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        if isinstance(content, BaseModel):
+            return content.__pydantic_serializer__.to_json(content)
+        return pydantic_core.to_json(content)
@@ -0,0 +1,31 @@
+import math
+
+from fastapi import APIRouter, HTTPException, Query
+
+from ..leaderboard import leaderboards
+from ..responses import ModelResponse
+from ..models import domain
+
+MAX_PAGE = 100
+
+router = APIRouter()
+
+@router.get("/leaderboard", tags=["leaderboard"])
+async def get_leaderboard(board: domain.LeaderboardKind = domain.LeaderboardKind.coins,
+                          limit: int = Query(MAX_PAGE, ge=1, le=MAX_PAGE), offset: int = Query(0, ge=0)) -> domain.Leaderboard:
+    ranking = leaderboards[board]
+    entries = [
+        domain.LeaderboardEntry(rank=offset + position, user_id=user_id, username=leaderboards.usernames.get(user_id), value=math.floor(value))
+        for position, (user_id, value) in enumerate(ranking.page(offset, limit), start=1)
+    ]
+    return ModelResponse(domain.Leaderboard(board=board, total=len(ranking), entries=entries))
+
+@router.get("/users/{user_id}/rank", tags=["leaderboard"])
+async def get_rank(user_id: int, board: domain.LeaderboardKind = domain.LeaderboardKind.coins) -> domain.LeaderboardEntry:
+    ranking = leaderboards[board]
+    rank = ranking.rank(user_id)
+    if rank is None:
+        raise HTTPException(status_code=404, detail="user not ranked")
+    return ModelResponse(domain.LeaderboardEntry(
+        rank=rank, user_id=user_id, username=leaderboards.usernames.get(user_id), value=math.floor(ranking.value(user_id))
+    ))
@@ -5,28 +5,90 @@ from typing import Tuple
 import math
 import random
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 
-from sqlalchemy.orm import load_only
+from sqlalchemy.orm import aliased, load_only
 from sqlalchemy.exc import NoResultFound
-from sqlalchemy import tablesample, func, or_, and_, case, Integer
+from sqlalchemy import exists, func, or_, update
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel import select
 
-from ..dependencies import get_session, send_notifications
+from .. import cache, idempotency, invalidation, ledger, matchmaking, metrics, notifications
+from ..responses import ModelResponse
+from ..database import session_factory
+from ..dependencies import get_read_session, get_session
 from ..models import domain, db
 
 
-router = APIRouter()
+router = APIRouter(route_class=idempotency.IdempotentRoute)
 
 @router.get("/users/{user_id}/character", tags=["pvp"])
-async def get_character(user_id: int, session: AsyncSession = Depends(get_session)) -> domain.CharacterProfile:
+async def get_character(user_id: int, session: AsyncSession = Depends(get_read_session)) -> domain.CharacterProfile:
+    # energy and premium depend on the current time, so only the row is cached, never the profile
+    db_character = cache.profiles.get(user_id)
+    if db_character is None:
+        db_character = await _read_character(user_id, session)
+    if db_character is None:
+        # first visit, the character is created on the primary
+        async with session_factory() as primary:
+            db_character = await _load_character(user_id, primary)
+
+    stats = None
+    if is_premium(db_character):
+        stats = _collect_stats(db_character)
+
+    return ModelResponse(_convert_from_db_character(db_character, stats))
+
+@router.post("/characters:batchGet", tags=["pvp"])
+async def batch_get_characters(request: domain.CharactersBatchRequest, session: AsyncSession = Depends(get_read_session)) -> domain.CharactersBatchResponse:
+    user_ids = list(dict.fromkeys(request.user_ids))
+    db_characters = {}
+    for user_id in user_ids:
+        db_character = cache.profiles.get(user_id)
+        if db_character is not None:
+            db_characters[user_id] = db_character
+
+    # the rest in one query; missing characters are reported, not created
+    missing = [user_id for user_id in user_ids if user_id not in db_characters]
+    if missing:
+        cache_version = cache.profiles.version()
+        characters_scalar = await session.exec(select(db.PVPCharacter).where(db.PVPCharacter.user_id.in_(missing)))
+        for db_character in characters_scalar.all():
+            db_characters[db_character.user_id] = db_character
+            cache.profiles.set(db_character.user_id, db_character, cache_version)
+        await session.commit()
+
+    characters = {}
+    for user_id in user_ids:
+        db_character = db_characters.get(user_id)
+        if db_character is None:
+            continue
+        stats = None
+        if request.stats or is_premium(db_character):
+            stats = _collect_stats(db_character)
+        characters[user_id] = _convert_from_db_character(db_character, stats)
+
+    return ModelResponse(domain.CharactersBatchResponse(
+        characters=characters,
+        not_found=[user_id for user_id in user_ids if user_id not in characters],
+    ))
+
+async def _read_character(user_id: int, session: AsyncSession) -> db.PVPCharacter | None:
+    cache_version = cache.profiles.version()
     scalar_result = await session.exec(select(db.PVPCharacter).where(db.PVPCharacter.user_id == user_id))
     db_character = scalar_result.one_or_none()
+    await session.commit()
+    if db_character is not None:
+        cache.profiles.set(user_id, db_character, cache_version)
+    return db_character
+
+async def _load_character(user_id: int, session: AsyncSession) -> db.PVPCharacter:
+    db_character = await _read_character(user_id, session)
     if not db_character:
+        cache_version = cache.profiles.version()
         try:
             user_scalar = await session.exec(
-                select(db.User).where(db.User.ref_code == str(user_id)).limit(1).options(load_only(db.User.username))
+                select(db.User).where(db.User.tg_id == user_id).order_by(db.User.sid).limit(1).options(load_only(db.User.username))
             )
             db_user = user_scalar.one()
 
@@ -46,56 +108,97 @@ async def get_character(user_id: int, session: AsyncSession = Depends(get_sessio
                 ts_defences_today=0
             )
             session.add(db_character)
+            invalidation.publish(session, 'pool.upsert', db_character.user_id, db_character.level, None)
+            invalidation.publish(session, 'written', user_id)
         except NoResultFound:
             raise HTTPException(status_code=404, detail="user not found")
-        
-    stats = None
-    if is_premium(db_character):
-        stats = await _collect_stats(db_character, session=session)
 
-    await session.commit()
-    return _convert_from_db_character(db_character, stats)
+        await session.commit()
+        cache.profiles.set(user_id, db_character, cache_version)
+    return db_character
 
-@router.post("/users/{user_id}/levelup", tags=["pvp"])
+@router.post("/users/{user_id}/levelup", tags=["pvp"], dependencies=[Depends(idempotency.key)])
 async def level_up(user_id: int, delta: domain.AbilityScoresDelta | None = None, session: AsyncSession = Depends(get_session)) -> domain.LevelupResponse:
     try:
+        # locked, so concurrent upgrades of the character each pay for their own
         character_scalar = await session.exec(
-            select(db.PVPCharacter).where(db.PVPCharacter.user_id == user_id).options(load_only(db.PVPCharacter.abilities))
+            select(db.PVPCharacter).where(db.PVPCharacter.user_id == user_id)
+                .options(load_only(db.PVPCharacter.abilities))
+                .with_for_update()
         )
         db_character = character_scalar.one()
         abilities = domain.AbilityScores(**db_character.abilities)
-        levelup_cost = abilities.upgrade_cost(delta)
-
-        user_scalar = await session.exec(
-            select(db.User).where(db.User.ref_code == str(user_id)).limit(1).options(load_only(db.User.score))
-        )
-        db_user = user_scalar.one()
-        db_user.score = db_user.score - levelup_cost
-
-        if db_user.score < 0:
-            raise HTTPException(status_code=400, detail=f"insufficient coins; need another {int(math.fabs(db_user.score))}")
+        try:
+            levelup_cost = abilities.upgrade_cost(delta)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        changes = await ledger.apply(session, {user_id: -levelup_cost}, db.CoinReason.levelup)
+        if user_id not in changes:
+            raise NoResultFound()
+        balance, applied = changes[user_id]
+        if applied != -levelup_cost:
+            raise HTTPException(status_code=400, detail=f"insufficient coins; need another {levelup_cost - balance}")
         
         abilities.upgrade(delta)
         db_character.abilities = abilities.model_dump(mode='json')
         db_character.power = abilities.power()
+        # picked up by the leaderboard reconciliation of other workers
+        db_character.ts_updated = datetime.now(timezone.utc)
     
-        session.add(db_user)
         session.add(db_character)
+        invalidation.publish(session, 'profiles', user_id)
+        invalidation.publish(session, 'written', user_id)
+        invalidation.publish(session, 'rank', domain.LeaderboardKind.coins, user_id, balance)
+        invalidation.publish(session, 'rank', domain.LeaderboardKind.power, user_id, db_character.power)
         await session.commit()
-        return domain.LevelupResponse(abilities=abilities, power=math.floor(db_character.power))
+        return ModelResponse(domain.LevelupResponse(abilities=abilities, power=math.floor(db_character.power)))
     except NoResultFound:
         raise HTTPException(status_code=404, detail="user or character not found")
 
-@router.post("/users/{user_id}/pvp", tags=["pvp"])
+@router.get("/users/{user_id}/levelup", tags=["pvp"])
+async def max_level_up(user_id: int, coins: int | None = Query(None, ge=0), session: AsyncSession = Depends(get_read_session)) -> domain.MaxLevelupResponse:
+    """Highest level reachable per ability for `coins`, the user balance by default"""
+    row_result = await session.exec(
+        select(
+            db.PVPCharacter.abilities,
+            select(db.User.score).where(db.User.tg_id == user_id).order_by(db.User.sid).limit(1).scalar_subquery(),
+        ).where(db.PVPCharacter.user_id == user_id)
+    )
+    row = row_result.one_or_none()
+    if row is None or (coins is None and row[1] is None):
+        raise HTTPException(status_code=404, detail="user or character not found")
+
+    abilities = domain.AbilityScores(**row[0])
+    if coins is None:
+        coins = row[1]
+
+    try:
+        delta = abilities.max_upgrade(coins)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    levels, costs = {}, {}
+    for ability_name, ability_delta in delta.model_dump().items():
+        levels[ability_name] = getattr(abilities, ability_name) + ability_delta
+        costs[ability_name] = abilities.upgrade_cost(domain.AbilityScoresDelta(**{ability_name: ability_delta}))
+
+    return ModelResponse(domain.MaxLevelupResponse(
+        coins=coins,
+        delta=delta,
+        abilities=domain.AbilityScores(**levels),
+        costs=domain.AbilityScores(**costs),
+    ))
+
+@router.post("/users/{user_id}/pvp", tags=["pvp"], dependencies=[Depends(idempotency.key)])
 async def search_match(user_id: int, session: AsyncSession = Depends(get_session)) -> domain.PVPMatch:
     try:
         player_scalar = await session.exec(
             select(db.PVPCharacter).where(db.PVPCharacter.user_id==user_id).options(
-                load_only(db.PVPCharacter.user_id, db.PVPCharacter.username, db.PVPCharacter.level, db.PVPCharacter.abilities, db.PVPCharacter.power, db.PVPCharacter.ts_premium_until)
+                load_only(*COMPETITIONER_COLUMNS)
             )
         )
         db_player = player_scalar.one()
-        player =  await _convert_to_match_competitioner(db_player, is_premium(db_player), session=session)
+        player = _convert_to_match_competitioner(db_player, is_premium(db_player))
 
         match_scalar = await session.exec(
             select(db.PVPMatch).where(db.PVPMatch.player_id==user_id, db.PVPMatch.ts_finished==None)
@@ -114,7 +217,7 @@ async def search_match(user_id: int, session: AsyncSession = Depends(get_session
             )
             session.add(db_match)
             await session.commit()
-            return domain.PVPMatch(match_id=db_match.uuid, player=player, opponent=opponent)
+            return ModelResponse(domain.PVPMatch(match_id=db_match.uuid, player=player, opponent=opponent))
         
         ts_now = datetime.now(timezone.utc)
         if db_match.ts_updated + timedelta(minutes=30) < ts_now:
@@ -122,20 +225,18 @@ async def search_match(user_id: int, session: AsyncSession = Depends(get_session
             db_match.opponent_id = opponent.user_id
             db_match.ts_updated = ts_now
             session.add(db_match)
-
-        opponent_scalar = await session.exec(
-            select(db.PVPCharacter).where(db.PVPCharacter.user_id == db_match.opponent_id).options(
-                    load_only(db.PVPCharacter.user_id, db.PVPCharacter.username, db.PVPCharacter.level, db.PVPCharacter.abilities, db.PVPCharacter.power, db.PVPCharacter.ts_premium_until)
-                )
+        else:
+            opponent_scalar = await session.exec(
+                select(*COMPETITIONER_COLUMNS).where(db.PVPCharacter.user_id == db_match.opponent_id)
             )
-        db_opponent = opponent_scalar.one()
-        opponent = await _convert_to_match_competitioner(db_opponent, is_premium(db_player), session=session)
+            db_opponent = opponent_scalar.one()
+            opponent = _convert_to_match_competitioner(db_opponent, is_premium(db_player))
         await session.commit()
-        return domain.PVPMatch(match_id=db_match.uuid, player=player, opponent=opponent)
+        return ModelResponse(domain.PVPMatch(match_id=db_match.uuid, player=player, opponent=opponent))
     except NoResultFound:
         raise HTTPException(status_code=404, detail="character not found")
 
-@router.post("/pvp/{match_id}/skip", tags=["pvp"])
+@router.post("/pvp/{match_id}/skip", tags=["pvp"], dependencies=[Depends(idempotency.key)])
 async def skip_match(match_id: UUID, session: AsyncSession = Depends(get_session)) -> domain.MatchCompetitioner:
     try: 
         match_scalar = await session.exec(
@@ -150,6 +251,7 @@ async def skip_match(match_id: UUID, session: AsyncSession = Depends(get_session
         )
         db_opponent = opponent_scalar.one()
         db_opponent.ts_invulnerable_until = None
+        db_opponent.ts_updated = datetime.now(timezone.utc)
 
         player_scalar = await session.exec(
             select(db.PVPCharacter).where(db.PVPCharacter.user_id == db_match.player_id).options(
@@ -158,40 +260,56 @@ async def skip_match(match_id: UUID, session: AsyncSession = Depends(get_session
         )
         db_player = player_scalar.one()
 
-        user_scalar = await session.exec(
-            select(db.User).where(db.User.ref_code == str(db_match.player_id)).limit(1)
-                .options(
-                    load_only(db.User.score)
-                )
-        )
-        db_user = user_scalar.one()
-
-        if db_user.score < 50:
+        changes = await ledger.apply(session, {db_match.player_id: -SKIP_COST}, db.CoinReason.skip, match_id=db_match.uuid)
+        if db_match.player_id not in changes:
+            raise NoResultFound()
+        if changes[db_match.player_id].delta != -SKIP_COST:
             raise HTTPException(status_code=400, detail="insufficient coins")
-        db_user.score -= 50
 
         opponent = await _search_opponent(db_match.player_id, db_player.level, is_premium(db_player), session=session)
         db_match.ts_updated = datetime.now(timezone.utc)
         db_match.opponent_id = opponent.user_id
         
         session.add(db_opponent)
-        session.add(db_user)
         session.add(db_match)
+        invalidation.publish(session, 'profiles', db_match.player_id, db_opponent.user_id)
+        invalidation.publish(session, 'written', db_match.player_id, db_opponent.user_id)
+        invalidation.publish(session, 'rank', domain.LeaderboardKind.coins, db_match.player_id, changes[db_match.player_id].balance)
+        if db_opponent.user_id != opponent.user_id:
+            invalidation.publish(session, 'pool.release', db_opponent.user_id)
         await session.commit()
-        return opponent
+        return ModelResponse(opponent)
 
     except NoResultFound:
         raise HTTPException(status_code=404, detail="match not found")
 
-@router.post("/pvp/{match_id}/start", tags=["pvp"])
-async def start_match(match_id: UUID, background_tasks: BackgroundTasks, session: AsyncSession = Depends(get_session)) -> domain.PVPMatchResult:
+@router.post("/pvp/{match_id}/start", tags=["pvp"], dependencies=[Depends(idempotency.key)])
+async def start_match(match_id: UUID, session: AsyncSession = Depends(get_session)) -> domain.PVPMatchResult:
     try: 
-        match_scalar = await session.exec(
-            select(db.PVPMatch).where(db.PVPMatch.uuid==match_id).options(
-                load_only(db.PVPMatch.player_id, db.PVPMatch.opponent_id, db.PVPMatch.ts_updated, db.PVPMatch.ts_finished)
+        # match, both characters, both balances and the first match flag in one locking read
+        player, opponent = aliased(db.PVPCharacter, name='player'), aliased(db.PVPCharacter, name='opponent')
+        previous_match = aliased(db.PVPMatch, name='previous_match')
+        resolution_scalar = await session.exec(
+            select(
+                db.PVPMatch,
+                player,
+                opponent,
+                select(db.User.score).where(db.User.tg_id == player.user_id).order_by(db.User.sid).limit(1).scalar_subquery(),
+                select(db.User.score).where(db.User.tg_id == opponent.user_id).order_by(db.User.sid).limit(1).scalar_subquery(),
+                or_(
+                    exists().where(previous_match.player_id == db.PVPMatch.player_id, previous_match.uuid != db.PVPMatch.uuid),
+                    exists().where(db.PVPMatchArchive.player_id == db.PVPMatch.player_id),
+                ),
             )
+            .join(player, player.user_id == db.PVPMatch.player_id)
+            .join(opponent, opponent.user_id == db.PVPMatch.opponent_id)
+            .where(db.PVPMatch.uuid == match_id)
+            .with_for_update(of=[db.PVPMatch, player, opponent])
         )
-        db_match = match_scalar.one()
+        db_match, db_player, db_opponent, player_score, opponent_score, has_played = resolution_scalar.one()
+        # everything below is written back explicitly in batched statements, not by the unit of work
+        for db_obj in (db_match, db_player, db_opponent):
+            session.expunge(db_obj)
 
         if db_match.ts_finished is not None:
             raise HTTPException(status_code=404, detail="match already finished")
@@ -200,10 +318,8 @@ async def start_match(match_id: UUID, background_tasks: BackgroundTasks, session
         if db_match.ts_updated + timedelta(minutes=30) < ts_now:  
             raise HTTPException(status_code=400, detail="match expired; find new opponent")
 
-        player_scalar = await session.exec(
-            select(db.PVPCharacter).where(db.PVPCharacter.user_id == db_match.player_id)
-        )
-        db_player = player_scalar.one()
+        if player_score is None or opponent_score is None:
+            raise HTTPException(status_code=404, detail="user not found")
 
         if db_player.energy_boost > 0:
             db_player.energy_boost = db_player.energy_boost - 1
@@ -221,24 +337,27 @@ async def start_match(match_id: UUID, background_tasks: BackgroundTasks, session
             db_player.energy_last_match = energy - 1.0
             db_player.ts_last_match = ts_now
 
-        opponent_scalar = await session.exec(
-            select(db.PVPCharacter).where(db.PVPCharacter.user_id == db_match.opponent_id)
-        )
-        db_opponent = opponent_scalar.one()
-
         # battle logic (╯°□°)╯︵ ┻━┻
-        match_result, stats = await _calculate_match_result(db_match, db_player, db_opponent, session)
+        match_result, stats = _calculate_match_result(db_player, db_opponent, first_match=not has_played)
         # ┬─┬ノ( º _ ºノ)
 
         db_match.result = match_result
         db_match.ts_updated = ts_now
         db_match.ts_finished = ts_now
 
-        db_match.loot = None
-
-        opponent_score, opponent_score_delta, player_score_delta = await _change_score(db_player, db_opponent, db_match.result, session)
+        player_score, opponent_score, opponent_score_delta, player_score_delta = await _change_score(
+            db_player, db_opponent, db_match, player_score, opponent_score, session
+        )
         db_match.loot = { 'coins': player_score_delta }
 
+        db_player.stats_total += 1
+        db_opponent.stats_total += 1
+        if db_match.result == db.MatchResult.win:
+            db_player.stats_won += 1
+            db_player.stats_loot += player_score_delta
+        else:
+            db_opponent.stats_won += 1
+
         if db_match.result == db.MatchResult.win:
             await _change_level(db_player, db_opponent)
         else:
@@ -246,22 +365,40 @@ async def start_match(match_id: UUID, background_tasks: BackgroundTasks, session
         
         db_match.stats = stats 
 
-        message = _match_result_notification_message(db_player, db_opponent, db_match.result, opponent_score_delta, opponent_score)
-        background_tasks.add_task(send_notifications, db_match.opponent_id, message)
+        report = _defence_report(db_player, db_opponent, db_match.result, opponent_score_delta, opponent_score)
+        outbox_entry = notifications.dispatcher.stage(session, report)
 
         #  2 hours invulnerability after defence
         db_opponent.ts_invulnerable_until = ts_now + timedelta(minutes=3)
         db_opponent.ts_defences_today += 1
         # if more the 5 defences per day — invulnerable for the day
         if db_opponent.ts_defences_today >= 100: # 5
-            today = ts_now.date()
-            db_opponent.ts_invulnerable_until = datetime(today.year, today.month, today.day + 1, tzinfo=timezone.utc)
+            tomorrow = ts_now.date() + timedelta(days=1)
+            db_opponent.ts_invulnerable_until = datetime(tomorrow.year, tomorrow.month, tomorrow.day, tzinfo=timezone.utc)
             db_opponent.ts_defences_today = 0
 
-        session.add(db_opponent)
-        session.add(db_player)
-        session.add(db_match)
+        db_player.ts_updated = ts_now
+        db_opponent.ts_updated = ts_now
+
+        # one executemany for both characters (rows are locked above), one UPDATE for the match
+        await session.exec(
+            update(db.PVPCharacter),
+            params=[_match_resolution_values(db_player), _match_resolution_values(db_opponent)],
+        )
+        await session.exec(
+            update(db.PVPMatch)
+                .where(db.PVPMatch.uuid == db_match.uuid, db.PVPMatch.ts_created == db_match.ts_created)
+                .values(result=db_match.result, ts_updated=ts_now, ts_finished=ts_now, loot=db_match.loot, stats=db_match.stats)
+                .execution_options(synchronize_session=False)
+        )
+        invalidation.publish(session, 'profiles', db_player.user_id, db_opponent.user_id)
+        invalidation.publish(session, 'written', db_player.user_id, db_opponent.user_id)
+        invalidation.publish(session, 'rank', domain.LeaderboardKind.coins, db_player.user_id, player_score)
+        invalidation.publish(session, 'rank', domain.LeaderboardKind.coins, db_opponent.user_id, opponent_score)
+        invalidation.publish(session, 'pool.upsert', db_player.user_id, db_player.level, db_player.ts_invulnerable_until)
+        invalidation.publish(session, 'pool.upsert', db_opponent.user_id, db_opponent.level, db_opponent.ts_invulnerable_until)
         await session.commit()
+        notifications.dispatcher.submit(report, outbox_entry)
 
         result = domain.PVPMatchResult(
             result=domain.MatchResult.win if db_match.result == db.MatchResult.win else domain.MatchResult.lose, 
@@ -269,10 +406,26 @@ async def start_match(match_id: UUID, background_tasks: BackgroundTasks, session
         if db_match.loot:
             result.loot = domain.MatchLoot(**db_match.loot)
 
-        return result
+        return ModelResponse(result)
     
     except NoResultFound:
         raise HTTPException(status_code=404, detail="match not found")
+
+def _match_resolution_values(db_obj: db.PVPCharacter) -> dict:
+    return {
+        'user_id': db_obj.user_id,
+        'level': db_obj.level,
+        'experience': db_obj.experience,
+        'energy_boost': db_obj.energy_boost,
+        'energy_last_match': db_obj.energy_last_match,
+        'ts_last_match': db_obj.ts_last_match,
+        'ts_invulnerable_until': db_obj.ts_invulnerable_until,
+        'ts_defences_today': db_obj.ts_defences_today,
+        'stats_total': db_obj.stats_total,
+        'stats_won': db_obj.stats_won,
+        'stats_loot': db_obj.stats_loot,
+        'ts_updated': db_obj.ts_updated,
+    }
     
 ts_from = datetime(2024, 10, 23, 21, 0, 0, 0, tzinfo=timezone.utc)
 ts_to = datetime(2024, 10, 24, 21, 0, 0, 0, tzinfo=timezone.utc)
@@ -290,30 +443,27 @@ def _calc_coins_gain_loss(opponent: db.PVPCharacter, score_base: int) -> Tuple[i
     else:
         return amount, -1 * amount
 
-async def _change_score(player: db.PVPCharacter, opponent: db.PVPCharacter, match_resut: db.MatchResult, session: AsyncSession) -> Tuple[int, int]:
-    player_user_scalar = await session.exec(
-        select(db.User).where(db.User.ref_code == str(player.user_id)).limit(1).options(load_only(db.User.score))
-    )
-    db_player_user = player_user_scalar.one()
-
-    opponent_user_scalar = await session.exec(
-        select(db.User).where(db.User.ref_code == str(opponent.user_id)).limit(1).options(load_only(db.User.score))
-    )
-    db_opponent_user = opponent_user_scalar.one()
-
+async def _change_score(player: db.PVPCharacter, opponent: db.PVPCharacter, match: db.PVPMatch,
+                        player_score: int, opponent_score: int, session: AsyncSession) -> Tuple[int, int, int, int]:
+    """Applies the match result to both balances; returns the new balances and the deltas as applied"""
     player_score_delta = 0
     opponent_score_delta = 0
-    if match_resut == db.MatchResult.win:
-        player_score_delta, opponent_score_delta = _calc_coins_gain_loss(opponent, db_opponent_user.score)
-    elif match_resut == db.MatchResult.lose:
-        opponent_score_delta, player_score_delta  = _calc_coins_gain_loss(player, db_player_user.score)
-
-    db_player_user.score = max(0, db_player_user.score + player_score_delta)
-    db_opponent_user.score = max(0, db_opponent_user.score + opponent_score_delta)
+    if match.result == db.MatchResult.win:
+        player_score_delta, opponent_score_delta = _calc_coins_gain_loss(opponent, opponent_score)
+    elif match.result == db.MatchResult.lose:
+        opponent_score_delta, player_score_delta  = _calc_coins_gain_loss(player, player_score)
+
+    # a loss takes at most what the loser has left
+    changes = await ledger.apply(
+        session, {player.user_id: player_score_delta, opponent.user_id: opponent_score_delta},
+        db.CoinReason.match, match_id=match.uuid, floor=True,
+    )
+    player_change = changes.get(player.user_id, ledger.Change(player_score, 0))
+    opponent_change = changes.get(opponent.user_id, ledger.Change(opponent_score, 0))
 
-    return db_opponent_user.score, opponent_score_delta, player_score_delta
+    return player_change.balance, opponent_change.balance, opponent_change.delta, player_change.delta
 
-def _match_result_notification_message(player: db.PVPCharacter, opponent: db.PVPCharacter, match_result: db.MatchResult, score_delta: int, score: int) -> str:
+def _defence_report(player: db.PVPCharacter, opponent: db.PVPCharacter, match_result: db.MatchResult, score_delta: int, score: int) -> notifications.DefenceReport:
     ts_now = datetime.now(timezone.utc)
 
     energy_max = 2
@@ -325,30 +475,16 @@ def _match_result_notification_message(player: db.PVPCharacter, opponent: db.PVP
     remaining_energy = _calc_remaining_energy(opponent.energy_last_match, energy_max, restore_speed, opponent.ts_last_match, ts_now)
     energy = math.floor(remaining_energy) + opponent.energy_boost
 
-    if match_result == db.MatchResult.win:
-        return f'''⚔️ @{player.username} with {int(math.floor(player.power))} battle power attacked you! ⚔️  
-🏆 Winner: @{player.username}  
-📃 Result: You lost {score_delta} $BRO 🪙
-
-Your $BRO balance: {score} $BRO 🪙  
-Energy remaining: {energy} ⚡️
-
-Level up your stats to win more battles!
-
-'''
-    elif match_result == db.MatchResult.lose:
-        return f'''⚔️ @{player.username} with {int(math.floor(player.power))} battle power attacked you! ⚔️  
-🏆 Winner: @{opponent.username}  
-📃 Result: You won {score_delta} $BRO 🪙, +1 EXP
-
-Your $BRO balance: {score} $BRO 🪙  
-Energy remaining: {energy} ⚡️
-
-Level up your stats to win more battles!
-
-'''
-    else:
-        return ''
+    return notifications.DefenceReport(
+        chat_id=opponent.user_id,
+        attacker=player.username,
+        attacker_power=int(math.floor(player.power)),
+        winner=player.username if match_result == db.MatchResult.win else opponent.username,
+        defended=match_result == db.MatchResult.lose,
+        score_delta=score_delta,
+        score=score,
+        energy=energy,
+    )
 
 async def _change_level(player: db.PVPCharacter, opponent: db.PVPCharacter):
     experience_gain = 0
@@ -373,8 +509,6 @@ async def _change_level(player: db.PVPCharacter, opponent: db.PVPCharacter):
             break
 
 async def _search_opponent(player_id: int, player_level: int, is_premium: bool, session: AsyncSession) -> domain.MatchCompetitioner:
-    sample = tablesample(db.PVPCharacter, func.bernoulli(100), name='sample', seed=func.random())
-
     min_level = 0
     if player_level == 1:
         min_level = 1
@@ -383,41 +517,57 @@ async def _search_opponent(player_id: int, player_level: int, is_premium: bool,
     else:
         min_level = player_level - 2
 
-    opponent_id_scalar = await session.exec(
-        select(sample.c.user_id).where(
-            and_(sample.c.level <= player_level + 2,
-                and_(sample.c.level >= min_level,
-                    and_(sample.c.user_id != player_id, 
-                        or_(sample.c.ts_invulnerable_until == None, 
-                            sample.c.ts_invulnerable_until < func.now()
-                        )
+    # reserve character for 30min
+    ts_now = datetime.now(timezone.utc)
+    ts_invulnerable_until = ts_now + timedelta(minutes=30)
+
+    db_opponent = None
+    # the pool may lag behind other workers; on a miss retry once with a fresh index
+    for attempt in range(2):
+        await matchmaking.pool.refresh(session, force=attempt > 0)
+        candidates = matchmaking.pool.sample(player_id, max(min_level, 0), player_level + 2, k=OPPONENT_CANDIDATES)
+        if not candidates:
+            metrics.matchmaking_misses.inc(reason='empty')
+            continue
+
+        # claim one candidate atomically; rows locked by concurrent searches are skipped, not waited on
+        candidate = (
+            select(db.PVPCharacter.user_id)
+                .where(
+                    db.PVPCharacter.user_id.in_(candidates),
+                    db.PVPCharacter.user_id != player_id,
+                    db.PVPCharacter.level <= player_level + 2,
+                    db.PVPCharacter.level >= min_level,
+                    or_(db.PVPCharacter.ts_invulnerable_until == None,
+                        db.PVPCharacter.ts_invulnerable_until < func.now()
                     )
                 )
-            )
+                .limit(1)
+                .with_for_update(skip_locked=True)
+                .scalar_subquery()
         )
-    )
-    opponent_ids = opponent_id_scalar.all()
-    if not opponent_ids:
-        raise HTTPException(status_code=400, detail="no available opponents; please wait")
-    opponent_id = random.choice(opponent_ids)
-
-    opponent_scalar = await session.exec(
-        select(db.PVPCharacter)
-            .where(db.PVPCharacter.user_id == opponent_id)
-            .options(
-                load_only(db.PVPCharacter.user_id, db.PVPCharacter.username, db.PVPCharacter.level, db.PVPCharacter.abilities, db.PVPCharacter.power, db.PVPCharacter.ts_invulnerable_until, db.PVPCharacter.ts_premium_until)
-            )
+        opponent_result = await session.exec(
+            update(db.PVPCharacter)
+                .where(db.PVPCharacter.user_id == candidate)
+                .values(ts_invulnerable_until=ts_invulnerable_until, ts_updated=ts_now)
+                .returning(*COMPETITIONER_COLUMNS)
+                .execution_options(synchronize_session=False)
         )
-    db_opponent = opponent_scalar.one()
+        db_opponent = opponent_result.one_or_none()
+        if db_opponent:
+            metrics.matchmaking_searches.inc(outcome='found' if attempt == 0 else 'found_after_refresh')
+            break
+        metrics.matchmaking_misses.inc(reason='contended')
 
-    # reserve character for 30min
-    ts_now = datetime.now(timezone.utc)
-    ts_invulnerable_until = ts_now + timedelta(minutes=30)
-    db_opponent.ts_invulnerable_until = ts_invulnerable_until
-    db_opponent.ts_updated = ts_now
-    session.add(db_opponent)
+    if not db_opponent:
+        metrics.matchmaking_searches.inc(outcome='no_opponents')
+        raise HTTPException(status_code=400, detail="no available opponents; please wait")
+
+    # reserved here right away so concurrent searches of this worker skip it
+    matchmaking.pool.reserve(db_opponent.user_id, ts_invulnerable_until)
+    invalidation.publish(session, 'pool.reserve', db_opponent.user_id, ts_invulnerable_until)
 
-    return await _convert_to_match_competitioner(db_opponent, is_premium, session=session)
+    return _convert_to_match_competitioner(db_opponent, is_premium)
 
 def _convert_from_db_character(db_obj: db.PVPCharacter, stats: domain.PVPStats | None) -> domain.CharacterProfile:
     ts_now = datetime.now(timezone.utc)
@@ -434,13 +584,14 @@ def _convert_from_db_character(db_obj: db.PVPCharacter, stats: domain.PVPStats |
     time_to_restore = _calc_time_to_restore(remaining_energy, energy_max, restore_speed)
     experience = _calc_exp(db_obj)
 
+    # abilities were written by AbilityScores.model_dump, no need to validate them again
     profile = domain.CharacterProfile(
         user_id=db_obj.user_id,
         username=db_obj.username,
         level=db_obj.level, 
         experience=experience,
         power=math.floor(db_obj.power),
-        abilities=domain.AbilityScores(**db_obj.abilities),
+        abilities=domain.AbilityScores.model_construct(**db_obj.abilities),
         energy=domain.CharacterEnergy(
             remaining=math.floor(remaining_energy) + db_obj.energy_boost,
             maximum=energy_max,
@@ -475,49 +626,40 @@ def _calc_exp(db_obj: db.PVPCharacter) -> domain.CharacterExperience:
     base = domain.exp_table[db_obj.level - 1]
     return domain.CharacterExperience(current_experience=exp - base, maximum_experience=max_exp - base)
 
-async def _collect_stats(db_obj: db.PVPCharacter, session: AsyncSession):
-    scalar = await session.exec(
-        select(
-                func.count('*').label('total'),
-                func.sum(
-                    case(
-                        (and_(db.PVPMatch.player_id == db_obj.user_id, db.PVPMatch.result == db.MatchResult.win), 1),
-                        (and_(db.PVPMatch.opponent_id == db_obj.user_id, db.PVPMatch.result == db.MatchResult.lose), 1),
-                        else_=0
-                    )
-                ).label('won'),
-                func.sum(
-                    case(
-                        (and_(db.PVPMatch.player_id == db_obj.user_id, db.PVPMatch.result == db.MatchResult.win), db.PVPMatch.loot['coins'].cast(Integer)),
-                        else_=0
-                    )
-                ).label('loot')
-            )
-            .select_from(db.PVPMatch)
-            .where(
-                or_(db.PVPMatch.player_id == db_obj.user_id,
-                    db.PVPMatch.opponent_id == db_obj.user_id)
-            )
-    )
-    total, won, loot = scalar.one()
+def _collect_stats(db_obj: db.PVPCharacter) -> domain.PVPStats:
+    return domain.PVPStats(total=db_obj.stats_total, won=db_obj.stats_won, loot=db_obj.stats_loot)
 
-    return domain.PVPStats(total=total, won=won, loot=loot)
-
-async def _convert_to_match_competitioner(db_obj: db.PVPCharacter, player_has_premium: bool, session: AsyncSession) -> domain.MatchCompetitioner:
+def _convert_to_match_competitioner(db_obj: db.PVPCharacter, player_has_premium: bool) -> domain.MatchCompetitioner:
     competitioner = domain.MatchCompetitioner(
         user_id=db_obj.user_id,
         username=db_obj.username,
         level=db_obj.level,
         power=math.floor(db_obj.power),
-        abilities=domain.AbilityScores(**db_obj.abilities),
+        abilities=domain.AbilityScores.model_construct(**db_obj.abilities),
         premium=is_premium(db_obj)
     )
     
     if player_has_premium:
-        competitioner.stats = await _collect_stats(db_obj, session=session)
+        competitioner.stats = _collect_stats(db_obj)
 
     return competitioner
 
+OPPONENT_CANDIDATES = 16
+
+SKIP_COST = 50
+
+COMPETITIONER_COLUMNS = (
+    db.PVPCharacter.user_id,
+    db.PVPCharacter.username,
+    db.PVPCharacter.level,
+    db.PVPCharacter.abilities,
+    db.PVPCharacter.power,
+    db.PVPCharacter.ts_premium_until,
+    db.PVPCharacter.stats_total,
+    db.PVPCharacter.stats_won,
+    db.PVPCharacter.stats_loot,
+)
+
 ENERGY_RESTORE_SPEED = 4 # per hour
 ENERGY_RESTORE_SPEED_PREMIUM = 12 # per hour
 
@@ -534,41 +676,19 @@ def _calc_time_to_restore(energy: float, maximum: int, restore_speed: int) -> ti
     return timedelta(hours=(1 - (energy - math.floor(energy))) / restore_speed)
 
 
-alpha_table = [
-        (1.50, None),  # auto-win
-        (0.51, 1.746),
-        (0.49, 1.800),
-        (0.44, 1.970),
-        (0.39, 2.170),
-        (0.34, 2.400),
-        (0.29, 2.500),
-        (0.24, 2.800),
-        (0.19, 3.000),
-        (0.14, 3.500),
-        (0.09, 4.000),
-        (0.06, 4.000),
-        (0.03, 4.000),
-        (0.01, 5.000),
-    ]
-
-async def _calculate_match_result(match: db.PVPMatch, player: db.PVPCharacter, opponent: db.PVPCharacter,
-                            session: AsyncSession) -> tuple[db.MatchResult, dict]:
+def _calculate_match_result(player: db.PVPCharacter, opponent: db.PVPCharacter, first_match: bool) -> tuple[db.MatchResult, dict]:
     """Вычисление результата матча
 
-    :param match: текущий матч
     :param player: нападающий игрок
     :param opponent: обороняющийся игрок
-    :param session: сессия бд
+    :param first_match: первый матч нападающего
 
     :return result: результат матча
     :return stat: статистика
 
     """
 
-    count_scalar = await session.exec(
-        select(func.count('*')).where(db.PVPMatch.player_id == player.user_id, db.PVPMatch.uuid != match.uuid).select_from(db.PVPMatch)
-    )
-    if count_scalar.one() == 0:
+    if first_match:
         return db.MatchResult.win, {'result': db.MatchResult.win, 'comment': 'first match'}
 
     champion, contestant = opponent, player
@@ -581,7 +701,7 @@ async def _calculate_match_result(match: db.PVPMatch, player: db.PVPCharacter, o
     gap = champion.power / contestant.power - 1
 
     
-    alpha = next((a for (_, (treshold, a)) in enumerate(alpha_table) if gap >= treshold), 5.000)
+    alpha = next((a for (_, (treshold, a)) in enumerate(domain.alpha_table) if gap >= treshold), 5.000)
     stats = {
         'player_id': player.user_id,
         'opponent_id': opponent.user_id,
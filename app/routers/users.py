@@ -1,38 +1,47 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from uuid import uuid4
 
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Query
 from fastapi import APIRouter
+from sqlalchemy import Row, func, literal, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import defer
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel import select
-from sqlalchemy.orm.attributes import flag_modified
 
-from ..dependencies import get_session
+from .. import idempotency, invalidation, ledger
+from ..dependencies import get_read_session, get_session
+from ..responses import ModelResponse
 from ..models import domain, db
 
-router = APIRouter()
+MAX_REFERRALS_PAGE = 100
+
+router = APIRouter(route_class=idempotency.IdempotentRoute)
 
 @router.get("/users/{user_id}", tags=["users"])
-async def get_user(user_id: str, session: AsyncSession = Depends(get_session)) -> domain.User:
+async def get_user(user_id: str, session: AsyncSession = Depends(get_read_session)) -> domain.User:
     try:
-        result = await session.exec(select(db.User).where(db.User.ref_code == user_id).limit(1))
+        result = await session.exec(select(db.User).where(_user_filter(user_id)).order_by(db.User.sid).limit(1).options(defer(db.User.refs)))
         db_user = result.one()
         await session.commit()
 
-        return _convert_from_db_user(db_user)
+        return ModelResponse(_convert_from_db_user(db_user))
     except NoResultFound:
         raise HTTPException(status_code=404, detail="user not found")
     
-@router.post("/users", tags=["users"])
+@router.post("/users", tags=["users"], dependencies=[Depends(idempotency.key)])
 async def post_user(user: domain.CreateUser, session: AsyncSession = Depends(get_session)) -> domain.User:
-    scalar_result = await session.exec(select(db.User).where(db.User.ref_code == user.user_id).limit(1))
+    # refs is never read here and can be large on legacy rows
+    scalar_result = await session.exec(select(db.User).where(_user_filter(user.user_id)).order_by(db.User.sid).limit(1).options(defer(db.User.refs)))
     db_user = scalar_result.one_or_none()
+    referrer = None
     if not db_user:
         db_user = db.User()
         db_user.sid = uuid4()
         db_user.username = user.username
         db_user.ref_code = user.user_id
+        db_user.tg_id = domain.telegram_id(user.user_id)
         db_user.refs = {"id": []}
         db_user.score = 25
         db_user.last_score = 0
@@ -47,33 +56,110 @@ async def post_user(user: domain.CreateUser, session: AsyncSession = Depends(get
 
         ref_score = db.ReferalScore(username=user.user_id, score=0)
         session.add(ref_score)
+        invalidation.publish(session, 'written', user.user_id)
 
         if user.ref_code:
-            stmt = select(db.User).where(db.User.ref_code == user.ref_code).limit(1)
-            scalar_result = await session.exec(stmt)
-            for ref_user in scalar_result:
-                ref_user.refs['id'].append(user.user_id)
-                flag_modified(ref_user, 'refs')
-                if user.premium:
-                    ref_user.tickets += 3
-                    ref_user.score += 50
-                else:
-                    ref_user.tickets += 1
-                session.add(ref_user)
+            referrer = await _add_referral(user, session)
+            if referrer is not None and referrer.tg_id is not None:
+                invalidation.publish(session, 'written', referrer.tg_id)
 
+        # only new users and rewarded referrers change a ranking; logins publish nothing
+        for ranked in (db_user, referrer):
+            if ranked is not None and ranked.tg_id is not None:
+                invalidation.publish(session, 'rank', domain.LeaderboardKind.coins, ranked.tg_id, ranked.score, ranked.username)
     await session.commit()
-    return _convert_from_db_user(db_user)
+    return ModelResponse(_convert_from_db_user(db_user))
+
+
+@router.get("/users/{user_id}/referrals", tags=["users"])
+async def get_referrals(user_id: str, limit: int = Query(MAX_REFERRALS_PAGE, ge=1, le=MAX_REFERRALS_PAGE),
+                        before: int | None = None, session: AsyncSession = Depends(get_read_session)) -> domain.Referrals:
+    try:
+        referrer_scalar = await session.exec(
+            select(db.User.sid, db.ReferralCount.total, db.ReferralCount.premium)
+                .outerjoin(db.ReferralCount, db.ReferralCount.referrer_sid == db.User.sid)
+                .where(_user_filter(user_id))
+                .order_by(db.User.sid)
+                .limit(1)
+        )
+        referrer_sid, total, premium = referrer_scalar.one()
+    except NoResultFound:
+        raise HTTPException(status_code=404, detail="user not found")
+
+    # newest first, paged by id so deep pages cost the same as the first
+    page = select(db.Referral.id, db.Referral.ref_code, db.Referral.premium).where(db.Referral.referrer_sid == referrer_sid)
+    if before is not None:
+        page = page.where(db.Referral.id < before)
+    referrals_scalar = await session.exec(page.order_by(db.Referral.id.desc()).limit(limit))
+    rows = referrals_scalar.all()
 
+    return ModelResponse(domain.Referrals(
+        total=total or 0,
+        premium=premium or 0,
+        referrals=[domain.Referral(user_id=ref_code, premium=ref_premium) for _, ref_code, ref_premium in rows],
+        before=rows[-1][0] if len(rows) == limit else None,
+    ))
 
 @router.post("/stars", tags=["users"])
 async def get_stars_link(energy: domain.GetEnergy) -> domain.GetEnergyResponse:
-    if int(energy.energy) == 3:
-        return domain.GetEnergyResponse(link='https://t.me/$26bVqEyvAEgMDAAAE9PgYRT5beM')
-    if int(energy.energy) == 10:
-        return domain.GetEnergyResponse(link='https://t.me/$pf0nqUyvAEgNDAAAaucf4pF3ym0')
-    if int(energy.energy) == 20:
-        return domain.GetEnergyResponse(link='https://t.me/$8ZFX2kyvAEgODAAA5JJk44q2OrM')
-    raise HTTPException(status_code=400, detail="invalid energy amount")
+    link = STARS_LINKS.get(int(energy.energy))
+    if link is None:
+        raise HTTPException(status_code=400, detail="invalid energy amount")
+    return ModelResponse(link)
+
+# invoice links per energy amount, serialized once
+STARS_LINKS = {
+    energy: domain.GetEnergyResponse(link=link).model_dump_json().encode()
+    for energy, link in {
+        3: 'https://t.me/$26bVqEyvAEgMDAAAE9PgYRT5beM',
+        10: 'https://t.me/$pf0nqUyvAEgNDAAAaucf4pF3ym0',
+        20: 'https://t.me/$8ZFX2kyvAEgODAAA5JJk44q2OrM',
+    }.items()
+}
+
+async def _add_referral(user: domain.CreateUser, session: AsyncSession) -> Row | None:
+    """Records the edge to the referrer and rewards them; returns the rewarded referrer"""
+    premium = bool(user.premium)
+    edge_result = await session.exec(
+        insert(db.Referral)
+            .from_select(
+                ['referrer_sid', 'ref_code', 'premium', 'ts_created'],
+                select(db.User.sid, literal(user.user_id), literal(premium), literal(datetime.now(timezone.utc)))
+                    .where(_user_filter(user.ref_code))
+                    .order_by(db.User.sid)
+                    .limit(1),
+            )
+            .on_conflict_do_nothing()
+            .returning(db.Referral.referrer_sid)
+    )
+    referrer_sid = edge_result.scalar_one_or_none()
+    if referrer_sid is None:
+        return None # unknown referrer or already counted
+
+    count_insert = insert(db.ReferralCount).values(referrer_sid=referrer_sid, total=1, premium=int(premium))
+    await session.exec(count_insert.on_conflict_do_update(
+        index_elements=[db.ReferralCount.referrer_sid],
+        set_={'total': db.ReferralCount.total + 1, 'premium': db.ReferralCount.premium + int(premium)},
+    ))
+
+    if premium:
+        await ledger.apply(session, {referrer_sid: 50}, db.CoinReason.referral, key='sid')
+    reward_result = await session.exec(
+        update(db.User)
+            .where(db.User.sid == referrer_sid)
+            .values(tickets=func.coalesce(db.User.tickets, 0) + (3 if premium else 1))
+            .returning(db.User.tg_id, db.User.username, db.User.score)
+            .execution_options(synchronize_session=False)
+    )
+    return reward_result.one()
+
+def _user_filter(user_id: str):
+    # legacy rows may share a ref_code; callers take the lowest sid, like app.ledger
+    # ref_code holds the telegram id as text; numeric ids go through the indexed tg_id key
+    tg_id = domain.telegram_id(user_id)
+    if tg_id is not None:
+        return db.User.tg_id == tg_id
+    return db.User.ref_code == user_id
 
 def _convert_from_db_user(user: db.User) -> domain.User:
     # original algorithm as is
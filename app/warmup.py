@@ -0,0 +1,79 @@
+"""Startup work done by the lifespan before the app takes traffic
+
+Opens pool connections up front, prepares the hot read statements on each
+of them and loads the in-process opponent pool and leaderboards, so the
+first requests of a new worker do not pay for any of it.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from contextlib import AsyncExitStack
+
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.orm import defer, load_only
+from sqlmodel import select
+
+from . import matchmaking
+from .database import engine, env_flag, session_factory
+from .leaderboard import leaderboards
+from .models import db
+from .routers.pvp import COMPETITIONER_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+
+ENABLED = env_flag('BROAPI_WARMUP', True)
+# capped at pool_size, connections beyond it are closed when returned
+CONNECTIONS = os.getenv('BROAPI_WARMUP_CONNECTIONS')
+
+# the reads of the busiest routes, built like the routers build them; asyncpg
+# keeps prepared statements per connection by SQL text, so any missing here
+# are prepared on first use as before
+_NO_ID = -1
+HOT_STATEMENTS = (
+    # get_character
+    select(db.PVPCharacter).where(db.PVPCharacter.user_id == _NO_ID),
+    # get_user, post_user
+    select(db.User).where(db.User.tg_id == _NO_ID).order_by(db.User.sid).limit(1).options(defer(db.User.refs)),
+    # level_up; its balance change is app.ledger's text statement, prepared on first use
+    select(db.PVPCharacter).where(db.PVPCharacter.user_id == _NO_ID)
+        .options(load_only(db.PVPCharacter.abilities))
+        .with_for_update(),
+    # search_match
+    select(db.PVPCharacter).where(db.PVPCharacter.user_id == _NO_ID).options(load_only(*COMPETITIONER_COLUMNS)),
+    select(db.PVPMatch).where(db.PVPMatch.player_id == _NO_ID, db.PVPMatch.ts_finished == None),
+)
+
+
+async def _prepare(connection: AsyncConnection):
+    for statement in HOT_STATEMENTS:
+        await connection.execute(statement)
+    await connection.rollback()
+
+
+async def open_connections(count: int):
+    """Holds count pool connections at once, preparing HOT_STATEMENTS on each"""
+    async with AsyncExitStack() as stack:
+        connections = [await stack.enter_async_context(engine.connect()) for _ in range(count)]
+        await asyncio.gather(*(_prepare(connection) for connection in connections))
+
+
+async def run():
+    if not ENABLED:
+        return
+
+    started = time.monotonic()
+    pool_size = engine.sync_engine.pool.size()
+    count = min(int(CONNECTIONS), pool_size) if CONNECTIONS is not None else pool_size
+    await open_connections(count)
+
+    async with session_factory() as session:
+        await matchmaking.pool.refresh(session, force=True)
+        await leaderboards.refresh(session)
+
+    logger.info(
+        "warmed up in %.2fs: %d connections, %d characters in the opponent pool",
+        time.monotonic() - started, count, len(matchmaking.pool),
+    )
@@ -0,0 +1,251 @@
+"""Async load benchmark over every API route
+
+Drives the FastAPI app in process against the database prepared by
+bench.seed and reports throughput, latency percentiles and SQL statements
+per request for each route:
+
+    python -m bench.load --duration 30 --concurrency 64 --save bench/baseline.json
+    python -m bench.load --duration 30 --concurrency 64 --compare bench/baseline.json
+
+Every virtual user plays its own slice of the seeded ids through a login,
+profile, levelup and match flow. Client and app share one event loop, so
+latencies are for comparing runs on the same machine, not absolute.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+from collections import Counter, defaultdict
+
+import httpx
+
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.models import db
+
+PREFIX = '/api/v1'
+ORIGIN = 'http://bench.local'
+ABILITIES = ('strength', 'defence', 'speed', 'weight', 'combinations')
+SKIP_SHARE = 0.3 # of found matches are skipped before starting
+
+SQL_TOLERANCE = 0.1
+LATENCY_TOLERANCE = 0.25
+
+# statements executed by the request running in the current context
+_statements: contextvars.ContextVar[list[str] | None] = contextvars.ContextVar('statements', default=None)
+
+
+class RouteStats:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.statements: list[int] = []
+        self.statuses: Counter[int] = Counter()
+
+    def summary(self, duration: float) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            'requests': len(latencies),
+            'rps': round(len(latencies) / duration, 1),
+            'p50_ms': _percentile(latencies, 50),
+            'p95_ms': _percentile(latencies, 95),
+            'p99_ms': _percentile(latencies, 99),
+            'sql_per_request': round(statistics.fmean(self.statements), 2) if self.statements else 0,
+            'sql_max': max(self.statements, default=0),
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+        }
+
+
+def _percentile(latencies: list[float], percent: int) -> float:
+    if not latencies:
+        return 0.0
+    index = min(len(latencies) - 1, round(percent / 100 * (len(latencies) - 1)))
+    return round(latencies[index] * 1000, 2)
+
+
+class Recorder:
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.routes: defaultdict[str, RouteStats] = defaultdict(RouteStats)
+        self.recording = False
+
+    async def call(self, method: str, route: str, path: str, **kwargs) -> httpx.Response:
+        statements = []
+        token = _statements.set(statements)
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, PREFIX + path, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            _statements.reset(token)
+
+        if self.recording:
+            stats = self.routes[f'{method} {route}']
+            stats.latencies.append(elapsed)
+            stats.statements.append(len(statements))
+            stats.statuses[response.status_code] += 1
+        return response
+
+
+async def _play(recorder: Recorder, user_id: int):
+    """One pass of a player through every route"""
+    call = recorder.call
+    await call('POST', '/users', '/users', json={'user_id': str(user_id), 'username': f'bro{user_id}'})
+    await call('GET', '/users/{user_id}', f'/users/{user_id}')
+    await call('GET', '/users/{user_id}/character', f'/users/{user_id}/character')
+    await call('GET', '/users/{user_id}/levelup', f'/users/{user_id}/levelup')
+    await call('POST', '/users/{user_id}/levelup', f'/users/{user_id}/levelup', json={random.choice(ABILITIES): 1})
+
+    response = await call('POST', '/users/{user_id}/pvp', f'/users/{user_id}/pvp')
+    if response.status_code == 200:
+        match_id = response.json()['match_id']
+        if random.random() < SKIP_SHARE:
+            await call('POST', '/pvp/{match_id}/skip', f'/pvp/{match_id}/skip')
+        await call('POST', '/pvp/{match_id}/start', f'/pvp/{match_id}/start')
+
+    await call('GET', '/users/{user_id}/rank', f'/users/{user_id}/rank', params={'board': random.choice(['coins', 'power'])})
+    await call('GET', '/leaderboard', '/leaderboard', params={'limit': 20})
+    await call('POST', '/characters:batchGet', '/characters:batchGet', json={'user_ids': list(range(user_id, user_id + 20))})
+    await call('POST', '/stars', '/stars', json={'energy': random.choice([3, 10, 20])})
+
+
+async def _virtual_user(recorder: Recorder, user_ids: list[int], deadline: float):
+    while time.monotonic() < deadline:
+        for user_id in user_ids:
+            if time.monotonic() >= deadline:
+                return
+            await _play(recorder, user_id)
+
+
+async def _population(dsn: str) -> int:
+    engine = create_async_engine(dsn)
+    try:
+        async with engine.connect() as conn:
+            return (await conn.execute(select(func.max(db.PVPCharacter.user_id)))).scalar_one() or 0
+    finally:
+        await engine.dispose()
+
+
+async def run(dsn: str, duration: float, warmup: float, concurrency: int) -> dict:
+    users = await _population(dsn)
+    if users < concurrency:
+        raise SystemExit(f"seeded population of {users} is smaller than the concurrency; run bench.seed first")
+
+    # the app reads its settings on import
+    os.environ['BROAPI_DB_DSN'] = dsn
+    os.environ.setdefault('BROAPI_ALLOW_ORIGINS', ORIGIN)
+    from app.database import engine
+    from app.main import app
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements = _statements.get()
+        if statements is not None:
+            statements.append(statement)
+
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    headers = {'Origin': os.environ['BROAPI_ALLOW_ORIGINS'].split(',')[0]}
+    async with app.router.lifespan_context(app), \
+            httpx.AsyncClient(transport=transport, base_url='http://bench', headers=headers) as client:
+        recorder = Recorder(client)
+        user_ids = list(range(1, users + 1))
+        random.shuffle(user_ids)
+        slices = [user_ids[worker::concurrency] for worker in range(concurrency)]
+
+        started = time.monotonic()
+        deadline = started + warmup + duration
+        workers = [asyncio.create_task(_virtual_user(recorder, slice_, deadline)) for slice_ in slices]
+
+        await asyncio.sleep(warmup)
+        recorder.recording = True
+        recorded_from = time.monotonic()
+        await asyncio.gather(*workers)
+        elapsed = time.monotonic() - recorded_from
+
+    await engine.dispose()
+
+    routes = {route: stats.summary(elapsed) for route, stats in sorted(recorder.routes.items())}
+    total = RouteStats()
+    for stats in recorder.routes.values():
+        total.latencies += stats.latencies
+        total.statements += stats.statements
+        total.statuses.update(stats.statuses)
+
+    return {
+        'config': {'users': users, 'concurrency': concurrency, 'duration': duration, 'warmup': warmup, 'cpus': os.cpu_count()},
+        'total': total.summary(elapsed),
+        'routes': routes,
+    }
+
+
+def report(results: dict, baseline: dict | None = None) -> list[str]:
+    """Prints the results table; returns the regressions against the baseline"""
+    header = f"{'route':<34} {'req':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'sql/req':>8}  statuses"
+    print(header)
+    print('-' * len(header))
+
+    regressions = []
+    rows = [*results['routes'].items(), ('total', results['total'])]
+    for route, row in rows:
+        line = f"{route:<34} {row['requests']:>7} {row['rps']:>8} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8} " \
+            f"{row['sql_per_request']:>8}  {' '.join(f'{status}:{count}' for status, count in row['statuses'].items())}"
+        print(line)
+
+        if baseline is None:
+            continue
+        previous = baseline['total'] if route == 'total' else baseline['routes'].get(route)
+        if previous is None:
+            continue
+        print(f"{'  baseline':<34} {previous['requests']:>7} {previous['rps']:>8} {previous['p50_ms']:>8} "
+              f"{previous['p95_ms']:>8} {previous['p99_ms']:>8} {previous['sql_per_request']:>8}")
+        regressions += _regressions(route, row, previous)
+    return regressions
+
+
+def _regressions(route: str, row: dict, previous: dict) -> list[str]:
+    found = []
+    # statement counts are deterministic per code path, a small rise is already a change
+    if row['sql_per_request'] > previous['sql_per_request'] + SQL_TOLERANCE:
+        found.append(f"{route}: {previous['sql_per_request']} -> {row['sql_per_request']} statements per request")
+    if previous['p95_ms'] and row['p95_ms'] > previous['p95_ms'] * (1 + LATENCY_TOLERANCE):
+        found.append(f"{route}: p95 {previous['p95_ms']} -> {row['p95_ms']} ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--duration', type=float, default=30, help='recorded seconds')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds run before recording')
+    parser.add_argument('--concurrency', type=int, default=64, help='virtual users')
+    parser.add_argument('--save', help='write the results as a baseline JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare with; exits 1 on regressions')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(os.environ['BROAPI_BENCH_DSN'], args.duration, args.warmup, args.concurrency))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+    if regressions:
+        print('\nregressions against the baseline:')
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
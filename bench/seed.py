@@ -0,0 +1,126 @@
+"""Synthetic population for the load benchmarks
+
+Drops and recreates the schema in BROAPI_BENCH_DSN, applies migrations/
+and fills it with users, characters and finished matches:
+
+    python -m bench.seed --users 100000 --matches 5
+"""
+import argparse
+import asyncio
+import os
+import pathlib
+import re
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+
+from app.models import db, domain
+
+MIGRATIONS = pathlib.Path(__file__).resolve().parent.parent / 'migrations'
+ABILITY_LEVEL_MAX = 20
+CHARACTER_LEVEL_MAX = len(domain.exp_table) - 1
+
+
+def _statements(sql: str) -> list[str]:
+    """Split a migration into statements, keeping $$ bodies whole"""
+    statements, current = [], ''
+    for chunk in re.split(r'(;)', re.sub(r'^\s*--.*$', '', sql, flags=re.MULTILINE)):
+        current += chunk
+        if chunk == ';' and current.count('$$') % 2 == 0:
+            statements.append(current.strip())
+            current = ''
+    if current.strip():
+        statements.append(current.strip())
+    return [statement for statement in statements if statement != ';']
+
+
+async def create_schema(engine):
+    async with engine.begin() as conn:
+        await conn.execute(text('DROP SCHEMA IF EXISTS pvp CASCADE'))
+        await conn.execute(text('DROP TABLE IF EXISTS users, referals_score, referrals, referral_counts, coin_ledger, idempotency_keys CASCADE'))
+        await conn.execute(text('CREATE SCHEMA pvp'))
+        await conn.run_sync(SQLModel.metadata.create_all)
+        for model in (db.PVPCharacter, db.PVPMatch, db.PVPNotification):
+            await conn.run_sync(model.metadata.create_all)
+
+    # CREATE INDEX CONCURRENTLY must run outside a transaction
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+        for path in sorted(MIGRATIONS.glob('*.sql')):
+            for statement in _statements(path.read_text()):
+                await conn.exec_driver_sql(statement)
+            print(f"applied {path.name}")
+
+
+async def populate(engine, users: int, matches: int, premium: float):
+    abilities = list(domain._coeffecients)
+    async with engine.begin() as conn:
+        await conn.execute(text('''
+            INSERT INTO users (sid, username, ref_code, tg_id, refs, score, last_score, energy, tickets, boxes,
+                               ton_balanse, mining_claim, last_tap, last_login, reward_streak, region, advertising_limit)
+            SELECT gen_random_uuid(), 'bro' || i, i::text, i, '{"id": []}', floor(random() * 100000)::int, 0, 1000, 25, 0,
+                   0, true, now(), now(), 1, 'eng', 10
+            FROM generate_series(1, :users) AS i
+        '''), dict(users=users))
+        print(f"inserted {users} users")
+
+        # energy_boost keeps every attacker able to start matches for the whole run
+        await conn.execute(text(f'''
+            WITH rolled AS (
+                SELECT i, {', '.join(f'1 + floor(random() * :ability_max)::int AS {name}' for name in abilities)},
+                       floor(random() * random() * (:level_max + 1))::int AS level
+                FROM generate_series(1, :users) AS i
+            )
+            INSERT INTO pvp.characters (user_id, username, ts_updated, ts_premium_until, abilities, level, experience, power,
+                                        ts_last_match, energy_last_match, energy_max, energy_boost, ts_defences_today,
+                                        stats_total, stats_won, stats_loot)
+            SELECT i, 'bro' || i, now() - random() * interval '30 days', CASE WHEN random() < :premium THEN now() + interval '30 days' END,
+                   jsonb_build_object({', '.join(f"'{name}', {name}" for name in abilities)}),
+                   level, 0, {' + '.join(f'{name} * {coeff}' for name, coeff in domain._coeffecients.items())},
+                   now(), 2, 2, 1000000, 0, 0, 0, 0
+            FROM rolled
+        '''), dict(users=users, ability_max=ABILITY_LEVEL_MAX, level_max=CHARACTER_LEVEL_MAX, premium=premium))
+        print(f"inserted {users} characters")
+
+        await conn.execute(text('''
+            WITH played AS (
+                SELECT i AS player_id, 1 + floor(random() * :users)::bigint AS opponent_id, random() < 0.5 AS won,
+                       now() - random() * interval '30 days' AS ts
+                FROM generate_series(1, :users) AS i, generate_series(1, :matches) AS m
+            )
+            INSERT INTO pvp.matches (uuid, ts_created, ts_updated, player_id, opponent_id, ts_finished, result, loot, stats)
+            SELECT gen_random_uuid(), ts, ts, player_id, opponent_id, ts,
+                   CASE WHEN won THEN 'win' ELSE 'lose' END::pvp.match_result,
+                   jsonb_build_object('coins', CASE WHEN won THEN 150 ELSE -30 END), '{}'
+            FROM played
+            WHERE player_id != opponent_id
+        '''), dict(users=users, matches=matches))
+        print(f"inserted up to {users * matches} matches")
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+        await conn.exec_driver_sql('ANALYZE')
+
+
+async def seed(dsn: str, users: int, matches: int, premium: float):
+    engine = create_async_engine(dsn)
+    try:
+        await create_schema(engine)
+        await populate(engine, users, matches, premium)
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--matches', type=int, default=5, help='finished matches per user')
+    parser.add_argument('--premium', type=float, default=0.1, help='share of premium characters')
+    args = parser.parse_args()
+
+    asyncio.run(seed(os.environ['BROAPI_BENCH_DSN'], args.users, args.matches, args.premium))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Offline battle simulator for balancing
+
+Vectorized re-implementation of the combat model in
+app.routers.pvp._calculate_match_result and the coin rule in
+app.routers.pvp._calc_coins_gain_loss. It evaluates millions of matchups at
+once and reports win rates and coin flows without touching the database.
+
+    python -m bench.simulation --players 100000 --matches 5000000
+
+Needs numpy (pip install numpy), which is not a dependency of the service
+and is not in requirements.txt.
+Balances are a static snapshot: coins won in one simulated match do not
+feed into the next one.
+"""
+import argparse
+
+from dataclasses import dataclass
+
+import numpy as np
+
+from app.models import domain
+
+ABILITIES = ('strength', 'defence', 'speed', 'weight', 'combinations')
+COEFFICIENTS = np.array([domain._coeffecients[ability] for ability in ABILITIES])
+
+# alpha_table in ascending treshold order for np.searchsorted; nan marks the auto-win
+_TRESHOLDS = np.array([treshold for treshold, _ in reversed(domain.alpha_table)])
+_ALPHAS = np.array([np.nan if alpha is None else alpha for _, alpha in reversed(domain.alpha_table)])
+_ALPHA_BELOW_TRESHOLDS = 5.000
+
+
+@dataclass
+class Population:
+    abilities: np.ndarray # (n, 5) ability levels in ABILITIES order
+    levels: np.ndarray    # (n,) character level
+    scores: np.ndarray    # (n,) coin balance
+
+    def __len__(self) -> int:
+        return len(self.levels)
+
+    @property
+    def power(self) -> np.ndarray:
+        return self.abilities @ COEFFICIENTS
+
+    @classmethod
+    def sample(cls, size: int, rng: np.random.Generator, ability_mean: float = 3.0, ability_spread: float = 0.6,
+               level_weights: list[float] | None = None, score_mean: float = 5000.0) -> 'Population':
+        """Random population with log-normal ability levels and exponential balances"""
+        abilities = np.maximum(1, np.rint(rng.lognormal(np.log(ability_mean), ability_spread, (size, len(ABILITIES)))))
+
+        if level_weights is None:
+            level_weights = [0.5 ** level for level in range(len(domain.exp_table))]
+        weights = np.asarray(level_weights, dtype=float)
+        levels = rng.choice(len(weights), size=size, p=weights / weights.sum())
+
+        scores = np.floor(rng.exponential(score_mean, size))
+        return cls(abilities=abilities.astype(np.int64), levels=levels.astype(np.int64), scores=scores.astype(np.int64))
+
+
+def win_probability(attacker_power: np.ndarray, defender_power: np.ndarray) -> np.ndarray:
+    """Probability that the attacker wins, vectorized over matchups"""
+    attacker_power, defender_power = np.floor(attacker_power), np.floor(defender_power)
+
+    # ties make the defender the champion, as in _calculate_match_result
+    attacker_is_champion = attacker_power > defender_power
+    champion = np.where(attacker_is_champion, attacker_power, defender_power)
+    contestant = np.where(attacker_is_champion, defender_power, attacker_power)
+
+    gap = champion / contestant - 1
+    index = np.searchsorted(_TRESHOLDS, gap, side='right') - 1
+    alpha = np.where(index >= 0, _ALPHAS[np.maximum(index, 0)], _ALPHA_BELOW_TRESHOLDS)
+
+    with np.errstate(invalid='ignore'):
+        p = champion * (1 + (champion - contestant) / champion) ** alpha / (champion + contestant)
+    p = np.where(np.isnan(alpha), 1.0, p)
+
+    return np.where(attacker_is_champion, p, 1 - p)
+
+
+def coins_gain_loss(loser_levels: np.ndarray, loser_scores: np.ndarray, coeff: float = 0.05) -> tuple[np.ndarray, np.ndarray]:
+    """Winner gain and loser loss, vectorized _calc_coins_gain_loss"""
+    amount = np.floor(np.maximum(0, loser_scores) * coeff)
+    gain = np.select([loser_levels == 0, loser_levels == 1], [150, 250], amount)
+    loss = np.select([loser_levels == 0, loser_levels == 1], [-30, -50], -amount)
+    return gain, loss
+
+
+def matchups(population: Population, size: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    """Random attacker/defender index pairs within the matchmaking level window"""
+    levels = population.levels
+    attackers, defenders = np.empty(0, np.int64), np.empty(0, np.int64)
+    # rejection sampling; a few rounds are enough unless the level window is nearly empty
+    for _ in range(64):
+        missing = size - len(attackers)
+        if missing <= 0:
+            break
+        a = rng.integers(0, len(population), missing * 2)
+        d = rng.integers(0, len(population), missing * 2)
+
+        min_level = np.where(levels[a] <= 2, np.minimum(levels[a], 1), levels[a] - 2)
+        valid = (a != d) & (levels[d] >= min_level) & (levels[d] <= levels[a] + 2)
+        attackers = np.concatenate([attackers, a[valid][:missing]])
+        defenders = np.concatenate([defenders, d[valid][:missing]])
+    return attackers, defenders
+
+
+@dataclass
+class SimulationResult:
+    attacker_levels: np.ndarray
+    defender_levels: np.ndarray
+    power_ratio: np.ndarray
+    attacker_won: np.ndarray
+    attacker_coins: np.ndarray
+    defender_coins: np.ndarray
+
+
+def simulate(population: Population, matches: int, rng: np.random.Generator, coeff: float = 0.05) -> SimulationResult:
+    attackers, defenders = matchups(population, matches, rng)
+    power = population.power
+
+    p = win_probability(power[attackers], power[defenders])
+    attacker_won = rng.random(len(p)) <= p
+
+    gain_on_win, loss_on_win = coins_gain_loss(population.levels[defenders], population.scores[defenders], coeff)
+    gain_on_lose, loss_on_lose = coins_gain_loss(population.levels[attackers], population.scores[attackers], coeff)
+
+    return SimulationResult(
+        attacker_levels=population.levels[attackers],
+        defender_levels=population.levels[defenders],
+        power_ratio=np.floor(power[attackers]) / np.floor(power[defenders]),
+        attacker_won=attacker_won,
+        attacker_coins=np.where(attacker_won, gain_on_win, loss_on_lose),
+        defender_coins=np.where(attacker_won, loss_on_win, gain_on_lose),
+    )
+
+
+def win_rate_by_power_ratio(result: SimulationResult, edges: np.ndarray) -> list[tuple[float, float, int, float]]:
+    """(ratio from, ratio to, matches, attacker win rate) per attacker/defender power ratio bucket"""
+    bucket = np.digitize(result.power_ratio, edges)
+    counts = np.bincount(bucket, minlength=len(edges) + 1)
+    wins = np.bincount(bucket, weights=result.attacker_won, minlength=len(edges) + 1)
+
+    bounds = np.concatenate([[0.0], edges, [np.inf]])
+    return [
+        (bounds[i], bounds[i + 1], int(counts[i]), wins[i] / counts[i])
+        for i in range(len(counts)) if counts[i]
+    ]
+
+
+def level_table(result: SimulationResult, values: np.ndarray) -> np.ndarray:
+    """Mean of `values` per (attacker level, defender level); nan where no matches"""
+    size = int(max(result.attacker_levels.max(), result.defender_levels.max())) + 1
+    cell = result.attacker_levels * size + result.defender_levels
+    counts = np.bincount(cell, minlength=size * size)
+    sums = np.bincount(cell, weights=values, minlength=size * size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).reshape(size, size)
+
+
+def _print_level_table(title: str, table: np.ndarray, fmt: str):
+    print(f'\n{title} (rows: attacker level, columns: defender level)')
+    print('     ' + ''.join(f'{level:>9}' for level in range(table.shape[1])))
+    for level, row in enumerate(table):
+        print(f'{level:>5}' + ''.join(f'{"-":>9}' if np.isnan(value) else f'{value:>9{fmt}}' for value in row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--players', type=int, default=100_000)
+    parser.add_argument('--matches', type=int, default=1_000_000)
+    parser.add_argument('--ability-mean', type=float, default=3.0)
+    parser.add_argument('--ability-spread', type=float, default=0.6)
+    parser.add_argument('--score-mean', type=float, default=5000.0)
+    parser.add_argument('--coeff', type=float, default=0.05, help='share of the loser balance at stake')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    population = Population.sample(args.players, rng, args.ability_mean, args.ability_spread, score_mean=args.score_mean)
+    result = simulate(population, args.matches, rng, args.coeff)
+
+    print(f'{len(result.attacker_won)} matches, attacker win rate {result.attacker_won.mean():.4f}')
+
+    print('\nattacker/defender power ratio    matches   win rate')
+    edges = np.array([0.5, 0.67, 0.8, 0.9, 0.95, 1.0, 1.05, 1.1, 1.25, 1.5, 2.0, 2.5])
+    for ratio_from, ratio_to, count, win_rate in win_rate_by_power_ratio(result, edges):
+        print(f'{ratio_from:>8.2f} .. {ratio_to:<8.2f}          {count:>10} {win_rate:>10.4f}')
+
+    _print_level_table('attacker win rate', level_table(result, result.attacker_won), '.3f')
+    _print_level_table('mean attacker coins per match', level_table(result, result.attacker_coins), '.1f')
+    _print_level_table('mean coins created per match', level_table(result, result.attacker_coins + result.defender_coins), '.1f')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2 @@
+-- incremental refresh of the in-memory opponent pool (app/matchmaking.py)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS characters_ts_updated_idx ON pvp.characters (ts_updated);
@@ -0,0 +1,5 @@
+-- materialized pvp stats; fill existing rows with `python -m app.jobs.backfill_stats`
+ALTER TABLE pvp.characters
+    ADD COLUMN IF NOT EXISTS stats_total integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS stats_won integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS stats_loot bigint NOT NULL DEFAULT 0;
@@ -0,0 +1,24 @@
+-- numeric telegram id key on users; pvp.characters.user_id joins on it
+ALTER TABLE users ADD COLUMN IF NOT EXISTS tg_id bigint;
+
+-- rows are also written by the bot, which only knows ref_code
+CREATE OR REPLACE FUNCTION users_set_tg_id() RETURNS trigger AS $$
+BEGIN
+    IF NEW.ref_code ~ '^[0-9]{1,18}$' THEN
+        NEW.tg_id := NEW.ref_code::bigint;
+    ELSE
+        NEW.tg_id := NULL;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_set_tg_id ON users;
+CREATE TRIGGER users_set_tg_id BEFORE INSERT OR UPDATE OF ref_code ON users
+    FOR EACH ROW EXECUTE FUNCTION users_set_tg_id();
+
+UPDATE users SET tg_id = ref_code::bigint
+WHERE tg_id IS NULL AND ref_code ~ '^[0-9]{1,18}$';
+
+-- not unique: legacy rows may share a ref_code, lookups keep LIMIT 1
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_tg_id_idx ON users (tg_id);
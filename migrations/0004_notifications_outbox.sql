@@ -0,0 +1,10 @@
+-- durable outbox for telegram notifications, used with BROAPI_NOTIFICATIONS_OUTBOX=1
+CREATE TABLE IF NOT EXISTS pvp.notifications (
+    id bigserial PRIMARY KEY,
+    chat_id bigint NOT NULL,
+    payload jsonb NOT NULL,
+    ts_created timestamptz NOT NULL,
+    ts_claimed timestamptz NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS notifications_ts_claimed_idx ON pvp.notifications (ts_claimed);
@@ -0,0 +1,48 @@
+-- monthly range partitions of pvp.matches by ts_created. Copies the table, so run it in a
+-- maintenance window; afterwards keep partitions rolling with `python -m app.jobs.archive_matches`.
+-- The old table stays as pvp.matches_unpartitioned until dropped by hand.
+DO $$
+DECLARE
+    month timestamptz;
+    last_month timestamptz;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'pvp.matches'::regclass) THEN
+        RETURN;
+    END IF;
+
+    -- partition bounds are whole UTC months, as in app/jobs/archive_matches.py
+    PERFORM set_config('timezone', 'UTC', true);
+
+    CREATE TABLE pvp.matches_partitioned (LIKE pvp.matches INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+        PARTITION BY RANGE (ts_created);
+    ALTER TABLE pvp.matches_partitioned ADD PRIMARY KEY (uuid, ts_created);
+
+    SELECT least(date_trunc('month', min(ts_created)), date_trunc('month', now()) - interval '1 month')
+        INTO month FROM pvp.matches;
+    last_month := date_trunc('month', now()) + interval '3 months';
+    WHILE month <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE pvp.%I PARTITION OF pvp.matches_partitioned FOR VALUES FROM (%L) TO (%L)',
+            'matches_' || to_char(month, 'YYYY_MM'), month, month + interval '1 month'
+        );
+        month := month + interval '1 month';
+    END LOOP;
+
+    INSERT INTO pvp.matches_partitioned SELECT * FROM pvp.matches;
+
+    -- search_match: the open match of a player; most matches are finished, so these stay small
+    CREATE INDEX matches_open_player_idx ON pvp.matches_partitioned (player_id) WHERE ts_finished IS NULL;
+    -- start_match: has the player attacked before
+    CREATE INDEX matches_player_idx ON pvp.matches_partitioned (player_id);
+
+    ALTER TABLE pvp.matches RENAME TO matches_unpartitioned;
+    ALTER TABLE pvp.matches_partitioned RENAME TO matches;
+END;
+$$;
+
+-- per player summary of detached partitions, so a first match stays a first match
+CREATE TABLE IF NOT EXISTS pvp.matches_archive (
+    player_id bigint PRIMARY KEY,
+    matches integer NOT NULL,
+    ts_last_finished timestamptz
+);
@@ -0,0 +1,9 @@
+-- schedule and run lock of the background maintenance jobs (app/maintenance.py)
+CREATE TABLE IF NOT EXISTS pvp.maintenance (
+    job varchar PRIMARY KEY,
+    ts_last_run timestamptz
+);
+
+-- expired reservations are cleared in the background, so only live ones stay in this index
+CREATE INDEX CONCURRENTLY IF NOT EXISTS characters_invulnerable_idx ON pvp.characters (ts_invulnerable_until)
+    WHERE ts_invulnerable_until IS NOT NULL;
@@ -0,0 +1,33 @@
+-- referrals as edges with per-referrer counts instead of the users.refs JSON array;
+-- post_user no longer appends to users.refs, the column is left for readers outside this service
+CREATE TABLE IF NOT EXISTS referrals (
+    id bigserial PRIMARY KEY,
+    referrer_sid uuid NOT NULL REFERENCES users (sid),
+    ref_code varchar NOT NULL,
+    premium boolean,
+    ts_created timestamptz,
+    UNIQUE (referrer_sid, ref_code)
+);
+
+CREATE INDEX IF NOT EXISTS referrals_referrer_idx ON referrals (referrer_sid, id);
+
+CREATE TABLE IF NOT EXISTS referral_counts (
+    referrer_sid uuid PRIMARY KEY REFERENCES users (sid),
+    total integer NOT NULL DEFAULT 0,
+    premium integer NOT NULL DEFAULT 0
+);
+
+INSERT INTO referrals (referrer_sid, ref_code)
+SELECT users.sid, entry.ref_code
+FROM users
+CROSS JOIN LATERAL json_array_elements_text(users.refs::json -> 'id') WITH ORDINALITY AS entry (ref_code, position)
+WHERE json_typeof(users.refs::json -> 'id') = 'array'
+ORDER BY users.sid, entry.position
+ON CONFLICT (referrer_sid, ref_code) DO NOTHING;
+
+-- recomputed from the edges, so running this again is harmless
+INSERT INTO referral_counts (referrer_sid, total, premium)
+SELECT referrer_sid, count(*), count(*) FILTER (WHERE premium)
+FROM referrals
+GROUP BY referrer_sid
+ON CONFLICT (referrer_sid) DO UPDATE SET total = excluded.total, premium = excluded.premium;
@@ -0,0 +1,16 @@
+-- append-only log of users.score changes (app/ledger.py); balances are not backfilled,
+-- the first entry of a user carries the balance it started from
+CREATE TABLE IF NOT EXISTS coin_ledger (
+    id bigserial PRIMARY KEY,
+    user_sid uuid NOT NULL REFERENCES users (sid),
+    delta integer NOT NULL,
+    balance integer NOT NULL,
+    reason varchar NOT NULL,
+    match_id uuid,
+    ts_created timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS coin_ledger_user_idx ON coin_ledger (user_sid, id);
+CREATE INDEX IF NOT EXISTS coin_ledger_ts_created_idx ON coin_ledger (ts_created);
+-- entries older than the retention are folded into this one row per user
+CREATE UNIQUE INDEX IF NOT EXISTS coin_ledger_compacted_idx ON coin_ledger (user_sid) WHERE reason = 'compacted';
@@ -0,0 +1,15 @@
+-- Idempotency-Key claims and stored responses shared by every worker (app/idempotency.py)
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    method varchar NOT NULL,
+    path varchar NOT NULL,
+    key varchar NOT NULL,
+    fingerprint varchar NOT NULL,
+    status_code integer,
+    body bytea,
+    media_type varchar,
+    ts_created timestamptz NOT NULL,
+    PRIMARY KEY (method, path, key)
+);
+
+-- expired keys are deleted by the expire_idempotency_keys maintenance job
+CREATE INDEX IF NOT EXISTS ix_idempotency_keys_ts_created ON idempotency_keys (ts_created);
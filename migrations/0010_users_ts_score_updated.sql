@@ -0,0 +1,19 @@
+-- incremental reconciliation of the in-memory leaderboards (app/leaderboard.py);
+-- set by a trigger since the bot also writes scores
+ALTER TABLE users ADD COLUMN IF NOT EXISTS ts_score_updated timestamptz NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION users_set_ts_score_updated() RETURNS trigger AS $$
+BEGIN
+    IF NEW.score IS DISTINCT FROM OLD.score OR NEW.username IS DISTINCT FROM OLD.username THEN
+        NEW.ts_score_updated := now();
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_set_ts_score_updated ON users;
+CREATE TRIGGER users_set_ts_score_updated BEFORE UPDATE OF score, username ON users
+    FOR EACH ROW EXECUTE FUNCTION users_set_ts_score_updated();
+
+-- deliberately not indexed: an index on a column every balance change writes would
+-- rule out HOT updates of users, and the reconciliation scan runs off the request path
@@ -0,0 +1,4 @@
+import os
+
+# app.database builds its engine at import; nothing here connects to it
+os.environ.setdefault('BROAPI_DB_DSN', 'postgresql+asyncpg://postgres@localhost/brocoin')
@@ -0,0 +1,77 @@
+from app import cache
+from app.cache import TTLCache
+
+
+def test_get_returns_what_was_set():
+    profiles = TTLCache(maxsize=10, ttl=30)
+    profiles.set(1, 'a')
+    assert profiles.get(1) == 'a'
+    assert profiles.get(2, 'missing') == 'missing'
+    assert (profiles.hits, profiles.misses) == (1, 1)
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    ts_now = 1000.0
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: ts_now)
+    profiles = TTLCache(maxsize=10, ttl=30)
+    profiles.set(1, 'a')
+
+    ts_now += 30
+    assert profiles.get(1) == 'a'
+    ts_now += 1
+    assert profiles.get(1) is None
+    assert len(profiles) == 0
+
+
+def test_least_recently_used_entries_are_evicted():
+    profiles = TTLCache(maxsize=3, ttl=30)
+    for key in (1, 2, 3):
+        profiles.set(key, str(key))
+    # reading 1 makes 2 the oldest
+    profiles.get(1)
+    profiles.set(4, '4')
+    assert len(profiles) == 3
+    assert profiles.get(2) is None
+    assert [profiles.get(key) for key in (1, 3, 4)] == ['1', '3', '4']
+
+
+def test_set_with_a_version_older_than_an_invalidate_is_ignored():
+    profiles = TTLCache(maxsize=10, ttl=30)
+    profiles.set(1, 'old')
+    # a reader observes the version, the row changes and is invalidated before it sets
+    version = profiles.version()
+    profiles.invalidate(1)
+    profiles.set(1, 'stale', version)
+    assert profiles.get(1) is None
+
+    # other keys are not affected by the invalidate
+    profiles.set(2, 'b', version)
+    assert profiles.get(2) == 'b'
+
+    # a read started after the invalidate is cached
+    profiles.set(1, 'new', profiles.version())
+    assert profiles.get(1) == 'new'
+
+
+def test_set_with_a_version_older_than_a_clear_is_ignored():
+    profiles = TTLCache(maxsize=10, ttl=30)
+    version = profiles.version()
+    profiles.clear()
+    profiles.set(1, 'stale', version)
+    profiles.set(2, 'b')
+    assert profiles.get(1) is None
+    assert profiles.get(2) == 'b'
+
+
+def test_invalidations_are_bounded_by_maxsize():
+    profiles = TTLCache(maxsize=2, ttl=30)
+    version = profiles.version()
+    profiles.invalidate(1, 2, 3)
+    assert list(profiles._invalidated) == [2, 3]
+    # the oldest invalidation was forgotten, versions from before it are refused for any key
+    profiles.set(1, 'stale', version)
+    profiles.set(4, 'stale', version)
+    assert profiles.get(1) is None
+    assert profiles.get(4) is None
+    profiles.set(1, 'new', profiles.version())
+    assert profiles.get(1) == 'new'
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from app.cors import OriginMiddleware
+
+
+def _middleware(*origins: str, paths: tuple[str, ...] = ()) -> OriginMiddleware:
+    return OriginMiddleware(None, allow_origins=origins, allow_paths=paths)
+
+
+@pytest.mark.parametrize('origin', [
+    'https://app.example.com',
+    'https://a.b.example.com',
+    'https://example.org',
+])
+def test_allowed_origins(origin):
+    assert _middleware('https://*.example.com', 'https://example.org/').is_allowed(origin)
+
+
+@pytest.mark.parametrize('origin', [
+    # the wildcard needs a subdomain
+    'https://example.com',
+    'https://.example.com',
+    # another scheme or a port
+    'http://app.example.com',
+    'https://app.example.com:8443',
+    # look-alike hosts
+    'https://evilexample.com',
+    'https://app.example.com.evil.com',
+    'https://evil.com/.example.com',
+    'https://evil.com:.example.com',
+    'https://sub.example.org',
+    'null',
+    '',
+])
+def test_rejected_origins(origin):
+    assert not _middleware('https://*.example.com', 'https://example.org').is_allowed(origin)
+
+
+def test_star_allows_everything():
+    middleware = _middleware('*')
+    assert middleware.is_allowed('https://anything.test')
+    assert middleware.is_allowed('null')
+
+
+async def _call(middleware: OriginMiddleware, path: str, headers: list[tuple[bytes, bytes]], method: str = 'GET'):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': headers}
+    await middleware(scope, None, send)
+    return messages[0]['status'], dict(messages[0]['headers'])
+
+
+async def _ok(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def test_requests_from_other_origins_are_rejected_outside_the_whitelist():
+    middleware = OriginMiddleware(_ok, allow_origins=['https://*.example.com'], allow_paths=['/metrics'])
+
+    status, headers = asyncio.run(_call(middleware, '/api/v1/users/1', [(b'origin', b'https://app.example.com')]))
+    assert status == 200
+    assert headers[b'access-control-allow-origin'] == b'https://app.example.com'
+
+    status, _ = asyncio.run(_call(middleware, '/api/v1/users/1', [(b'origin', b'https://evil.com')]))
+    assert status == 403
+    status, _ = asyncio.run(_call(middleware, '/api/v1/users/1', []))
+    assert status == 403
+    status, headers = asyncio.run(_call(middleware, '/metrics', [(b'origin', b'https://evil.com')]))
+    assert status == 200
+    assert b'access-control-allow-origin' not in headers
+
+
+def test_preflight_is_answered_for_allowed_methods_only():
+    middleware = OriginMiddleware(_ok, allow_origins=['https://*.example.com'])
+    origin = (b'origin', b'https://app.example.com')
+
+    status, headers = asyncio.run(_call(
+        middleware, '/api/v1/users/1', [origin, (b'access-control-request-method', b'POST')], method='OPTIONS',
+    ))
+    assert status == 200
+    assert headers[b'access-control-allow-methods'] == b'GET, POST'
+
+    status, _ = asyncio.run(_call(
+        middleware, '/api/v1/users/1', [origin, (b'access-control-request-method', b'DELETE')], method='OPTIONS',
+    ))
+    assert status == 400
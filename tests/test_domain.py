@@ -0,0 +1,100 @@
+import math
+import random
+
+from fractions import Fraction
+
+import pytest
+
+from pydantic import ValidationError
+
+from app.models import domain
+from app.models.domain import AbilityScores, AbilityScoresDelta, MAX_LEVELUP_DELTA
+
+ABILITIES = list(AbilityScoresDelta.model_fields)
+
+
+def _summed_cost(ability_name: str, level_current: int, level_target: int) -> int:
+    # the per-level costs summed without rounding, then rounded up once
+    coeff = domain._coeffecients[ability_name]
+    return math.ceil(sum(Fraction(math.pow(level, coeff)) for level in range(level_current, level_target)))
+
+
+def _abilities(**levels: int) -> AbilityScores:
+    return AbilityScores(**{**AbilityScores.default().model_dump(), **levels})
+
+
+def test_cost_tables_match_summed_costs():
+    rng = random.Random(0)
+    for _ in range(2000):
+        ability_name = rng.choice(ABILITIES)
+        level_current = rng.randrange(1, 500)
+        level_target = level_current + rng.randrange(0, 300)
+        abilities = _abilities(**{ability_name: level_current})
+        assert abilities._ability_cost(ability_name, level_target) == _summed_cost(ability_name, level_current, level_target)
+
+
+def test_cost_of_no_change_is_zero():
+    abilities = _abilities(strength=10)
+    assert abilities._ability_cost('strength', 10) == 0
+    assert abilities.upgrade_cost(AbilityScoresDelta()) == 0
+
+
+def test_upgrade_cost_sums_abilities():
+    abilities = _abilities(strength=4, speed=7)
+    delta = AbilityScoresDelta(strength=3, speed=2)
+    assert abilities.upgrade_cost(delta) == _summed_cost('strength', 4, 7) + _summed_cost('speed', 7, 9)
+
+
+@pytest.mark.parametrize('coins', [0, 1, 2, 10, 99, 1000, 123456, 10**7])
+def test_max_upgrade_is_the_largest_affordable_delta(coins):
+    abilities = _abilities(strength=3, defence=12, speed=1, weight=40, combinations=7)
+    delta = abilities.max_upgrade(coins)
+    for ability_name in ABILITIES:
+        level_current = getattr(abilities, ability_name)
+        ability_delta = getattr(delta, ability_name)
+        assert 0 <= ability_delta <= MAX_LEVELUP_DELTA
+        assert abilities._ability_cost(ability_name, level_current + ability_delta) <= coins
+        if ability_delta < MAX_LEVELUP_DELTA:
+            assert abilities._ability_cost(ability_name, level_current + ability_delta + 1) > coins
+
+
+def test_max_upgrade_at_the_exact_price():
+    abilities = _abilities(strength=5)
+    price = abilities._ability_cost('strength', 9)
+    assert abilities.max_upgrade(price).strength == 4
+    assert abilities.max_upgrade(price - 1).strength == 3
+
+
+@pytest.mark.parametrize('coins', [-1, -5, -10**6])
+def test_max_upgrade_with_a_negative_balance_is_zero(coins):
+    delta = _abilities(strength=5, weight=2).max_upgrade(coins)
+    assert all(getattr(delta, ability_name) == 0 for ability_name in ABILITIES)
+
+
+def test_max_upgrade_is_capped():
+    delta = AbilityScores.default().max_upgrade(10**18)
+    assert all(getattr(delta, ability_name) == MAX_LEVELUP_DELTA for ability_name in ABILITIES)
+
+
+@pytest.mark.parametrize('ability_name', ABILITIES)
+def test_negative_delta_is_rejected(ability_name):
+    with pytest.raises(ValidationError):
+        AbilityScoresDelta(**{ability_name: -1})
+
+
+def test_abilities_cannot_be_lowered():
+    abilities = _abilities(strength=5)
+    with pytest.raises(ValueError):
+        abilities._ability_cost('strength', 4)
+    with pytest.raises(ValueError):
+        abilities.upgrade(AbilityScoresDelta.model_construct(strength=-9))
+    assert abilities.strength == 5
+
+
+def test_levels_below_the_start_are_rejected():
+    # a character lowered before deltas were bounded: -4 then +5 priced as a huge credit
+    abilities = _abilities(strength=-4)
+    with pytest.raises(ValueError):
+        abilities.upgrade_cost(AbilityScoresDelta(strength=5))
+    with pytest.raises(ValueError):
+        abilities.max_upgrade(1000)
@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+from app import leaderboard
+from app.leaderboard import RankIndex
+
+
+def _reference(values: dict[int, float]) -> list[tuple[int, float]]:
+    return sorted(values.items(), key=lambda item: (-item[1], item[0]))
+
+
+def _check(index: RankIndex, values: dict[int, float]):
+    expected = _reference(values)
+    assert len(index) == len(expected)
+    for position, (user_id, value) in enumerate(expected, start=1):
+        assert index.rank(user_id) == position
+        assert index.value(user_id) == value
+    for offset in (0, 1, len(expected) // 2, max(len(expected) - 3, 0), len(expected), len(expected) + 5):
+        for limit in (1, 7, 100):
+            assert index.page(offset, limit) == expected[offset:offset + limit]
+
+
+@pytest.fixture
+def small_lists(monkeypatch):
+    # tiny sublists so splits and emptied sublists happen within a few hundred entries
+    monkeypatch.setattr(leaderboard, 'LOAD', 4)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rank_index_matches_sorted_reference(small_lists, seed):
+    rng = random.Random(seed)
+    index, values = RankIndex(), {}
+    for step in range(3000):
+        operation = rng.random()
+        user_id = rng.randrange(300)
+        if operation < 0.7:
+            # few distinct values, so ties are ordered by user_id
+            value = float(rng.randrange(50))
+            index.update(user_id, value)
+            values[user_id] = value
+        elif operation < 0.9:
+            index.discard(user_id)
+            values.pop(user_id, None)
+        else:
+            assert index.rank(user_id) == (_reference(values).index((user_id, values[user_id])) + 1 if user_id in values else None)
+        if step % 250 == 0:
+            _check(index, values)
+    _check(index, values)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_reconcile_matches_load(small_lists, seed):
+    rng = random.Random(seed)
+    index = RankIndex({user_id: float(rng.randrange(100)) for user_id in range(200)})
+    values = {user_id: float(rng.randrange(100)) for user_id in rng.sample(range(400), 250)}
+    index.reconcile(values)
+    _check(index, values)
+    _check(RankIndex(values), values)
+
+
+def test_empty_index():
+    index = RankIndex()
+    assert len(index) == 0
+    assert index.rank(1) is None
+    assert index.page(0, 10) == []
+    index.update(1, 5.0)
+    index.discard(1)
+    assert index.page(0, 10) == []
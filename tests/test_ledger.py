@@ -0,0 +1,102 @@
+import asyncio
+import re
+
+from uuid import uuid4
+
+import pytest
+
+from sqlalchemy.dialects.postgresql import asyncpg
+
+from app import ledger
+from app.ledger import Change
+from app.models import db
+
+
+def _sql(key: str, floor: bool) -> str:
+    return ' '.join(str(ledger.STATEMENTS[key, floor]).split())
+
+
+@pytest.mark.parametrize('key', list(ledger.KEY_TYPES))
+@pytest.mark.parametrize('floor', [False, True])
+def test_statements_take_the_same_parameters(key, floor):
+    statement = ledger.STATEMENTS[key, floor]
+    assert set(statement._bindparams) == {'keys', 'deltas', 'reason', 'match_id'}
+    # every parameter is bound by asyncpg as a positional one
+    compiled = str(statement.compile(dialect=asyncpg.dialect()))
+    assert re.findall(r'\$\d+', compiled) == ['$1', '$2', '$3', '$4']
+
+
+@pytest.mark.parametrize('key, key_type', list(ledger.KEY_TYPES.items()))
+def test_keys_are_cast_to_their_column_type(key, key_type):
+    for floor in (False, True):
+        sql = _sql(key, floor)
+        assert f'CAST(:keys AS {key_type}[])' in sql
+        assert f'ON users.{key} = deltas.key' in sql
+
+
+def test_floor_clamps_the_balance_at_zero():
+    sql = _sql('tg_id', True)
+    assert 'SET score = greatest(0, locked.score + locked.delta)' in sql
+    # every locked user is changed; the entry records what was actually taken
+    assert 'WHERE users.sid = locked.sid RETURNING' in sql
+    assert 'users.score - locked.score AS delta' in sql
+
+
+def test_without_floor_changes_below_zero_are_refused():
+    sql = _sql('tg_id', False)
+    assert 'SET score = locked.score + locked.delta' in sql
+    assert 'greatest' not in sql
+    assert 'WHERE users.sid = locked.sid AND locked.score + locked.delta >= 0 RETURNING' in sql
+    # a refused user keeps its locked balance and reports no change
+    assert 'coalesce(changed.score, locked.score), coalesce(changed.delta, 0)' in sql
+
+
+def test_users_are_locked_in_sid_order_and_only_changes_are_logged():
+    for statement in ledger.STATEMENTS.values():
+        sql = ' '.join(str(statement).split())
+        assert 'SELECT DISTINCT ON (deltas.key) users.sid' in sql
+        assert 'ORDER BY deltas.key, users.sid' in sql
+        assert 'ORDER BY users.sid FOR UPDATE OF users' in sql
+        assert 'FROM changed WHERE delta <> 0' in sql
+
+
+class _Result:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def all(self):
+        return self._rows
+
+
+class _Session:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    async def exec(self, statement, params=None):
+        self.executed.append((statement, params))
+        return _Result(self.rows)
+
+
+def test_apply_runs_the_statement_for_the_key_and_floor():
+    match_id = uuid4()
+    session = _Session([(1, 0, -30), (2, 120, 20)])
+    changes = asyncio.run(ledger.apply(session, {1: -50, 2: 20}, db.CoinReason.match, match_id, floor=True))
+
+    [(statement, params)] = session.executed
+    assert statement is ledger.STATEMENTS['tg_id', True]
+    assert params == {'keys': [1, 2], 'deltas': [-50, 20], 'reason': 'match', 'match_id': match_id}
+    # with floor the applied delta is what was actually taken, not what was asked for
+    assert changes == {1: Change(0, -30), 2: Change(120, 20)}
+
+
+def test_apply_reports_refused_and_missing_users():
+    sid = uuid4()
+    session = _Session([(sid, 10, 0)])
+    before = ledger.entries_written._values.get(('levelup',), 0)
+    changes = asyncio.run(ledger.apply(session, {sid: -50, uuid4(): 5}, db.CoinReason.levelup, key='sid'))
+
+    assert session.executed[0][0] is ledger.STATEMENTS['sid', False]
+    # the refused user keeps its balance with no delta applied, the unknown one is missing
+    assert changes == {sid: Change(10, 0)}
+    assert ledger.entries_written._values.get(('levelup',), 0) == before
@@ -0,0 +1,132 @@
+import asyncio
+
+from datetime import datetime, timedelta, timezone
+
+from app import matchmaking
+from app.matchmaking import OpponentPool
+
+
+def _pool(levels: dict[int, int]) -> OpponentPool:
+    pool = OpponentPool()
+    for user_id, level in levels.items():
+        pool.upsert(user_id, level)
+    return pool
+
+
+def _sample_all(pool: OpponentPool, player_id: int, min_level: int, max_level: int) -> set[int]:
+    # sample draws at random with a bounded number of draws, repeat it to see everyone
+    picked = set()
+    for _ in range(200):
+        picked.update(pool.sample(player_id, min_level, max_level, k=10))
+    return picked
+
+
+def test_sample_stays_within_levels_and_skips_the_player():
+    pool = _pool({1: 1, 2: 2, 3: 2, 4: 3, 5: 5})
+    assert _sample_all(pool, 2, 2, 3) <= {3, 4}
+    for _ in range(50):
+        picked = pool.sample(2, 1, 3, k=2)
+        assert len(picked) == len(set(picked)) <= 2
+        assert set(picked) <= {1, 3, 4}
+    assert pool.sample(1, 4, 4) == []
+
+
+def test_upsert_moves_between_levels():
+    pool = _pool({1: 1, 2: 1})
+    pool.upsert(1, 4)
+    assert len(pool) == 2
+    assert _sample_all(pool, 0, 1, 1) == {2}
+    assert _sample_all(pool, 0, 4, 4) == {1}
+
+
+def test_reserved_characters_are_not_sampled_until_they_expire():
+    pool = _pool({1: 1, 2: 1})
+    ts_now = datetime.now(timezone.utc)
+    pool.reserve(1, ts_now + timedelta(minutes=5))
+    pool.reserve(2, ts_now - timedelta(seconds=1))
+    # 2's reservation has passed, the sample puts it back
+    assert _sample_all(pool, 0, 1, 1) == {2}
+
+    pool.release(1)
+    assert _sample_all(pool, 0, 1, 1) == {1, 2}
+
+
+def test_extended_reservation_outlives_its_stale_expiry():
+    pool = _pool({1: 1})
+    ts_now = datetime.now(timezone.utc)
+    pool.reserve(1, ts_now - timedelta(seconds=1))
+    pool.reserve(1, ts_now + timedelta(minutes=5))
+    assert _sample_all(pool, 0, 1, 1) == set()
+
+
+def test_upsert_with_a_future_invulnerability_reserves():
+    pool = OpponentPool()
+    pool.upsert(1, 1, datetime.now(timezone.utc) + timedelta(minutes=5))
+    pool.upsert(2, 1, datetime.now(timezone.utc) - timedelta(minutes=5))
+    assert _sample_all(pool, 0, 1, 1) == {2}
+
+
+def test_unknown_characters_are_ignored():
+    pool = OpponentPool()
+    pool.reserve(1, datetime.now(timezone.utc) + timedelta(minutes=5))
+    pool.release(1)
+    assert len(pool) == 0
+    assert pool.sample(0, 1, 10) == []
+
+
+def test_concurrent_refreshes_share_one_load(monkeypatch):
+    loads = 0
+
+    async def load(self, session):
+        nonlocal loads
+        loads += 1
+        await asyncio.sleep(0.01)
+        self._watermark = datetime.now(timezone.utc)
+
+    monkeypatch.setattr(OpponentPool, '_load', load)
+
+    async def refresh_concurrently():
+        pool = OpponentPool()
+        # the first load and the incremental ones after it
+        for _ in range(2):
+            await asyncio.gather(*(pool.refresh(None, force=True) for _ in range(20)))
+            assert pool._refreshing is None
+
+    asyncio.run(refresh_concurrently())
+    assert loads == 2
+
+
+def test_failed_refresh_releases_the_waiters(monkeypatch):
+    async def load(self, session):
+        await asyncio.sleep(0.01)
+        raise RuntimeError('connection lost')
+
+    monkeypatch.setattr(OpponentPool, '_load', load)
+
+    async def refresh_concurrently():
+        pool = OpponentPool()
+        results = await asyncio.gather(*(pool.refresh(None, force=True) for _ in range(5)), return_exceptions=True)
+        assert isinstance(results[0], RuntimeError)
+        assert results[1:] == [None] * 4
+        assert pool._refreshing is None
+
+    asyncio.run(refresh_concurrently())
+
+
+def test_refresh_is_skipped_within_the_interval(monkeypatch):
+    loads = 0
+
+    async def load(self, session):
+        nonlocal loads
+        loads += 1
+
+    monkeypatch.setattr(OpponentPool, '_load', load)
+    monkeypatch.setattr(matchmaking, 'REFRESH_INTERVAL', 60.0)
+
+    async def refresh_twice():
+        pool = OpponentPool()
+        await pool.refresh(None)
+        await pool.refresh(None)
+
+    asyncio.run(refresh_twice())
+    assert loads == 1
@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+# delivery imports it lazily; importing it here keeps the first send from taking seconds
+import aiogram.exceptions
+
+from app import notifications
+from app.notifications import DefenceReport, NotificationDispatcher, _RateLimiter
+
+WINDOW = 0.1
+
+
+class _Bot:
+    def __init__(self):
+        self.sent: list[tuple[float, int, str]] = []
+
+    async def send_message(self, chat_id: int, text: str, reply_markup=None):
+        self.sent.append((asyncio.get_running_loop().time(), chat_id, text))
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    bot = _Bot()
+    monkeypatch.setattr(notifications, 'get_bot', lambda: bot)
+    monkeypatch.setattr(notifications, 'bro_button', lambda: None)
+    monkeypatch.setattr(notifications, 'COALESCE_WINDOW', WINDOW)
+    monkeypatch.setattr(notifications, 'GLOBAL_RATE', 1000.0)
+    return bot
+
+
+def _report(chat_id: int, attacker: str, score_delta: int = 10) -> DefenceReport:
+    return DefenceReport(
+        chat_id=chat_id, attacker=attacker, attacker_power=100, winner=attacker,
+        defended=False, score_delta=score_delta, score=500, energy=10,
+    )
+
+
+async def _until(predicate, timeout: float = 2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        assert loop.time() < deadline
+        await asyncio.sleep(0.005)
+
+
+def test_reports_within_the_window_are_sent_as_one_digest(bot):
+    async def attack():
+        dispatcher = NotificationDispatcher()
+        await dispatcher.start()
+        # the first report goes out right away, the rest wait out the window
+        dispatcher.submit(_report(1, 'first'))
+        await _until(lambda: len(bot.sent) == 1)
+        for attacker in ('second', 'third'):
+            dispatcher.submit(_report(1, attacker))
+        dispatcher.submit(_report(2, 'other'))
+        await _until(lambda: len(bot.sent) == 3)
+
+        # a quiet window ends the coalescing, the next report is sent right away again
+        await _until(lambda: 1 not in dispatcher._pending)
+        dispatcher.submit(_report(1, 'fourth'))
+        await _until(lambda: len(bot.sent) == 4)
+        await dispatcher.stop()
+        return dispatcher
+
+    dispatcher = asyncio.run(attack())
+    by_chat = [(chat_id, text) for _, chat_id, text in bot.sent]
+    assert [chat_id for chat_id, _ in by_chat] == [1, 2, 1, 1]
+    assert '@first' in by_chat[0][1]
+    assert 'attacked 2 times by @second, @third' in by_chat[2][1]
+    assert '@fourth' in by_chat[3][1]
+    assert dispatcher.sent == 4
+
+    first, digest = [ts for ts, chat_id, _ in bot.sent if chat_id == 1][:2]
+    # loop timers may fire up to a clock resolution early
+    assert digest - first >= WINDOW - 0.005
+
+
+def test_pending_reports_are_delivered_on_stop(bot):
+    async def attack():
+        dispatcher = NotificationDispatcher()
+        await dispatcher.start()
+        dispatcher.submit(_report(1, 'first'))
+        await _until(lambda: len(bot.sent) == 1)
+        dispatcher.submit(_report(1, 'second'))
+        dispatcher.submit(_report(1, 'third'))
+        await dispatcher.stop()
+
+    asyncio.run(attack())
+    assert len(bot.sent) == 2
+    assert 'attacked 2 times' in bot.sent[1][2]
+
+
+def test_full_queue_drops_reports(bot, monkeypatch):
+    monkeypatch.setattr(notifications, 'QUEUE_SIZE', 2)
+
+    async def flood():
+        dispatcher = NotificationDispatcher()
+        assert [dispatcher.submit(_report(1, 'spammer')) for _ in range(3)] == [True, True, False]
+        return dispatcher
+
+    dispatcher = asyncio.run(flood())
+    assert (dispatcher.depth, dispatcher.dropped) == (2, 1)
+
+
+def test_rate_limiter_spaces_acquisitions():
+    async def acquire_all():
+        limiter = _RateLimiter(rate=50)
+        loop = asyncio.get_running_loop()
+        times = []
+
+        async def acquire():
+            await limiter.acquire()
+            times.append(loop.time())
+
+        await asyncio.gather(*(acquire() for _ in range(5)))
+        limiter.pause(0.1)
+        await acquire()
+        return times
+
+    times = asyncio.run(acquire_all())
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    # loop timers may fire up to a clock resolution early
+    assert all(gap >= 0.02 - 0.005 for gap in gaps[:4])
+    assert gaps[4] >= 0.1 - 0.005
+
+
+def test_digest_sums_the_reports():
+    reports = [_report(1, f'attacker{n}', score_delta=-5) for n in range(5)]
+    reports[0].defended = True
+    text = notifications.render(reports)
+    assert 'attacked 5 times by @attacker0, @attacker1, @attacker2, 2 more' in text
+    assert 'Defended: 1, lost: 4' in text
+    assert 'Result: -25 $BRO' in text